@@ -0,0 +1,72 @@
+from collections import OrderedDict
+
+import pytest
+import torch
+
+from whisperspeech.t2s_up_wds_mlang_enclm import TSARTransformer
+from whisperspeech.s2a_delar_mup_wds_mlang import SADelARTransformer
+from whisperspeech.pipeline import Pipeline
+
+# Tiny randomly initialized models: the invariants we check do not depend on the weights, only on the
+# decoding code paths. The weights are perturbed so the outputs are not dominated by the zero init.
+
+def perturb(model, seed=1):
+    g = torch.Generator().manual_seed(seed)
+    with torch.no_grad():
+        for p in model.parameters(): p.add_(0.05 * torch.randn(p.shape, generator=g))
+    return model
+
+def tiny_t2s(**kwargs):
+    torch.manual_seed(0)
+    model = TSARTransformer(depth=2, n_head=2, head_width=16, ttoks_len=64, stoks_len=80, stoks_codes=33, **kwargs)
+    return perturb(model).eval()
+
+def tiny_s2a(cls=SADelARTransformer, **kwargs):
+    torch.manual_seed(0)
+    model = cls(depth=2, n_head=2, head_width=16, ctx_n=120, stoks_len=40, stoks_codes=33, quantizers=4, spk_width=192, **kwargs)
+    return perturb(model).eval()
+
+def optimized(model, max_batch_size=1, **kwargs):
+    model.optimize(max_batch_size=max_batch_size, torch_compile=False, dtype=torch.float32, **kwargs)
+    return model
+
+def tiny_pipeline(max_batch_size=1, **kwargs):
+    # a `Pipeline` with the tiny models, without a vocoder and a speaker embedding model
+    pipe = Pipeline.__new__(Pipeline)
+    pipe.t2s = optimized(tiny_t2s(), max_batch_size)
+    pipe.s2a = optimized(tiny_s2a(), max_batch_size)
+    pipe.device, pipe.voices, pipe.encoder, pipe.vocoder = 'cpu', None, None, None
+    pipe.spk_cache, pipe.spk_cache_size, pipe.spk_cache_dir = OrderedDict(), 64, None
+    for k,v in kwargs.items(): setattr(pipe, k, v)
+    return pipe
+
+def tiny_vocoder():
+    # the `charactr/vocos-encodec-24khz` config with a smaller, randomly initialized backbone
+    from vocos import Vocos
+    from vocos.pretrained import instantiate_class
+    from whisperspeech.a2wav import Vocoder, _OfflineEncodecFeatures
+    config = dict(
+        feature_extractor=dict(class_path="vocos.feature_extractors.EncodecFeatures",
+                               init_args=dict(encodec_model="encodec_24khz", bandwidths=[1.5, 3.0, 6.0, 12.0])),
+        backbone=dict(class_path="vocos.models.VocosBackbone",
+                      init_args=dict(input_channels=128, dim=64, intermediate_dim=128, num_layers=2, adanorm_num_embeddings=4)),
+        head=dict(class_path="vocos.heads.ISTFTHead", init_args=dict(dim=64, n_fft=1280, hop_length=320, padding="same")))
+    torch.manual_seed(0)
+    vocoder = Vocoder.__new__(Vocoder)
+    vocoder.device, vocoder.repo_id, vocoder.quantized, vocoder.config = 'cpu', None, False, config
+    vocoder.vocos = Vocos(feature_extractor=_OfflineEncodecFeatures(**config["feature_extractor"]["init_args"]),
+                          backbone=instantiate_class(args=(), init=config["backbone"]),
+                          head=instantiate_class(args=(), init=config["head"])).eval()
+    return vocoder
+
+@pytest.fixture
+def t2s(): return tiny_t2s()
+
+@pytest.fixture
+def s2a(): return tiny_s2a()
+
+@pytest.fixture
+def stoks(): return torch.randint(0, 32, (24,), generator=torch.Generator().manual_seed(0))
+
+@pytest.fixture
+def speaker(): return torch.randn(1, 192, generator=torch.Generator().manual_seed(0))
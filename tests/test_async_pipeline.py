@@ -0,0 +1,69 @@
+import asyncio
+import time
+
+import pytest
+import torch
+
+from conftest import tiny_pipeline
+from whisperspeech.async_pipeline import AsyncPipeline
+
+class SlowPipeline:
+    # stands in for `Pipeline`, every decode step takes 10ms
+    def __init__(self): self.running = False
+
+    def generate_atoks(self, text, speaker=None, lang='en', cps=15, step_callback=None):
+        self.running = True
+        try:
+            for _ in range(100):
+                time.sleep(0.01)
+                step_callback()
+            return text
+        finally:
+            self.running = False
+
+    def generate_stream(self, text, speaker=None, lang='en', cps=15, chunk=25, context=8, step_callback=None):
+        self.running = True
+        try:
+            for i in range(100):
+                time.sleep(0.01)
+                step_callback()
+                yield i
+        finally:
+            self.running = False
+
+def test_cancel_keeps_the_slot_until_the_worker_stops():
+    pipe = SlowPipeline()
+    async def main():
+        apipe = AsyncPipeline(pipe, max_pending=1)
+        task = asyncio.create_task(apipe.generate_atoks("hello"))
+        await asyncio.sleep(0.05)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError): await task
+        assert not pipe.running
+        assert await apipe.generate_atoks("again") == "again"
+        apipe.close()
+    asyncio.run(main())
+
+def test_closing_a_stream_waits_for_the_worker():
+    pipe = SlowPipeline()
+    async def main():
+        apipe = AsyncPipeline(pipe, max_pending=1)
+        stream = apipe.generate_stream("hello")
+        assert await stream.__anext__() == 0
+        await stream.aclose()
+        assert not pipe.running
+        apipe.close()
+    asyncio.run(main())
+
+def test_stream_does_not_run_next_to_the_batching_server():
+    pipe = tiny_pipeline(2)
+    async def main():
+        apipe = AsyncPipeline(pipe, batching=True)
+        ref = await apipe.generate_atoks("Hello world.", seed=3)
+        # a stream would use the KV cache rows of the requests the server is decoding
+        task = asyncio.create_task(apipe.generate_atoks("Hello world.", seed=3))
+        with pytest.raises(ValueError):
+            async for _ in apipe.generate_stream("Hello world."): pass
+        assert torch.equal(await task, ref)
+        apipe.close()
+    asyncio.run(main())
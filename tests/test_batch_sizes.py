@@ -0,0 +1,57 @@
+import pytest
+import torch
+
+from conftest import optimized, tiny_pipeline
+from whisperspeech.batching import BatchingServer, S2ABatcher, T2SBatcher
+
+TEXT = "Hello world, this is a test."
+
+# generating fewer rows than the KV cache holds (e.g. `Pipeline(max_batch_size=8)` serving a single request)
+# must give the same tokens as with a cache of the exact size
+
+@pytest.mark.parametrize("bs", [1, 2])
+def test_t2s_smaller_batch_than_cache(t2s, bs):
+    ref = optimized(t2s, bs).generate(TEXT, bs=bs, seed=3, show_progress_bar=False)
+    out = optimized(t2s, 4).generate(TEXT, bs=bs, seed=3, show_progress_bar=False)
+    assert torch.equal(out, ref)
+
+@pytest.mark.parametrize("bs", [1, 2])
+def test_s2a_smaller_batch_than_cache(s2a, stoks, speaker, bs):
+    ref = optimized(s2a, bs).generate(stoks, speaker, bs=bs, seed=3, show_progress_bar=False)
+    out = optimized(s2a, 4).generate(stoks, speaker, bs=bs, seed=3, show_progress_bar=False)
+    assert torch.equal(out, ref)
+
+def test_t2s_batcher_clamps_n(t2s):
+    model = optimized(t2s, 2)
+    assert T2SBatcher(model, N=10 * model.stoks_len).N == model.stoks_len
+    ref = model.generate_batch([TEXT], seed=3, show_progress_bar=False)
+    out = model.generate_batch([TEXT], N=10 * model.stoks_len, seed=3, show_progress_bar=False)
+    assert all(torch.equal(x, y) for x,y in zip(out, ref))
+
+# T2S can stop right away, the empty (or too short) semantic tokens must not break the other requests
+
+def test_s2a_batcher_short_stoks(s2a, stoks, speaker):
+    model = optimized(s2a, 2)
+    out = model.generate_batch([stoks, stoks[:0], stoks[:1]], speaker, seed=3, show_progress_bar=False)
+    assert torch.equal(out[0], model.generate(stoks, speaker, seed=3, show_progress_bar=False))
+    assert out[1].shape == out[2].shape == (1, model.quantizers, 0)
+
+def test_s2a_batcher_fails_only_the_bad_request(s2a, stoks, speaker):
+    batcher = S2ABatcher(optimized(s2a, 2))
+    good = batcher.submit(stoks, speaker[0], seed=3)
+    bad = batcher.submit(stoks, speaker[0,:10], seed=4) # the wrong embedding size
+    while not (good.done() and bad.done()): batcher.step()
+    assert isinstance(bad.exception(), RuntimeError)
+    assert torch.equal(good.result(), s2a.generate(stoks, speaker, seed=3, show_progress_bar=False))
+
+def test_server_fails_only_the_bad_request():
+    pipe = tiny_pipeline(2)
+    server = BatchingServer(pipe).start()
+    try:
+        good = server.submit(TEXT, seed=3)
+        bad = server.submit(TEXT, speaker=torch.zeros(10), seed=3)
+        ref = good.result(timeout=60)
+        with pytest.raises(RuntimeError): bad.result(timeout=60)
+        assert torch.equal(server.submit(TEXT, seed=3).result(timeout=60), ref)
+    finally:
+        server.stop()
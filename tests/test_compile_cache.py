@@ -0,0 +1,11 @@
+import pytest
+import torch
+
+from whisperspeech import inference
+
+def test_compile_cache_needs_recent_torch(tmp_path, monkeypatch):
+    monkeypatch.delattr(torch.compiler, 'save_cache_artifacts', raising=False)
+    with pytest.raises(RuntimeError, match="PyTorch 2.7"):
+        inference.save_compile_cache(tmp_path/"cache.bin")
+    with pytest.raises(RuntimeError, match="PyTorch 2.7"):
+        inference.load_compile_cache(tmp_path/"cache.bin")
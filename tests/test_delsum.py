@@ -0,0 +1,23 @@
+import pytest
+import torch
+
+from conftest import tiny_s2a
+from whisperspeech.s2a_delar_mup_wds_mlang_cond import SADelARTransformer as CondSADelARTransformer
+
+@pytest.mark.parametrize("cls", [None, CondSADelARTransformer])
+@torch.no_grad()
+def test_stacked_tables_match_the_quantizer_loop(cls):
+    model = tiny_s2a(cls) if cls else tiny_s2a()
+    embds = model.embds
+    embds.convert_for_eval()
+    toks = torch.randint(0, embds.embeddings[0].main.weight.shape[0], (2, model.quantizers, 10))
+    x = torch.randn(2, 10, model.width)
+    fast = embds(toks, None), model.head(x, embeddings=embds)
+    # without the stacked tables we go through the per-quantizer embeddings one by one
+    merged = embds.merged_in, embds.merged_out
+    embds.merged_in = embds.merged_out = None
+    slow = embds(toks, None), model.head(x, embeddings=embds)
+    embds.merged_in, embds.merged_out = merged
+    for a, b in zip(fast, slow):
+        assert a.shape == b.shape
+        assert torch.allclose(a, b, atol=1e-5)
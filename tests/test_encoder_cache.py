@@ -0,0 +1,24 @@
+import torch
+
+from conftest import optimized, tiny_s2a, tiny_t2s
+
+TEXT = "Hello world, this is a test."
+
+def test_t2s_encoder_cache():
+    ref = optimized(tiny_t2s()).generate(TEXT, seed=3, show_progress_bar=False)
+    model = optimized(tiny_t2s(), encoder_cache_size=4)
+    for i in range(2):
+        assert torch.equal(model.generate(TEXT, seed=3, show_progress_bar=False), ref)
+    assert (model.encoder_cache.misses, model.encoder_cache.hits) == (1, 1)
+    # a different speed is a different encoder input
+    model.generate(TEXT, cps=10, seed=3, show_progress_bar=False)
+    assert model.encoder_cache.misses == 2
+
+def test_s2a_encoder_cache(stoks, speaker):
+    ref = optimized(tiny_s2a()).generate(stoks, speaker, seed=3, show_progress_bar=False)
+    model = optimized(tiny_s2a(), encoder_cache_size=4)
+    for i in range(2):
+        assert torch.equal(model.generate(stoks, speaker, seed=3, show_progress_bar=False), ref)
+    assert (model.encoder_cache.misses, model.encoder_cache.hits) == (1, 1)
+    model.generate(stoks, speaker + 1, seed=3, show_progress_bar=False)
+    assert model.encoder_cache.misses == 2
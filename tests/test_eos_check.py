@@ -0,0 +1,19 @@
+import pytest
+import torch
+
+from conftest import optimized
+
+TEXT = "Hello world, this is a test."
+
+@pytest.mark.parametrize("seed", [0, 1, 2])
+def test_result_does_not_depend_on_eos_check_interval(t2s, seed):
+    # finished rows keep sampling until the next check but are padded with EOT and trimmed the same way
+    t2s = optimized(t2s, 2)
+    outs, steps = {}, {}
+    for interval in (1, 3, 8, 100):
+        steps[interval] = []
+        outs[interval] = t2s.generate(TEXT, bs=2, seed=seed, eos_check_interval=interval,
+                                      step=lambda: steps[interval].append(1), show_progress_bar=False)
+    for interval in (3, 8, 100):
+        assert torch.equal(outs[interval], outs[1])
+        assert len(steps[1]) <= len(steps[interval])
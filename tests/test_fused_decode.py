@@ -0,0 +1,22 @@
+import torch
+
+from conftest import optimized
+from whisperspeech.benchmark_fused_decode import decoder_step_error
+
+TEXT = "Hello world, this is a test."
+
+# the fused single-token decoding step has to give the same results as the regular layers
+
+def test_fused_decode_step(t2s, s2a):
+    for model in (t2s, s2a):
+        assert decoder_step_error(optimized(model, 2, fused_decode=True).decoder, position=20) < 1e-5
+
+def test_t2s_fused_decode(t2s):
+    ref = optimized(t2s).generate(TEXT, seed=3, show_progress_bar=False)
+    out = optimized(t2s, fused_decode=True).generate(TEXT, seed=3, show_progress_bar=False)
+    assert torch.equal(out, ref)
+
+def test_s2a_fused_decode(s2a, stoks, speaker):
+    ref = optimized(s2a).generate(stoks, speaker, seed=3, show_progress_bar=False)
+    out = optimized(s2a, fused_decode=True).generate(stoks, speaker, seed=3, show_progress_bar=False)
+    assert torch.equal(out, ref)
@@ -0,0 +1,25 @@
+import pytest
+import torch
+
+from conftest import optimized, tiny_s2a
+from whisperspeech.s2a_delar_mup_wds_mlang_cond import SADelARTransformer as CondSADelARTransformer
+
+TEXTS = ["Hello world, this is a test.", "A second, slightly longer sentence to check the batching."]
+
+# every sequence of a batch has to get the same tokens as when it is generated on its own with the same seed
+
+def test_t2s_generate_batch(t2s):
+    model = optimized(t2s, 2)
+    N = model.stoks_len
+    out = model.generate_batch(TEXTS, N=N, T=0.7, top_k=None, seed=3, show_progress_bar=False)
+    for j, txt in enumerate(TEXTS):
+        ref = model.generate(txt, N=N, seed=3+j, show_progress_bar=False)[0]
+        assert torch.equal(out[j], ref[:len(out[j])])
+
+@pytest.mark.parametrize("cls", [None, CondSADelARTransformer])
+def test_s2a_generate_batch(stoks, speaker, cls):
+    model = optimized(tiny_s2a(cls) if cls else tiny_s2a(), 2)
+    seqs = [stoks, stoks[:15]]
+    out = model.generate_batch(seqs, speaker, seed=3, show_progress_bar=False)
+    for j, x in enumerate(seqs):
+        assert torch.equal(out[j], model.generate(x, speaker, seed=3+j, show_progress_bar=False))
@@ -0,0 +1,69 @@
+import pytest
+import torch
+
+from conftest import tiny_pipeline
+from whisperspeech.pipeline import split_text
+
+TEXT = "This is a test of the long text synthesis. It has a few sentences, some of them with clauses. The end."
+
+class FakeVocoder:
+    # 320 samples per acoustic frame like Vocos
+    def decode(self, atoks): return torch.zeros(1, atoks.shape[-1] * 320)
+
+def test_split_text():
+    segments = split_text(TEXT, 50)
+    assert all(len(x) <= 50 for x in segments)
+    assert " ".join(segments) == TEXT
+    # the first sentence does not fit and is split on the words
+    assert segments[0] == "This is a test of the long text synthesis."
+
+def test_split_text_long_word():
+    assert split_text("a " + "x" * 25 + " b", 10) == ["a", "x" * 10, "x" * 10, "x" * 5 + " b"]
+
+def test_split_text_empty():
+    assert split_text("", 10) == split_text("  \n ", 10) == []
+    with pytest.raises(ValueError): split_text(TEXT, 0)
+
+def test_max_segment_chars():
+    pipe = tiny_pipeline()
+    # S2A voices at most (ctx_n-1)//3 = 39 semantic tokens including the prompt
+    assert pipe.stoks_budget(10) == 29
+    assert pipe.max_segment_chars(cps=15, prompt_stoks=10) >= 1
+    with pytest.raises(ValueError): pipe.max_segment_chars(cps=15, prompt_stoks=39)
+
+def fake_t2s(pipe, tokens_per_char=1):
+    # a T2S speaking much slower than `max_segment_chars` assumes
+    made = []
+    def generate(txt):
+        made.append(torch.randint(0, 32, (int(len(txt) * tokens_per_char),)))
+        return made[-1]
+    pipe.t2s.generate_batch = lambda txts, **kwargs: [generate(x) for x in txts]
+    pipe.t2s.generate = lambda txt, **kwargs: generate(txt).unsqueeze(0)
+    return made
+
+def record_s2a(pipe):
+    seen = []
+    generate, generate_batch = pipe.s2a.generate, pipe.s2a.generate_batch
+    def record(fn):
+        def wrapper(stoks, *args, **kwargs):
+            seen.extend(len(x) for x in (stoks if isinstance(stoks, list) else [stoks]))
+            return fn(stoks, *args, **kwargs)
+        return wrapper
+    pipe.s2a.generate, pipe.s2a.generate_batch = record(generate), record(generate_batch)
+    return seen
+
+@pytest.mark.parametrize("method", ["generate_long", "generate_pipelined"])
+def test_too_long_segments_are_split_again(method):
+    pipe = tiny_pipeline(2, vocoder=FakeVocoder())
+    made, seen = fake_t2s(pipe), record_s2a(pipe)
+    audio = getattr(pipe, method)(TEXT, max_chars=1000, prompt_seconds=0.4, crossfade=0)
+    if method == "generate_pipelined": audio = torch.cat(list(audio), dim=-1)
+    budget = pipe.stoks_budget(10)
+    assert len(made) > 1 and max(seen) <= budget + 10
+    # all the text is voiced, with 3 acoustic frames per semantic token (minus the delay of the quantizers)
+    assert audio.shape[-1] == 320 * sum(3 * len(x) - pipe.s2a.quantizers for x in made if len(x) <= budget)
+
+def test_unsplittable_segment_raises():
+    pipe = tiny_pipeline(2, vocoder=FakeVocoder())
+    fake_t2s(pipe, tokens_per_char=40)
+    with pytest.raises(ValueError): pipe.generate_long("abc", max_chars=1000, prompt_seconds=0.4)
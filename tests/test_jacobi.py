@@ -0,0 +1,24 @@
+import pytest
+import torch
+
+from conftest import optimized
+
+# seeded Jacobi decoding must give exactly the tokens of the sequential loop (`jacobi_window=None`)
+
+@pytest.mark.parametrize("window", [2, 4, 8])
+def test_s2a_jacobi_matches_sequential(s2a, stoks, speaker, window):
+    s2a = optimized(s2a)
+    ref = s2a.generate(stoks, speaker, seed=5, show_progress_bar=False)
+    out = s2a.generate(stoks, speaker, seed=5, jacobi_window=window, show_progress_bar=False)
+    assert torch.equal(out, ref)
+
+def test_s2a_jacobi_with_sliding_window(s2a, speaker):
+    # long enough to wrap around the ring buffer and slide the encoder
+    stoks = torch.randint(0, 32, (60,), generator=torch.Generator().manual_seed(0))
+    s2a = optimized(s2a, window=40)
+    ref = s2a.generate(stoks, speaker, seed=5, show_progress_bar=False)
+    out = s2a.generate(stoks, speaker, seed=5, jacobi_window=8, show_progress_bar=False)
+    assert torch.equal(out, ref)
+    slack = s2a.decoder.layers[0].attn.k_cache.shape[2] - 40
+    with pytest.raises(AssertionError, match="slack"):
+        s2a.generate(stoks, speaker, seed=5, jacobi_window=slack+1, show_progress_bar=False)
@@ -0,0 +1,34 @@
+import pytest
+import torch
+
+from conftest import optimized, tiny_s2a, tiny_t2s
+from whisperspeech.inference import LengthBuckets
+from whisperspeech.modules import BaseDecoder
+
+TEXT = "Hello world, this is a test."
+
+def full_cache(model):
+    # make every decoding step read the whole KV cache (the unfilled part is masked out)
+    model.decoder.set_kv_len = lambda n: BaseDecoder.set_kv_len(model.decoder, None)
+    return model
+
+@pytest.mark.parametrize("buckets", [None, [16, 32, 64]])
+def test_t2s_kv_prefix_matches_full_cache(buckets):
+    ref = full_cache(optimized(tiny_t2s())).generate(TEXT, seed=3, show_progress_bar=False)
+    model = optimized(tiny_t2s())
+    if buckets: model.decoder.kv_len_buckets = LengthBuckets(model.stoks_len, buckets)
+    read = []
+    out = model.generate(TEXT, seed=3, step=lambda: read.append(model.decoder.layers[0].attn.kv_len), show_progress_bar=False)
+    assert torch.equal(out, ref)
+    assert min(read) < model.stoks_len
+    if buckets: assert set(read) <= set(model.decoder.kv_len_buckets.sizes)
+
+@pytest.mark.parametrize("buckets", [None, [16, 32, 64]])
+def test_s2a_kv_prefix_matches_full_cache(stoks, speaker, buckets):
+    ref = full_cache(optimized(tiny_s2a())).generate(stoks, speaker, seed=3, show_progress_bar=False)
+    model = optimized(tiny_s2a())
+    if buckets: model.decoder.kv_len_buckets = LengthBuckets(model.ctx_n, buckets)
+    read = []
+    out = model.generate(stoks, speaker, seed=3, step=lambda: read.append(model.decoder.layers[0].attn.kv_len), show_progress_bar=False)
+    assert torch.equal(out, ref)
+    assert min(read) < model.ctx_n
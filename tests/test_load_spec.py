@@ -0,0 +1,12 @@
+import pytest
+import torch
+
+from whisperspeech import inference
+
+@pytest.mark.parametrize("zipped", [True, False])
+def test_load_spec_mmap(tmp_path, zipped):
+    # `fast=True` loads memory-mapped, checkpoints in the legacy format have to fall back to a normal load
+    spec = dict(config={}, state_dict={'w': torch.arange(4.)})
+    torch.save(spec, tmp_path/"model.model", _use_new_zipfile_serialization=zipped)
+    loaded = inference.load_spec(tmp_path/"model.model", mmap=True)
+    assert torch.equal(loaded['state_dict']['w'], spec['state_dict']['w'])
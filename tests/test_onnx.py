@@ -0,0 +1,36 @@
+import pytest
+import torch
+
+pytest.importorskip("onnx")
+pytest.importorskip("onnxruntime")
+
+from conftest import optimized, tiny_s2a, tiny_t2s
+from whisperspeech.export_onnx import export_t2s, export_s2a
+from whisperspeech.ort_inference import ORTT2S, ORTS2A
+from whisperspeech.s2a_delar_mup_wds_mlang_cond import SADelARTransformer as CondSADelARTransformer
+
+TEXT = "Hello world, this is a test."
+
+# the exported graphs with the numpy KV caches have to sample the same tokens as the PyTorch models
+
+def test_t2s_onnx(t2s, tmp_path):
+    ref = optimized(t2s).generate(TEXT, seed=3, show_progress_bar=False)
+    export_t2s(t2s, tmp_path)
+    out = ORTT2S(tmp_path).generate(TEXT, seed=3)
+    assert torch.equal(torch.as_tensor(out), ref)
+
+@pytest.mark.parametrize("cls", [None, CondSADelARTransformer])
+def test_s2a_onnx(stoks, speaker, tmp_path, cls):
+    s2a = tiny_s2a(cls) if cls else tiny_s2a()
+    ref = optimized(s2a).generate(stoks, speaker, seed=3, show_progress_bar=False)
+    export_s2a(s2a, tmp_path)
+    out = ORTS2A(tmp_path).generate(stoks.numpy(), speaker.numpy(), seed=3)
+    assert torch.equal(torch.as_tensor(out), ref)
+
+def test_export_leaves_the_model_alone(tmp_path):
+    t2s, s2a = tiny_t2s().half(), tiny_s2a().half()
+    export_t2s(t2s, tmp_path/"t2s")
+    export_s2a(s2a, tmp_path/"s2a")
+    for model in (t2s, s2a):
+        assert not model.converted_for_eval
+        assert next(model.parameters()).dtype == torch.float16
@@ -0,0 +1,36 @@
+import torch
+
+from conftest import optimized
+
+TEXT = "Hello world, this is a test."
+
+def test_t2s_paged_matches_dense(t2s):
+    ref = optimized(t2s, 2).generate(TEXT, bs=2, seed=3, show_progress_bar=False)
+    out = optimized(t2s, 2, kv_block_size=8).generate(TEXT, bs=2, seed=3, show_progress_bar=False)
+    assert torch.equal(out, ref)
+
+def test_s2a_paged_matches_dense(s2a, stoks, speaker):
+    ref = optimized(s2a, 2).generate(stoks, speaker, bs=2, seed=3, show_progress_bar=False)
+    out = optimized(s2a, 2, kv_block_size=8).generate(stoks, speaker, bs=2, seed=3, show_progress_bar=False)
+    assert torch.equal(out, ref)
+
+def test_paged_kv_cache_grows_with_the_sequence(t2s):
+    t2s = optimized(t2s, 1, kv_block_size=8)
+    allocator = t2s.decoder.kv_allocator
+    used = []
+    t2s.generate(TEXT, N=40, seed=3, step=lambda: used.append(allocator.n_blocks), show_progress_bar=False)
+    assert used[0] == 1 and max(used) <= 40 // 8
+    assert len(allocator.free_blocks) == allocator.num_blocks - 1
+
+def test_paged_kv_only_gathers_the_blocks_of_the_batch(t2s):
+    t2s = optimized(t2s, 2, kv_block_size=8)
+    decoder = t2s.decoder
+    decoder.reserve_kv_cache([8, 40])
+    attn = decoder.layers[0].attn
+    # the longer second row does not make the first one read more blocks
+    assert attn.paged_kv(1)[0].shape[2] == 8
+    assert attn.paged_kv(2)[0].shape[2] == 40
+    decoder.set_kv_len(16)
+    assert attn.paged_kv(2)[0].shape[2] == 16
+    decoder.set_kv_len(None)
+    decoder.free_kv_cache([0, 1])
@@ -0,0 +1,54 @@
+import threading
+import time
+import pytest
+import torch
+
+from conftest import tiny_pipeline
+from whisperspeech.pipeline import run_stages
+
+@pytest.fixture
+def stage_threads():
+    # the threads started since the beginning of the test that are still running
+    before = set(threading.enumerate())
+    return lambda: set(threading.enumerate()) - before
+
+def test_run_stages_order(stage_threads):
+    assert list(run_stages(range(10), [lambda x: x + 1, lambda x: x * 2])) == [2 * (x + 1) for x in range(10)]
+    assert not stage_threads()
+
+def test_run_stages_propagates_errors(stage_threads):
+    def fail(x):
+        if x == 3: raise KeyError(x)
+        return x
+    out = []
+    with pytest.raises(KeyError):
+        for x in run_stages(range(10), [lambda x: x, fail, lambda x: x]): out.append(x)
+    # the items before the failure still come out, the later ones never do
+    assert out == [0, 1, 2]
+    assert not stage_threads()
+
+def test_run_stages_close_stops_the_threads(stage_threads):
+    started = []
+    def slow(x):
+        started.append(x)
+        time.sleep(0.01)
+        return x
+    gen = run_stages(range(100), [slow, slow], queue_size=1)
+    assert next(gen) == 0
+    gen.close()
+    n = len(started)
+    assert not stage_threads()
+    # the stages neither block on the full queues nor go on working after the consumer went away
+    time.sleep(0.05)
+    assert len(started) == n < 200
+
+class FakeVocoder:
+    def decode(self, atoks): return torch.zeros(1, atoks.shape[-1] * 320)
+
+def test_pipelined_skips_empty_segments():
+    pipe = tiny_pipeline(vocoder=FakeVocoder())
+    # T2S stops right away on the middle segment
+    lengths = {"One.": 10, "Two.": 0, "Three.": 12}
+    pipe.t2s.generate = lambda txt, **kwargs: torch.randint(0, 32, (1, lengths[txt]))
+    audio = list(pipe.generate_pipelined("One. Two. Three.", max_chars=6, prompt_seconds=0.2, crossfade=0))
+    assert sum(x.shape[-1] for x in audio) == 320 * (3 * 10 - 4 + 3 * 12 - 4)
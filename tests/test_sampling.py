@@ -0,0 +1,58 @@
+import math
+
+import torch
+
+from conftest import optimized
+from whisperspeech import inference
+
+TEXT = "Hello world, this is a test."
+
+# seeded sampling has to be reproducible and independent of the global RNG and of the rest of the batch
+
+def test_gumbel_noise_is_deterministic():
+    idxs = torch.arange(8).expand(3, 4, 8)
+    seeds, steps = torch.tensor([1, 2, 3]), torch.tensor([5, 5, 6])
+    noise = inference.gumbel_noise(seeds, steps, idxs)
+    assert torch.equal(noise, inference.gumbel_noise(seeds, steps, idxs))
+    # a row only depends on its own seed and step
+    assert torch.equal(noise[1:2], inference.gumbel_noise(seeds[1:2], steps[1:2], idxs[1:2]))
+    # but differs between seeds, steps, quantizers and token ids
+    assert not torch.equal(noise[0], noise[1])
+    assert not torch.equal(noise[1], inference.gumbel_noise(seeds[1:2], steps[1:2]+1, idxs[1:2])[0])
+    assert not torch.equal(noise[0,0], noise[0,1])
+    assert len(noise[0,0].unique()) == 8
+
+def test_gumbel_noise_distribution():
+    n = 200000
+    noise = inference.gumbel_noise(torch.arange(n), torch.zeros(n, dtype=torch.long), torch.zeros(n, 1, dtype=torch.long))
+    # the standard Gumbel distribution has the Euler–Mascheroni constant as its mean and a variance of pi^2/6
+    assert abs(noise.mean().item() - 0.5772) < 0.01
+    assert abs(noise.var().item() - math.pi**2 / 6) < 0.03
+
+def test_seeded_sample_distribution():
+    n = 100000
+    logits = torch.tensor([2., 1., 0.5, -1.]).expand(n, 4)
+    seeds, steps = torch.arange(n), torch.zeros(n, dtype=torch.long)
+    for T, top_k in [(1.0, None), (0.7, None), (1.0, 2)]:
+        toks = inference.sample(logits, T=T, top_k=top_k, seeds=seeds, steps=steps)[:,0]
+        expected = logits[0] / T
+        if top_k: expected = expected.masked_fill(expected < expected.topk(top_k).values[-1], -torch.inf)
+        freqs = torch.bincount(toks.long(), minlength=4).float() / n
+        assert (freqs - expected.softmax(-1)).abs().max() < 0.01
+
+def test_t2s_seeded_determinism(t2s):
+    model = optimized(t2s, 2)
+    ref = model.generate(TEXT, bs=2, seed=5, show_progress_bar=False)
+    torch.manual_seed(123) # the global RNG state does not matter
+    assert torch.equal(model.generate(TEXT, bs=2, seed=5, show_progress_bar=False), ref)
+    # row `j` uses the seed `seed+j`
+    row = optimized(t2s, 1).generate(TEXT, seed=6, show_progress_bar=False)
+    assert torch.equal(row[0], ref[1])
+
+def test_s2a_seeded_determinism(s2a, stoks, speaker):
+    model = optimized(s2a, 2)
+    ref = model.generate(stoks, speaker, bs=2, seed=5, show_progress_bar=False)
+    torch.manual_seed(123)
+    assert torch.equal(model.generate(stoks, speaker, bs=2, seed=5, show_progress_bar=False), ref)
+    row = optimized(s2a, 1).generate(stoks, speaker, seed=6, show_progress_bar=False)
+    assert torch.equal(row[0], ref[1])
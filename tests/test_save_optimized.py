@@ -0,0 +1,37 @@
+import pytest
+import torch
+
+from whisperspeech import inference
+from whisperspeech.t2s_up_wds_mlang_enclm import TSARTransformer
+from whisperspeech.s2a_delar_mup_wds_mlang import SADelARTransformer
+from conftest import optimized, tiny_vocoder
+from whisperspeech.a2wav import Vocoder
+
+@pytest.mark.parametrize("ext", ["model", "safetensors"])
+def test_t2s_save_optimized(t2s, tmp_path, ext):
+    fname = tmp_path/f"t2s.{ext}"
+    t2s.save_optimized(fname, dtype=torch.float32)
+    spec = inference.load_spec(fname)
+    assert spec['inference_dtype'] == 'float32'
+    assert not [k for k in spec['state_dict'] if k.endswith(('.query.weight', '.key.weight', '.value.weight'))]
+    ref = optimized(t2s).generate("Hello world.", seed=3, show_progress_bar=False)
+    loaded = optimized(TSARTransformer.load_model(str(fname), device='cpu'))
+    assert torch.equal(loaded.generate("Hello world.", seed=3, show_progress_bar=False), ref)
+
+@pytest.mark.parametrize("ext", ["model", "safetensors"])
+def test_s2a_save_optimized(s2a, stoks, speaker, tmp_path, ext):
+    fname = tmp_path/f"s2a.{ext}"
+    s2a.save_optimized(fname, dtype=torch.float32)
+    ref = optimized(s2a).generate(stoks, speaker, seed=3, show_progress_bar=False)
+    loaded = optimized(SADelARTransformer.load_model(str(fname), device='cpu'))
+    assert torch.equal(loaded.generate(stoks, speaker, seed=3, show_progress_bar=False), ref)
+
+@pytest.mark.parametrize("ext", ["model", "safetensors"])
+def test_vocoder_save_optimized(tmp_path, ext):
+    vocoder = tiny_vocoder()
+    fname = tmp_path/f"vocoder.{ext}"
+    vocoder.save_optimized(fname)
+    assert inference.load_spec(fname)['config'] == vocoder.config
+    atoks = torch.randint(0, 1024, (2, 30))
+    loaded = Vocoder(str(fname), device='cpu')
+    assert torch.equal(loaded.decode(atoks), vocoder.decode(atoks))
@@ -0,0 +1,27 @@
+import pytest
+import torch
+
+from conftest import optimized
+from whisperspeech.modules import MultiHeadAttention
+
+@pytest.mark.parametrize("rope", [False, True])
+def test_window_matches_banded_dense_attention(rope):
+    # decoding step by step through the ring buffer gives the dense attention restricted to the last `window` positions
+    torch.manual_seed(0)
+    n, window = 30, 8
+    attn = MultiHeadAttention(32, 2, rope=rope).eval()
+    x = torch.randn(1, n, 32)
+    positions = torch.arange(n)
+    dist = positions[:,None] - positions[None,:]
+    band = torch.zeros(n, n).masked_fill(~((dist >= 0) & (dist < window)), -torch.inf)
+    with torch.no_grad():
+        ref = attn(x, positions, x, positions, mask=band)
+        attn.setup_kv_cache(1, n, window=window, window_slack=4)
+        out = torch.cat([attn(x[:,i:i+1], positions[i:i+1], x[:,i:i+1], positions[i:i+1]) for i in range(n)], dim=1)
+    assert torch.allclose(out, ref, atol=1e-5)
+
+def test_s2a_window_matches_dense_within_the_context(s2a, stoks, speaker):
+    # nothing slides out of a window longer than the whole generation (24 semantic tokens, 72 acoustic frames)
+    ref = optimized(s2a).generate(stoks, speaker, seed=3, show_progress_bar=False)
+    out = optimized(s2a, window=100).generate(stoks, speaker, seed=3, show_progress_bar=False)
+    assert torch.equal(out, ref)
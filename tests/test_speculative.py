@@ -0,0 +1,38 @@
+import pytest
+import torch
+
+from conftest import tiny_t2s, optimized
+from whisperspeech.t2s_up_wds_mlang_enclm import TSARTransformer
+
+def test_speculative_rejects_seed():
+    t2s, draft = optimized(tiny_t2s()), optimized(tiny_t2s())
+    with pytest.raises(ValueError):
+        t2s.generate("Hello", draft=draft, seed=1, show_progress_bar=False)
+
+def test_speculative_checks_draft_context():
+    t2s = optimized(tiny_t2s())
+    draft = optimized(TSARTransformer(depth=1, n_head=2, head_width=16, ttoks_len=64, stoks_len=40, stoks_codes=33).eval())
+    with pytest.raises(AssertionError):
+        t2s.generate("Hello", draft=draft, show_progress_bar=False)
+    # a short enough N is fine
+    assert t2s.generate("Hello", draft=draft, N=40, show_progress_bar=False).shape[-1] < 40
+
+TEXT = "Hello world, this is a test."
+
+def test_speculative_matches_greedy_generate():
+    # with top_k=1 the target model distribution is one-hot, so whatever the draft proposes the result has to be
+    # the plain greedy output
+    t2s = optimized(tiny_t2s())
+    ref = t2s.generate(TEXT, top_k=1, show_progress_bar=False)
+    torch.manual_seed(1)
+    other = optimized(TSARTransformer(depth=1, n_head=2, head_width=16, ttoks_len=64, stoks_len=80, stoks_codes=33).eval())
+    for draft in (optimized(tiny_t2s()), other):
+        assert torch.equal(t2s.generate(TEXT, top_k=1, draft=draft, show_progress_bar=False), ref)
+
+def test_speculative_accepts_identical_draft():
+    # a draft with the same weights proposes tokens from the target distribution, so all of them are accepted
+    # and every verification step advances by `draft_k+1` tokens
+    t2s, draft = optimized(tiny_t2s()), optimized(tiny_t2s())
+    steps = []
+    out = t2s.generate(TEXT, draft=draft, draft_k=4, step=lambda: steps.append(1), show_progress_bar=False)
+    assert len(steps) <= -(-out.shape[-1] // 5)
@@ -0,0 +1,64 @@
+import os
+import torch
+
+from whisperspeech import pipeline
+from whisperspeech.pipeline import file_hash
+from conftest import tiny_pipeline
+
+def counting_pipeline(monkeypatch, **kwargs):
+    # a pipeline with a fake speaker embedding model that counts the extractions and the file hashes
+    pipe = tiny_pipeline(**kwargs)
+    calls = dict(extract=0, hash=0)
+    def extract(fname, seconds=30):
+        calls['extract'] += 1
+        return torch.tensor([float(len(open(fname, 'rb').read())), float(seconds)])
+    def counting_hash(fname):
+        calls['hash'] += 1
+        return file_hash(fname)
+    pipe._extract_spk_emb = extract
+    monkeypatch.setattr(pipeline, 'file_hash', counting_hash)
+    return pipe, calls
+
+def test_spk_cache_in_memory(tmp_path, monkeypatch):
+    fname = tmp_path/"voice.wav"
+    fname.write_bytes(b"abc")
+    pipe, calls = counting_pipeline(monkeypatch)
+    emb = pipe.extract_spk_emb(fname)
+    assert torch.equal(pipe.extract_spk_emb(fname), emb)
+    assert calls == dict(extract=1, hash=0)
+    # a modified file is extracted again
+    fname.write_bytes(b"abcd")
+    os.utime(fname, ns=(0, 10**9))
+    assert pipe.extract_spk_emb(fname)[0] == 4
+    assert pipe.extract_spk_emb(fname, seconds=10)[1] == 10
+    assert calls['extract'] == 3
+
+def test_spk_cache_on_disk(tmp_path, monkeypatch):
+    fname = tmp_path/"voice.wav"
+    fname.write_bytes(b"abc")
+    pipe, calls = counting_pipeline(monkeypatch, spk_cache_dir=tmp_path/"cache")
+    emb = pipe.extract_spk_emb(fname)
+    pipe.extract_spk_emb(fname)
+    # the content hash is only computed on an in-memory miss
+    assert calls == dict(extract=1, hash=1)
+    # a new process finds the embedding on disk, also under a different path
+    pipe, calls = counting_pipeline(monkeypatch, spk_cache_dir=tmp_path/"cache")
+    copy = tmp_path/"copy.wav"
+    copy.write_bytes(b"abc")
+    assert torch.equal(pipe.extract_spk_emb(copy), emb)
+    assert calls == dict(extract=0, hash=1)
+
+def test_voice_library(tmp_path, monkeypatch):
+    voices = {}
+    for name, data in [("alice", b"a"), ("bob", b"bb")]:
+        voices[name] = tmp_path/f"{name}.wav"
+        voices[name].write_bytes(data)
+    pipe, calls = counting_pipeline(monkeypatch)
+    library = pipe.build_voice_library(tmp_path/"voices", voices)
+    assert len(library) == 2 and "bob" in library
+    # voices from the library are not extracted again
+    assert torch.equal(pipe.get_speaker("bob"), torch.tensor([2., 30.]))
+    assert calls['extract'] == 2
+    pipe, calls = counting_pipeline(monkeypatch, voices=pipeline.VoiceLibrary(tmp_path/"voices"))
+    assert torch.equal(pipe.get_speaker("alice"), torch.tensor([1., 30.]))
+    assert calls['extract'] == 0
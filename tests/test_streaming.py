@@ -0,0 +1,24 @@
+import pytest
+import torch
+
+from conftest import optimized, tiny_vocoder
+
+@pytest.mark.parametrize("chunk", [5, 16, 100])
+def test_s2a_generate_stream_matches_generate(s2a, stoks, speaker, chunk):
+    model = optimized(s2a)
+    ref = model.generate(stoks, speaker, seed=3, show_progress_bar=False)
+    chunks = list(model.generate_stream(stoks, speaker, chunk=chunk, seed=3))
+    assert all(x.shape[-1] == chunk for x in chunks[:-1]) and 0 < chunks[-1].shape[-1] <= chunk
+    assert torch.equal(torch.cat(chunks, dim=-1), ref)
+
+def test_decode_stream_matches_decode():
+    vocoder = tiny_vocoder()
+    atoks = torch.randint(0, 1024, (4, 100), generator=torch.Generator().manual_seed(0))
+    ref = vocoder.decode(atoks)
+    # a single chunk is decoded exactly like the whole sequence
+    assert torch.equal(torch.cat(list(vocoder.decode_stream([atoks])), dim=-1), ref)
+    # with more chunks only the crossfaded seams differ slightly
+    for chunk in (10, 25):
+        out = torch.cat(list(vocoder.decode_stream(atoks.split(chunk, dim=-1))), dim=-1)
+        assert out.shape == ref.shape
+        assert (out - ref).abs().max() < 0.05 * ref.abs().max()
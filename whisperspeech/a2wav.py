@@ -5,17 +5,75 @@ __all__ = ['Vocoder']
 
 # %% ../nbs/6. Quality-boosting vocoder.ipynb 1
 from vocos import Vocos
+from vocos.pretrained import instantiate_class
+from vocos.feature_extractors import EncodecFeatures
+from encodec import EncodecModel
 from whisperspeech import inference
 import torch
 import torchaudio
+import yaml
+from pathlib import Path
+from huggingface_hub import hf_hub_download
 
 # %% ../nbs/6. Quality-boosting vocoder.ipynb 2
+class _OfflineEncodecFeatures(EncodecFeatures):
+    # `EncodecFeatures` with a randomly initialized Encodec model instead of the downloaded pretrained
+    # checkpoint, the weights are loaded afterwards from the saved Vocos state dict
+    def __init__(self, encodec_model="encodec_24khz", bandwidths=[1.5, 3.0, 6.0, 12.0], train_codebooks=False):
+        super(EncodecFeatures, self).__init__()
+        encodec = {'encodec_24khz': EncodecModel.encodec_model_24khz,
+                   'encodec_48khz': EncodecModel.encodec_model_48khz}[encodec_model]
+        self.encodec = encodec(pretrained=False).requires_grad_(False)
+        self.num_q = self.encodec.quantizer.get_num_quantizers_for_bandwidth(self.encodec.frame_rate, bandwidth=max(bandwidths))
+        codebook_weights = torch.cat([vq.codebook for vq in self.encodec.quantizer.vq.layers[:self.num_q]], dim=0)
+        self.codebook_weights = torch.nn.Parameter(codebook_weights, requires_grad=train_codebooks)
+        self.bandwidths = bandwidths
+
 class Vocoder:
-    def __init__(self, repo_id="charactr/vocos-encodec-24khz", device=None):
+    def __init__(self, repo_id="charactr/vocos-encodec-24khz", device=None, quantize=False):
         if device is None: device = inference.get_compute_device()
         if device == 'mps': device = 'cpu' # mps does not currently work with vocos, thus only cuda or cpu
         self.device = device
-        self.vocos = Vocos.from_pretrained(repo_id).to(device)
+        self.repo_id = repo_id
+        self.quantized = quantize
+        if Path(repo_id).is_file():
+            # a model saved with `save_optimized`, no need to download anything
+            spec = inference.load_spec(repo_id, mmap=False)
+            self.config = spec['config']
+            self.vocos = self.build_vocos(spec['config'], spec['state_dict']).to(device)
+        else:
+            self.config = None
+            self.vocos = Vocos.from_pretrained(repo_id).to(device)
+        if quantize:
+            assert torch.device(device).type == 'cpu', "int8 dynamic quantization is only supported on the CPU"
+            inference.quantize_linears(self.vocos)
+
+    @staticmethod
+    def build_vocos(config, state_dict):
+        # `Vocos.from_hparams` but the Encodec feature extractor gets its weights from `state_dict` instead of
+        # downloading the pretrained Encodec checkpoint
+        init = config["feature_extractor"]
+        if init["class_path"].split('.')[-1] == 'EncodecFeatures':
+            feature_extractor = _OfflineEncodecFeatures(**init.get("init_args", {}))
+        else:
+            feature_extractor = instantiate_class(args=(), init=init)
+        vocos = Vocos(feature_extractor=feature_extractor,
+                      backbone=instantiate_class(args=(), init=config["backbone"]),
+                      head=instantiate_class(args=(), init=config["head"]))
+        vocos.load_state_dict(state_dict)
+        return vocos.eval()
+
+    def save_optimized(self, fname):
+        """Saves the Vocos config and weights so the model can be loaded without network access by passing
+        `fname` as the `repo_id`.
+
+        Like the T2S and S2A models it uses `.safetensors` or a torch pickle depending on the extension. The
+        weights are stored in float32, the dtype the vocoder runs in."""
+        assert not self.quantized, "please save the vocoder before quantizing it (and pass `quantize=True` when loading it)"
+        if self.config is None:
+            with open(hf_hub_download(repo_id=self.repo_id, filename="config.yaml")) as f: self.config = yaml.safe_load(f)
+        state_dict = {k:v.float() if v.is_floating_point() else v for k,v in self.vocos.state_dict().items()}
+        inference.save_spec(dict(config=self.config, inference_dtype='float32', state_dict=state_dict), fname)
 
     def is_notebook(self):
         try:
@@ -37,6 +95,28 @@ class Vocoder:
         features = self.vocos.codes_to_features(atoks)
         bandwidth_id = torch.tensor({2: 0, 4: 1, 8: 2}[q]).to(self.device)  # Move tensor to the same device as model
         return self.vocos.decode(features, bandwidth_id=bandwidth_id)
+
+    @torch.no_grad()
+    def decode_stream(self, atoks_chunks, context=8):
+        """Decodes consecutive chunks of acoustic tokens, yielding audio as soon as each chunk arrives.
+
+        Every chunk is decoded together with the last `context` frames of the previous one and the
+        overlapping audio is crossfaded with the tail we held back in the previous step."""
+        prev, tail = None, None
+        for atoks in atoks_chunks:
+            atoks = atoks.to(self.device)
+            if prev is not None: atoks = torch.cat([prev, atoks], dim=-1)
+            audio = self.decode(atoks)
+            if tail is not None:
+                ov = tail.shape[-1]
+                fade = torch.linspace(0, 1, ov, device=audio.device)
+                audio = torch.cat([tail * (1 - fade) + audio[...,:ov] * fade, audio[...,ov:]], dim=-1)
+            # hold back the audio of the last `context` frames, the next chunk will decode them again
+            prev = atoks[...,max(atoks.shape[-1] - context, 0):]
+            keep = audio.shape[-1] * prev.shape[-1] // atoks.shape[-1]
+            tail = audio[...,audio.shape[-1] - keep:]
+            yield audio[...,:audio.shape[-1] - keep]
+        if tail is not None: yield tail
         
     def decode_to_file(self, fname, atoks):
         audio = self.decode(atoks)
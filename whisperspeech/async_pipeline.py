@@ -0,0 +1,142 @@
+# AUTOGENERATED! DO NOT EDIT! File to edit: ../nbs/7B. Async pipeline.ipynb.
+
+# %% auto 0
+__all__ = ['AsyncPipeline']
+
+# %% ../nbs/7B. Async pipeline.ipynb 2
+import asyncio
+import threading
+import concurrent.futures
+from concurrent.futures import ThreadPoolExecutor
+
+from whisperspeech.batching import BatchingServer
+
+# %% ../nbs/7B. Async pipeline.ipynb 3
+class _Cancelled(Exception):
+    pass
+
+class AsyncPipeline:
+    """`asyncio` versions of the `Pipeline` generation methods for async servers.
+
+    The models run in a single worker thread (they share their KV caches, so one generation runs at a time)
+    and the event loop stays free while they decode. At most `max_pending` requests are queued for the worker
+    (or the batching server), any further callers wait before their request is even submitted.
+
+    Cancelling a task that awaits one of the methods (e.g. when the client disconnects) stops the generation
+    at the next decode step through the `step_callback` hook (the request keeps its slot until then). With `batching=True` the requests are served by
+    a `BatchingServer` instead (the models have to be optimized with `max_batch_size` > 1) and a cancelled
+    request frees its batch row at the next step. Streaming is not available with batching, since the batching
+    server thread owns the KV caches of the models."""
+    def __init__(self, pipe, max_pending=16, batching=False, **batching_kwargs):
+        self.pipe = pipe
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="whisperspeech")
+        self.max_pending = max_pending
+        self.slots = None
+        self.server = BatchingServer(pipe, **batching_kwargs).start() if batching else None
+
+    def _slots(self):
+        # created lazily because it has to belong to the running event loop
+        if self.slots is None: self.slots = asyncio.Semaphore(self.max_pending)
+        return self.slots
+
+    async def _finish(self, fut, cancel=None):
+        # waits for an executor future, if we get cancelled we still keep our slot until the worker thread is done
+        # with the request (with `cancel` set it stops at its next decode step)
+        try:
+            return await asyncio.shield(fut)
+        except asyncio.CancelledError:
+            if cancel is not None: cancel.set()
+            await asyncio.wait([fut])
+            raise
+
+    async def _run(self, fun, *args, **kwargs):
+        # runs `fun` in the worker thread, if we get cancelled it raises `_Cancelled` from its next decode step
+        cancel = threading.Event()
+        def step_callback():
+            if cancel.is_set(): raise _Cancelled()
+        def run():
+            try:
+                return fun(*args, step_callback=step_callback, **kwargs)
+            except _Cancelled:
+                pass # nobody is waiting for the result anymore
+        fut = asyncio.get_running_loop().run_in_executor(self.executor, run)
+        return await self._finish(fut, cancel)
+
+    async def _submit(self, text, speaker, lang, cps, seed):
+        fut = self.server.submit(text, speaker, lang=lang, cps=cps, seed=seed)
+        try:
+            return await asyncio.wrap_future(fut)
+        except asyncio.CancelledError:
+            fut.cancel()
+            raise
+
+    async def generate_atoks(self, text, speaker=None, lang='en', cps=15, seed=None):
+        """Returns the acoustic tokens for `text` (`seed` is only used with `batching=True`)."""
+        async with self._slots():
+            if self.server is None:
+                return await self._run(self.pipe.generate_atoks, text, speaker, lang=lang, cps=cps)
+            return await self._submit(text, speaker, lang, cps, seed)
+
+    async def generate(self, text, speaker=None, lang='en', cps=15, seed=None):
+        """Returns the 24kHz audio for `text`."""
+        async with self._slots():
+            if self.server is None:
+                return await self._run(self.pipe.generate, text, speaker, lang=lang, cps=cps)
+            atoks = await self._submit(text, speaker, lang, cps, seed)
+            return await self._finish(asyncio.get_running_loop().run_in_executor(self.executor, self.pipe.vocoder.decode, atoks))
+
+    async def generate_stream(self, text, speaker=None, lang='en', cps=15, chunk=25, context=8, queue_size=4):
+        """Yields 24kHz audio chunks like `Pipeline.generate_stream`.
+
+        The chunks go through a queue of at most `queue_size` entries: if the consumer falls behind the
+        generation pauses until it catches up. Closing the generator (or cancelling the task iterating it)
+        stops the generation at the next decode step."""
+        if self.server is not None:
+            # the stream would decode in the worker thread while the batching server uses the same KV cache rows
+            raise ValueError("generate_stream is not supported with `batching=True`, please use `generate` instead")
+        loop = asyncio.get_running_loop()
+        chunks = asyncio.Queue(maxsize=queue_size)
+        cancel = threading.Event()
+        done = object()
+
+        def put(x):
+            # blocks the worker while the queue is full, but not after the consumer went away
+            fut = asyncio.run_coroutine_threadsafe(chunks.put(x), loop)
+            while True:
+                try:
+                    return fut.result(timeout=0.1)
+                except concurrent.futures.TimeoutError:
+                    if cancel.is_set():
+                        fut.cancel()
+                        raise _Cancelled()
+
+        def step_callback():
+            if cancel.is_set(): raise _Cancelled()
+
+        def produce():
+            try:
+                for x in self.pipe.generate_stream(text, speaker, lang=lang, cps=cps, chunk=chunk, context=context,
+                                                   step_callback=step_callback):
+                    put(x)
+                put(done)
+            except _Cancelled:
+                pass
+            except Exception as e:
+                if not cancel.is_set(): put(e)
+
+        async with self._slots():
+            worker = loop.run_in_executor(self.executor, produce)
+            try:
+                while True:
+                    x = await chunks.get()
+                    if x is done: break
+                    if isinstance(x, Exception): raise x
+                    yield x
+            finally:
+                # also when the consumer closed us early, the slot is only free once the worker stopped
+                cancel.set()
+                await asyncio.wait([worker])
+
+    def close(self):
+        if self.server is not None: self.server.stop()
+        self.executor.shutdown(wait=False, cancel_futures=True)
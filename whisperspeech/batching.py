@@ -0,0 +1,371 @@
+# AUTOGENERATED! DO NOT EDIT! File to edit: ../nbs/E. Continuous batching.ipynb.
+
+# %% auto 0
+__all__ = ['T2SBatcher', 'S2ABatcher', 'BatchingServer']
+
+# %% ../nbs/E. Continuous batching.ipynb 2
+import queue
+import threading
+from concurrent.futures import Future, CancelledError
+
+import torch
+import torch.nn.functional as F
+from fastprogress import progress_bar
+
+from whisperspeech import inference, languages
+
+# %% ../nbs/E. Continuous batching.ipynb 3
+class ContinuousBatcher:
+    """Decodes a pool of unrelated sequences together in the preallocated KV cache rows of `model`.
+
+    New requests are admitted into free rows between decode steps and finished sequences are retired
+    and compacted out, so the active ones always occupy the first `len(self.active)` rows."""
+    def __init__(self, model, max_batch_size=None, T=0.7, top_k=None):
+        attn = model.decoder.layers[0].attn
+        assert attn.k_cache is not None, "please call `optimize(max_batch_size=...)` on the model first"
+        cache_rows = attn.allocator.max_batch_size if attn.allocator else attn.k_cache.shape[0]
+        self.model = model
+        self.max_batch_size = max_batch_size or cache_rows
+        assert self.max_batch_size <= cache_rows, "please pass in a larger max_batch_size to optimize"
+        self.device = model.device
+        self.T = torch.tensor(T, device=self.device)
+        self.top_k = top_k
+        self.pending = queue.Queue()
+        self.active = [] # futures of the sequences in the consecutive cache rows
+        self.lengths = [] # number of positions in the KV cache of each active row (kept on the host for paging)
+        self.positions = torch.zeros(self.max_batch_size, dtype=torch.long, device=self.device)
+        self.seeds = torch.zeros(self.max_batch_size, dtype=torch.long, device=self.device)
+        self.cancelled = set() # futures of active rows to drop before the next decode step
+        self.cancel_lock = threading.Lock()
+
+    def _submit(self, request, seed=None):
+        # every request gets its own sampling seed so its tokens do not depend on the rest of the batch
+        if seed is None: seed = torch.randint(2**31, ()).item()
+        fut = Future()
+        self.pending.put((fut, (request, seed)))
+        return fut
+
+    def admit(self):
+        new = []
+        while len(self.active) + len(new) < self.max_batch_size:
+            try:
+                fut, request = self.pending.get_nowait()
+            except queue.Empty:
+                break
+            if fut.set_running_or_notify_cancel(): new.append((fut, request))
+        if not new: return
+        row = len(self.active)
+        try:
+            self.start(row, [request for _,(request,_) in new])
+        except Exception:
+            # start them one by one so a bad request only fails itself and not the others admitted with it
+            started = []
+            for fut, request in new:
+                try:
+                    self.start(row + len(started), [request[0]])
+                except Exception as e:
+                    fut.set_exception(e)
+                else:
+                    started.append((fut, request))
+            new = started
+            if not new: return
+        self.seeds[row:row + len(new)] = torch.tensor([seed for _,(_,seed) in new], device=self.device)
+        self.active += [fut for fut,_ in new]
+        self.lengths += [0] * len(new)
+
+    def cancel(self, fut):
+        """Cancels a request (can be called from any thread). Pending requests are never admitted and active ones
+        are dropped before the next decode step, which frees their cache rows for new requests.
+
+        Returns `False` if the request already finished."""
+        if fut.cancel(): return True
+        with self.cancel_lock:
+            if fut.done(): return False
+            self.cancelled.add(fut)
+        return True
+
+    def drop_cancelled(self):
+        with self.cancel_lock:
+            cancelled, self.cancelled = self.cancelled, set()
+        self.retire({i:CancelledError() for i,fut in enumerate(self.active) if fut in cancelled})
+
+    def retire(self, finished):
+        if not finished: return
+        keep = [i for i in range(len(self.active)) if i not in finished]
+        self.model.decoder.free_kv_cache(finished.keys())
+        if keep != list(range(len(keep))):
+            rows = torch.tensor(keep, device=self.device)
+            self.model.decoder.reorder_kv_cache(rows)
+            self.reorder(rows)
+        for row, result in finished.items():
+            if isinstance(result, CancelledError): self.active[row].set_exception(result)
+            else: self.active[row].set_result(result)
+        self.active = [self.active[i] for i in keep]
+        self.lengths = [self.lengths[i] for i in keep]
+
+    def fail(self, exc):
+        for fut in self.active: fut.set_exception(exc)
+        self.model.decoder.free_kv_cache(range(len(self.active)))
+        self.active = []
+        self.lengths = []
+
+    @property
+    def idle(self):
+        return not self.active and self.pending.empty()
+
+    @torch.no_grad()
+    def step(self):
+        """Admits pending requests, runs one decode step for all active sequences and retires the finished ones.
+
+        Returns `False` if there was nothing to do."""
+        if self.cancelled: self.drop_cancelled()
+        self.admit()
+        if not self.active: return False
+        self.lengths = [l + 1 for l in self.lengths]
+        decoder = self.model.decoder
+        decoder.reserve_kv_cache(self.lengths)
+        decoder.set_kv_len(max(self.lengths))
+        try:
+            with inference.inference_context():
+                self.retire(self.decode(len(self.active)))
+        finally:
+            decoder.set_kv_len(None)
+        return True
+
+    def padded(self, n):
+        # with `batch_buckets` we run the model on one of a few fixed batch sizes so the compiled graphs
+        # are reused, the extra rows are free cache rows and their outputs are dropped
+        buckets = self.model.batch_buckets
+        return min(buckets(n), self.max_batch_size) if buckets else n
+
+    @torch.no_grad()
+    def warmup(self):
+        """Runs a decode step with every batch and KV length bucket size so all the graphs are compiled before serving."""
+        assert not self.active, "warmup only works with an idle batcher"
+        buckets, decoder = self.model.batch_buckets, self.model.decoder
+        lengths = decoder.kv_len_buckets.sizes if decoder.kv_len_buckets else [None]
+        try:
+            with inference.inference_context():
+                for n in sorted({min(x, self.max_batch_size) for x in (buckets.sizes if buckets else [1])}):
+                    for length in lengths:
+                        decoder.set_kv_len(length)
+                        self.sample(self.padded(n))
+        finally:
+            decoder.set_kv_len(None)
+
+    def run_until_done(self, futs, show_progress_bar=True):
+        """Runs decode steps until all requests in `futs` are finished and returns their results."""
+        done = 0
+        if show_progress_bar:
+            pb = progress_bar(range(len(futs)))
+            pb.update(done)
+        while not all(f.done() for f in futs):
+            self.step()
+            if show_progress_bar and sum(f.done() for f in futs) != done:
+                done = sum(f.done() for f in futs)
+                pb.update(done)
+        return [f.result() for f in futs]
+
+    def reorder(self, rows):
+        self.positions[:len(rows)] = self.positions[rows]
+        self.seeds[:len(rows)] = self.seeds[rows]
+
+# %% ../nbs/E. Continuous batching.ipynb 4
+class T2SBatcher(ContinuousBatcher):
+    def __init__(self, model, max_batch_size=None, T=0.7, top_k=None, N=None):
+        super().__init__(model, max_batch_size, T, top_k)
+        # the maximum number of positions (with the SOT), like in `generate`, but never past the end of `toks`
+        self.N = min(N or model.stoks_len, model.stoks_len)
+        model.ensure_tokenizer()
+        self.eot = model.stoks_codes + model.tunables.padding_token_offset
+        self.toks = torch.zeros((self.max_batch_size, model.stoks_len), dtype=torch.long, device=self.device)
+        self.cps_embs = torch.zeros((self.max_batch_size, 1, model.width), dtype=model.dtype, device=self.device)
+
+    def submit(self, txt, lang='en', cps=15, seed=None):
+        """Returns a `Future` resolving to the semantic tokens for `txt`.
+
+        With an integer `seed` the result is the same as `generate(txt, seed=seed)`."""
+        return self._submit((txt, lang, cps), seed)
+
+    def start(self, row, requests):
+        m, dev = self.model, self.device
+        ttoks = []
+        for txt,_,_ in requests:
+            tt = torch.tensor(m.tokenizer.encode(txt), device=dev)
+            ttoks.append(F.pad(tt, (1, m.ttoks_len - len(tt) - 1), value=m.tokenizer.eot))
+        langs = torch.tensor([languages.to_id(lang) for _,lang,_ in requests], device=dev)
+        cpss = torch.tensor([cps for _,_,cps in requests], device=dev)
+        rows = slice(row, row + len(requests))
+        _, _, cps_emb = m.encode_to_kv_cache(torch.stack(ttoks), langs, cpss, rows)
+        self.cps_embs[rows] = cps_emb
+        self.toks[rows] = 0
+        self.toks[rows,0] = self.eot
+        self.positions[rows] = 0
+
+    def sample(self, n):
+        # samples the next tokens for the first `n` rows without updating their state
+        positions = self.positions[:n]
+        return self.model.generate_next(self.toks[torch.arange(n, device=self.device),positions].unsqueeze(1),
+                                        positions.unsqueeze(1), self.cps_embs[:n], None, None, self.T, self.top_k,
+                                        seeds=self.seeds[:n])
+
+    def decode(self, n):
+        toks = self.sample(self.padded(n))[:n,0].to(torch.long)
+        rows = torch.arange(n, device=self.device)
+        positions = self.positions[:n]
+        positions += 1
+        self.toks[rows,positions] = toks
+        eot = toks == self.eot
+        done = eot | (positions == self.N - 1)
+        return {i:self.toks[i,1:p+1-e].clone()
+                for i,p,e in zip(done.nonzero()[:,0].tolist(), positions[done].tolist(), eot[done].tolist())}
+
+    def reorder(self, rows):
+        super().reorder(rows)
+        self.toks[:len(rows)] = self.toks[rows]
+        self.cps_embs[:len(rows)] = self.cps_embs[rows]
+
+# %% ../nbs/E. Continuous batching.ipynb 5
+class S2ABatcher(ContinuousBatcher):
+    def __init__(self, model, max_batch_size=None, T=0.7, top_k=None):
+        super().__init__(model, max_batch_size, T, top_k)
+        q = model.quantizers
+        self.toks = torch.full((self.max_batch_size, q, model.ctx_n), model.codes+1, dtype=torch.long, device=self.device)
+        self.ends = torch.zeros(self.max_batch_size, dtype=torch.long, device=self.device)
+        self.prompt_lens = torch.zeros(self.max_batch_size, dtype=torch.long, device=self.device)
+        self.quantizer_ids = torch.arange(q, device=self.device)
+
+    def submit(self, stoks, speaker, atoks_prompt=None, seed=None):
+        """Returns a `Future` resolving to the acoustic tokens for `stoks` spoken by `speaker`.
+
+        Like in `generate`, `stoks` have to cover the `atoks_prompt` as well and the result includes it.
+        The prompt is consumed one frame per decode step so the row can share the batch with others.
+        With an integer `seed` the result is the same as `generate(..., seed=seed)`.
+
+        Sequences too short to fill a single frame of all the quantizers (e.g. when T2S stopped right away)
+        resolve immediately to empty acoustic tokens."""
+        q = self.model.quantizers
+        if len(stoks) * 3 <= q:
+            fut = Future()
+            fut.set_result(torch.zeros((1, q, 0), dtype=torch.long, device=self.device))
+            return fut
+        return self._submit((stoks, speaker, atoks_prompt), seed)
+
+    def start(self, row, requests):
+        m, dev = self.model, self.device
+        stoks = torch.stack([F.pad(stoks.to(dev), (1, m.stoks_len - len(stoks) - 1), value=m.stoks_codes-1)
+                             for stoks,_,_ in requests])
+        speakers = torch.stack([spk.to(device=dev, dtype=m.dtype) for _,spk,_ in requests])
+        rows = slice(row, row + len(requests))
+        m.encode_to_kv_cache(stoks, m.speaker_conds(speakers), rows)
+        self.toks[rows] = m.codes+1
+        self.positions[rows] = 0
+        self.prompt_lens[rows] = 0
+        for i,(_,_,prompt) in enumerate(requests):
+            if prompt is None: continue
+            prompt = prompt.reshape(m.quantizers, -1)
+            for j in range(m.quantizers):
+                self.toks[row+i,j,1+j:prompt.shape[-1]+j+1] = prompt[j]
+            self.prompt_lens[row+i] = prompt.shape[-1]
+        # index of the last column to sample, same as in `generate`
+        self.ends[rows] = torch.tensor([min(len(stoks) * 3, m.ctx_n-1) - 1 for stoks,_,_ in requests], device=dev)
+
+    def sample(self, n):
+        # samples the next tokens for the first `n` rows without updating their state
+        positions = self.positions[:n]
+        return self.model.generate_next(self.toks[torch.arange(n, device=self.device),:,positions].unsqueeze(-1),
+                                        positions.unsqueeze(1), None, None, None, self.T, self.top_k,
+                                        seeds=self.seeds[:n])
+
+    def decode(self, n):
+        m = self.model
+        toks = self.sample(self.padded(n))[:n,:,0].to(torch.long)
+        rows = torch.arange(n, device=self.device)
+        positions = self.positions[:n]
+        positions += 1
+        # the delay pattern: quantizer j starts in column j+1 (and we keep the prompt tokens)
+        started = self.quantizer_ids + self.prompt_lens[:n].unsqueeze(1) < positions.unsqueeze(1)
+        self.toks[rows,:,positions] = torch.where(started, toks, self.toks[rows,:,positions])
+        done = positions >= self.ends[:n]
+        return {i:m._undelay(self.toks[i:i+1], 0, p + 1 - m.quantizers).clone()
+                for i,p in zip(done.nonzero()[:,0].tolist(), positions[done].tolist())}
+
+    def reorder(self, rows):
+        super().reorder(rows)
+        self.toks[:len(rows)] = self.toks[rows]
+        self.ends[:len(rows)] = self.ends[rows]
+        self.prompt_lens[:len(rows)] = self.prompt_lens[rows]
+
+# %% ../nbs/E. Continuous batching.ipynb 6
+class BatchingServer:
+    """Serves concurrent requests by running continuous T2S and S2A batchers in a background thread.
+
+    The models of `pipe` have to be optimized with `max_batch_size` larger than 1, e.g.
+    `Pipeline(max_batch_size=16)`."""
+    def __init__(self, pipe, T=0.7, top_k=None):
+        self.pipe = pipe
+        self.t2s = T2SBatcher(pipe.t2s, T=T, top_k=top_k)
+        self.s2a = S2ABatcher(pipe.s2a, T=T, top_k=top_k)
+        self.wakeup = threading.Event()
+        self.thread = None
+
+    def submit(self, text, speaker=None, lang='en', cps=15, seed=None):
+        """Returns a `Future` resolving to the acoustic tokens (use `pipe.vocoder.decode` to get the audio).
+
+        With an integer `seed` the result does not depend on the other requests served at the same time.
+        Cancelling the `Future` drops the request from the batch at the next decode step."""
+        speaker = self.pipe.get_speaker(speaker)
+        result = Future()
+        current = [] # the batcher and the future of the stage the request is in
+        def resolve(fut):
+            if result.done() or fut.cancelled(): return
+            if fut.exception(): result.set_exception(fut.exception())
+            else: result.set_result(fut.result())
+        def run_s2a(stoks):
+            if result.done() or stoks.cancelled(): return
+            if stoks.exception(): return resolve(stoks)
+            atoks = self.s2a.submit(stoks.result(), speaker, seed=seed)
+            current[:] = [self.s2a, atoks]
+            atoks.add_done_callback(resolve)
+            if result.cancelled(): self.s2a.cancel(atoks)
+        def cancel(result):
+            if not result.cancelled(): return
+            batcher, fut = current
+            batcher.cancel(fut)
+            self.wakeup.set()
+        stoks = self.t2s.submit(text.replace("\n", " "), lang=lang, cps=cps, seed=seed)
+        current[:] = [self.t2s, stoks]
+        stoks.add_done_callback(run_s2a)
+        result.add_done_callback(cancel)
+        self.wakeup.set()
+        return result
+
+    def warmup(self):
+        """Compiles the decoding graphs of both batchers for all the batch buckets (call it before `start`)."""
+        self.t2s.warmup()
+        self.s2a.warmup()
+        return self
+
+    def run(self):
+        while self.running:
+            self.wakeup.clear()
+            busy = False
+            for batcher in (self.t2s, self.s2a):
+                try:
+                    busy = batcher.step() or busy
+                except Exception as e:
+                    # a failed decode step loses the state of the rows of this batcher, the other one is not affected
+                    batcher.fail(e)
+                    busy = True
+            if not busy: self.wakeup.wait()
+
+    def start(self):
+        self.running = True
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.running = False
+        self.wakeup.set()
+        self.thread.join()
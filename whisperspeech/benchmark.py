@@ -8,6 +8,7 @@ import time
 import torch
 from fastcore.script import call_parse
 from whisperspeech.pipeline import Pipeline
+from whisperspeech import inference
 from whisperspeech.inference import get_compute_device
 
 # %% ../nbs/C. Benchmark.ipynb 3
@@ -28,6 +29,7 @@ def benchmark(
     batch_size : int = 1,
     max_batch_size : int = None,
     no_torch_compile : bool = False,
+    compile_cache : str = None, # artifacts saved by `build_compile_cache`
     s2a_ctx_n : int = None,
     t2s_ctx_n : int = None,
     iterations = 10,
@@ -35,6 +37,7 @@ def benchmark(
     max_batch_size = max_batch_size or batch_size
 
     pipe = Pipeline(t2s_ref=t2s_ref, s2a_ref=s2a_ref, optimize=False)
+    if compile_cache and not no_torch_compile: inference.load_compile_cache(compile_cache)
 
     if t2s_ctx_n:
         pipe.t2s.stoks_len = t2s_ctx_n
@@ -58,8 +61,10 @@ def benchmark(
         return pipe.s2a.generate(stoks, pipe.default_speaker.unsqueeze(0), bs=batch_size, show_progress_bar=False)
 
     # warmup
+    start = time.time()
     t2s()
     s2a()
+    print(f"Warmup: {time.time() - start:.1f} s")
     
     t2s_mean, t2s_std = measure(t2s, iterations=iterations)
     s2a_mean, s2a_std = measure(s2a, iterations=iterations)
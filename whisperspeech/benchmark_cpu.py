@@ -0,0 +1,62 @@
+# AUTOGENERATED! DO NOT EDIT! File to edit: ../nbs/C. Benchmark CPU.ipynb.
+
+# %% auto 0
+__all__ = []
+
+# %% ../nbs/C. Benchmark CPU.ipynb 2
+import time
+import torch
+from fastcore.script import call_parse
+from whisperspeech.pipeline import Pipeline
+from whisperspeech import inference
+
+# %% ../nbs/C. Benchmark CPU.ipynb 3
+def measure(fun, iterations = 10):
+    ts = []
+    for x in range(iterations):
+        start = time.time()
+        fun()
+        ts.append(time.time() - start)
+    ts = torch.tensor(ts)
+    return ts.mean(), ts.std()
+
+profiles = {
+    'fp32': dict(dtype=torch.float32),
+    'bf16': dict(dtype=torch.bfloat16),
+    'int8': dict(quantize=True),
+}
+
+@call_parse
+def benchmark(
+    t2s_ref='collabora/whisperspeech:t2s-small-en+pl.model',
+    s2a_ref='collabora/whisperspeech:s2a-q4-tiny-en+pl.model',
+    profile : str = "fp32,bf16,int8", # comma separated list of profiles to compare
+    threads : int = None, # number of CPU threads (defaults to all cores)
+    iterations = 3,
+):
+    """Measures the real-time factor (seconds of audio per second of compute) of the CPU inference profiles."""
+    if threads: torch.set_num_threads(threads)
+    inference.preferred_device = 'cpu'
+    txt = "This is the first demo of Whisper Speech, a fully open source text-to-speech model trained by Collabora and Lion on the Juwels supercomputer."
+
+    print(f"profile\tT2S\tS2A\tvocoder\ttotal")
+    for name in profile.split(','):
+        kwargs = profiles[name]
+        if name == 'bf16' and not inference.cpu_supports_bf16():
+            print(f"{name}\tnot supported on this CPU")
+            continue
+        # `quantize` also applies to the vocoder, the T2S and S2A models are optimized below with the profile
+        pipe = Pipeline(t2s_ref=t2s_ref, s2a_ref=s2a_ref, optimize=False, device='cpu', quantize=kwargs.get('quantize', False))
+        pipe.t2s.optimize(torch_compile=False, **kwargs)
+        pipe.s2a.optimize(torch_compile=False, **kwargs)
+
+        torch.manual_seed(0)
+        stoks = pipe.t2s.generate(txt, show_progress_bar=False)[0]
+        atoks = pipe.s2a.generate(stoks, pipe.default_speaker.unsqueeze(0), show_progress_bar=False)
+        t = atoks.shape[-1] / 75
+
+        def t2s(): return pipe.t2s.generate(txt, show_progress_bar=False)
+        def s2a(): return pipe.s2a.generate(stoks, pipe.default_speaker.unsqueeze(0), show_progress_bar=False)
+        def vocoder(): return pipe.vocoder.decode(atoks)
+        ts = [measure(f, iterations=iterations)[0] for f in (t2s, s2a, vocoder)]
+        print(f"{name}\t" + "\t".join(f"{t/x:.2f}x" for x in ts + [sum(ts)]))
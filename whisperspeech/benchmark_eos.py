@@ -0,0 +1,51 @@
+# AUTOGENERATED! DO NOT EDIT! File to edit: ../nbs/C. Benchmark EOS checks.ipynb.
+
+# %% auto 0
+__all__ = []
+
+# %% ../nbs/C. Benchmark EOS checks.ipynb 2
+import time
+import torch
+from fastcore.script import call_parse
+from whisperspeech.t2s_up_wds_mlang_enclm import TSARTransformer
+from whisperspeech.inference import get_compute_device
+
+# %% ../nbs/C. Benchmark EOS checks.ipynb 3
+@call_parse
+def benchmark(
+    t2s_ref='collabora/whisperspeech:t2s-small-en+pl.model',
+    intervals : str = "1,4,8,16", # comma separated list of `eos_check_interval` values to compare
+    batch_size : int = 1,
+    no_torch_compile : bool = False,
+    iterations = 10,
+    seed : int = 0,
+):
+    """Measures the per-token time of T2S decoding for different EOS check intervals.
+
+    With an interval of 1 we wait for the device after every token, like the loop used to do. The
+    decoded tokens are the same for all intervals, the larger ones only run a few extra steps at the end."""
+    dev = get_compute_device()
+    t2s = TSARTransformer.load_model(t2s_ref, device=dev)
+    t2s.optimize(max_batch_size=batch_size, torch_compile=not no_torch_compile)
+    txt = "This is the first demo of Whisper Speech, a fully open source text-to-speech model trained by Collabora and Lion on the Juwels supercomputer."
+
+    def run(interval, step=None):
+        toks = t2s.generate(txt, bs=batch_size, seed=seed, eos_check_interval=interval, step=step, show_progress_bar=False)
+        getattr(torch, dev).synchronize()
+        return toks
+
+    run(1) # warmup
+    reference = run(1)
+    print(f"interval\tsteps\tsame\tper token\t\ttotal")
+    for interval in [int(x) for x in intervals.split(',')]:
+        steps = [0]
+        def count(): steps[0] += 1
+        same = torch.equal(run(interval, step=count), reference)
+        ts = []
+        for _ in range(iterations):
+            start = time.time()
+            run(interval)
+            ts.append(time.time() - start)
+        ts = torch.tensor(ts)
+        per_token = ts / (steps[0] + 1)
+        print(f"{interval}\t\t{steps[0]+1}\t{same}\t{per_token.mean()*1e3:.2f} ± {per_token.std()*1e3:.2f} ms\t{ts.mean():.3f} s")
@@ -0,0 +1,82 @@
+# AUTOGENERATED! DO NOT EDIT! File to edit: ../nbs/C. Benchmark fused decoding.ipynb.
+
+# %% auto 0
+__all__ = []
+
+# %% ../nbs/C. Benchmark fused decoding.ipynb 2
+import time
+import torch
+from fastcore.script import call_parse
+from whisperspeech.pipeline import Pipeline
+from whisperspeech.inference import get_compute_device
+
+# %% ../nbs/C. Benchmark fused decoding.ipynb 3
+def measure(fun, iterations = 10):
+    ts = []
+    for x in range(iterations):
+        start = time.time()
+        fun()
+        getattr(torch, get_compute_device()).synchronize()
+        ts.append(time.time() - start)
+    ts = torch.tensor(ts)
+    return ts.mean(), ts.std()
+
+@torch.no_grad()
+def decoder_step_error(decoder, position=100):
+    """Returns the largest difference between the outputs of a fused and a reference decoding step (relative
+    to the largest output) on random inputs and random KV caches."""
+    attn = decoder.layers[0].attn
+    bs, dtype = attn.k_cache.shape[0], attn.k_cache.dtype
+    caches = [c for l in decoder.layers for m in (l.attn, l.cross_attn) if m for c in (m.k_cache, m.v_cache)]
+    saved = [c.clone() for c in caches]
+    for c in caches: c.normal_()
+    random = [c.clone() for c in caches]
+    x = torch.randn(bs, 1, decoder.width, dtype=dtype, device=attn.k_cache.device)
+    positions = torch.tensor([position], device=x.device)
+    fused = decoder.fused_decode
+    outs = []
+    decoder.set_kv_len(position+1)
+    for mode in (False, True):
+        decoder.fused_decode = mode
+        outs.append(decoder(x, positions, None, None).float())
+        for c, r in zip(caches, random): c.copy_(r) # the step writes the new keys and values
+    decoder.fused_decode = fused
+    decoder.set_kv_len(None)
+    for c, s in zip(caches, saved): c.copy_(s)
+    ref, out = outs
+    return ((ref - out).abs().max() / ref.abs().max()).item()
+
+@call_parse
+def benchmark(
+    t2s_ref='collabora/whisperspeech:t2s-small-en+pl.model',
+    s2a_ref='collabora/whisperspeech:s2a-q4-tiny-en+pl.model',
+    no_torch_compile : bool = False,
+    iterations = 5,
+    seed : int = 0,
+):
+    """Compares the fused single token decoding steps (`optimize(fused_decode=True)`) with the reference layers at batch size 1.
+
+    Parity is the largest relative difference of the decoder outputs for one step and the fraction of tokens
+    equal to the reference decode with the same seed. Speed is the time per decoding step of `generate`."""
+    pipe = Pipeline(t2s_ref=t2s_ref, s2a_ref=s2a_ref, optimize=False)
+    for model in (pipe.t2s, pipe.s2a):
+        model.optimize(max_batch_size=1, torch_compile=not no_torch_compile, fused_decode=True)
+    txt = "This is the first demo of Whisper Speech, a fully open source text-to-speech model trained by Collabora and Lion on the Juwels supercomputer."
+    # a fixed number of steps (a check interval of N never stops at the end of text)
+    N = pipe.t2s.stoks_len // 2
+    stoks = torch.zeros(N, dtype=torch.long)
+    speaker = pipe.default_speaker.unsqueeze(0)
+    def t2s(): return pipe.t2s.generate(txt, N=N, eos_check_interval=N, seed=seed, show_progress_bar=False)
+    def s2a(): return pipe.s2a.generate(stoks, speaker, seed=seed, show_progress_bar=False)
+
+    print(f"model\tstep error\ttokens\treference\t\tfused")
+    for name, model, gen, steps in [('T2S', pipe.t2s, t2s, N), ('S2A', pipe.s2a, s2a, 3*N)]:
+        error = decoder_step_error(model.decoder)
+        ts, toks = [], []
+        for mode in (False, True):
+            model.decoder.fused_decode = mode
+            toks.append(gen()) # also the warmup
+            mean, std = measure(gen, iterations=iterations)
+            ts.append(f"{mean/steps*1e3:.2f} ± {std/steps*1e3:.2f} ms")
+        match = (toks[0] == toks[1]).float().mean().item() if toks[0].shape == toks[1].shape else 0
+        print(f"{name}\t{error:.2e}\t{match*100:.1f}%\t" + "\t".join(ts))
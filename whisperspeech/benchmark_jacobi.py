@@ -0,0 +1,60 @@
+# AUTOGENERATED! DO NOT EDIT! File to edit: ../nbs/C. Benchmark Jacobi decoding.ipynb.
+
+# %% auto 0
+__all__ = []
+
+# %% ../nbs/C. Benchmark Jacobi decoding.ipynb 2
+import time
+import torch
+from fastcore.script import call_parse
+from whisperspeech.pipeline import Pipeline
+from whisperspeech.inference import get_compute_device
+
+# %% ../nbs/C. Benchmark Jacobi decoding.ipynb 3
+def measure(fun, iterations = 10):
+    ts = []
+    for x in range(iterations):
+        start = time.time()
+        fun()
+        getattr(torch, get_compute_device()).synchronize()
+        ts.append(time.time() - start)
+    ts = torch.tensor(ts)
+    return ts.mean(), ts.std()
+
+@call_parse
+def benchmark(
+    t2s_ref='collabora/whisperspeech:t2s-small-en+pl.model',
+    s2a_ref='collabora/whisperspeech:s2a-q4-tiny-en+pl.model',
+    windows : str = "2,4,8,16", # comma separated list of Jacobi window sizes to test
+    top_k : int = None,
+    no_torch_compile : bool = False,
+    iterations = 10,
+    seed : int = 0,
+):
+    """Compares S2A Jacobi decoding with the sequential loop.
+
+    Speed is the wall-clock time of a full `generate` call. Quality is the fraction of acoustic tokens equal to
+    the sequential decode (`jacobi_window=None`) with the same `seed` (it should be 100% up to numerical
+    differences between batched and single-step matmuls). Without a seed the two only match in distribution."""
+    pipe = Pipeline(t2s_ref=t2s_ref, s2a_ref=s2a_ref, torch_compile=not no_torch_compile)
+
+    txt = "This is the first demo of Whisper Speech, a fully open source text-to-speech model trained by Collabora and Lion on the Juwels supercomputer."
+    stoks = pipe.t2s.generate(txt, seed=seed, show_progress_bar=False)[0]
+    t = len(stoks)/25
+    speaker = pipe.default_speaker.unsqueeze(0)
+
+    def s2a(window=None, step=None):
+        return pipe.s2a.generate(stoks, speaker, top_k=top_k, jacobi_window=window, step=step, seed=seed, show_progress_bar=False)
+
+    s2a() # warmup
+    reference = s2a()
+    mean, std = measure(s2a, iterations=iterations)
+    print(f"window\tforwards\tmatch\ttime\t\t\tRTF")
+    print(f"-\t{reference.shape[-1]+3}\t\t100.0%\t{mean:.3f} ± {std:.3f} s\t{t/mean:.2f}x")
+    for window in [int(x) for x in windows.split(',')]:
+        forwards = [0]
+        def count(): forwards[0] += 1
+        atoks = s2a(window, step=count)
+        match = (atoks == reference).float().mean().item()
+        mean, std = measure(lambda: s2a(window), iterations=iterations)
+        print(f"{window}\t{forwards[0]+1}\t\t{match*100:.1f}%\t{mean:.3f} ± {std:.3f} s\t{t/mean:.2f}x")
@@ -0,0 +1,66 @@
+# AUTOGENERATED! DO NOT EDIT! File to edit: ../nbs/C. Benchmark paged KV cache.ipynb.
+
+# %% auto 0
+__all__ = []
+
+# %% ../nbs/C. Benchmark paged KV cache.ipynb 2
+import time
+import torch
+from fastcore.script import call_parse
+from whisperspeech.pipeline import Pipeline
+from whisperspeech.inference import get_compute_device
+
+# %% ../nbs/C. Benchmark paged KV cache.ipynb 3
+def measure(fun, iterations = 10):
+    ts = []
+    for x in range(iterations):
+        start = time.time()
+        fun()
+        getattr(torch, get_compute_device()).synchronize()
+        ts.append(time.time() - start)
+    ts = torch.tensor(ts)
+    return ts.mean(), ts.std()
+
+@torch.no_grad()
+def gather_time(decoder, bs, length, iterations=10):
+    """Returns the time it takes to gather the paged KV caches of all the layers for a decoding step of `bs`
+    rows that attend to `length` positions."""
+    decoder.reserve_kv_cache([length] * bs)
+    decoder.set_kv_len(length)
+    def gather():
+        for l in decoder.layers: l.attn.paged_kv(bs)
+    gather() # warmup
+    mean, _ = measure(gather, iterations=iterations)
+    decoder.free_kv_cache(range(bs))
+    decoder.set_kv_len(None)
+    return mean
+
+@call_parse
+def benchmark(
+    t2s_ref='collabora/whisperspeech:t2s-small-en+pl.model',
+    bs : int = 4,
+    kv_block_size : int = 16,
+    iterations = 5,
+    seed : int = 0,
+):
+    """Compares T2S decoding with the dense and the paged KV cache (`optimize(kv_block_size=...)`).
+
+    The attention layers cannot read the blocks of the paged cache in place, so every decoding step first
+    copies them into contiguous keys and values. We print the time per decoding step of `generate` and how
+    much of it the copy takes at the last (longest) step."""
+    pipe = Pipeline(t2s_ref=t2s_ref, optimize=False)
+    model = pipe.t2s
+    txt = "This is the first demo of Whisper Speech, a fully open source text-to-speech model trained by Collabora and Lion on the Juwels supercomputer."
+    # a fixed number of steps (a check interval of N never stops at the end of text)
+    N = model.stoks_len
+    def gen(): return model.generate(txt, N=N, bs=bs, eos_check_interval=N, seed=seed, show_progress_bar=False)
+
+    print(f"cache\ttokens\tstep\t\t\tcopy")
+    toks = []
+    for name, block_size in [('dense', None), ('paged', kv_block_size)]:
+        model.optimize(max_batch_size=bs, torch_compile=False, kv_block_size=block_size)
+        toks.append(gen()) # also the warmup
+        mean, std = measure(gen, iterations=iterations)
+        copy = f"{gather_time(model.decoder, bs, N-1)*1e3:.2f} ms" if block_size else "-"
+        match = (toks[0] == toks[-1]).float().mean().item() if toks[0].shape == toks[-1].shape else 0
+        print(f"{name}\t{match*100:.1f}%\t{mean/N*1e3:.2f} ± {std/N*1e3:.2f} ms\t{copy}")
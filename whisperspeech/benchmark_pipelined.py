@@ -0,0 +1,62 @@
+# AUTOGENERATED! DO NOT EDIT! File to edit: ../nbs/C. Benchmark pipelined generation.ipynb.
+
+# %% auto 0
+__all__ = []
+
+# %% ../nbs/C. Benchmark pipelined generation.ipynb 2
+import time
+import torch
+from fastcore.script import call_parse
+from whisperspeech.pipeline import Pipeline, split_text
+from whisperspeech.inference import get_compute_device
+
+# %% ../nbs/C. Benchmark pipelined generation.ipynb 3
+@call_parse
+def benchmark(
+    t2s_ref='collabora/whisperspeech:t2s-small-en+pl.model',
+    s2a_ref='collabora/whisperspeech:s2a-q4-tiny-en+pl.model',
+    torch_compile : bool = False,
+    max_chars : int = 100,
+    iterations = 3,
+):
+    """Compares the time to synthesize a long text segment by segment sequentially and with `Pipeline.generate_pipelined`.
+
+    We also print the total time spent in each stage in the sequential run, the pipelined one should take
+    about as long as the slowest stage."""
+    dev = get_compute_device()
+    pipe = Pipeline(t2s_ref=t2s_ref, s2a_ref=s2a_ref, torch_compile=torch_compile)
+    txt = " ".join(["This is the first demo of Whisper Speech, a fully open source text-to-speech model trained by Collabora and Lion on the Juwels supercomputer."] * 4)
+    segments = split_text(txt, max_chars)
+    speaker = pipe.default_speaker.unsqueeze(0)
+    stages = torch.zeros(3)
+
+    def timed(i, fun, *args, **kwargs):
+        start = time.time()
+        result = fun(*args, **kwargs)
+        getattr(torch, dev).synchronize()
+        stages[i] += time.time() - start
+        return result
+
+    def sequential():
+        for segment in segments:
+            stoks = timed(0, pipe.t2s.generate, segment, show_progress_bar=False)[0]
+            atoks = timed(1, pipe.s2a.generate, stoks, speaker, show_progress_bar=False)
+            timed(2, pipe.vocoder.decode, atoks)
+
+    def pipelined():
+        for _ in pipe.generate_pipelined(txt, max_chars=max_chars): pass
+
+    sequential(); pipelined() # warmup
+    stages.zero_()
+    print(f"{len(segments)} segments")
+    for name, fun in [('sequential', sequential), ('pipelined', pipelined)]:
+        ts = []
+        for _ in range(iterations):
+            start = time.time()
+            fun()
+            getattr(torch, dev).synchronize()
+            ts.append(time.time() - start)
+        ts = torch.tensor(ts)
+        print(f"{name}:\t{ts.mean():.2f} ± {ts.std():.2f} s")
+    t2s, s2a, vocoder = (stages / iterations).tolist()
+    print(f"stages (sequential): T2S {t2s:.2f} s, S2A {s2a:.2f} s, vocoder {vocoder:.2f} s")
@@ -0,0 +1,81 @@
+# AUTOGENERATED! DO NOT EDIT! File to edit: ../nbs/C. Benchmark sampling.ipynb.
+
+# %% auto 0
+__all__ = []
+
+# %% ../nbs/C. Benchmark sampling.ipynb 2
+import time
+import torch
+from fastcore.script import call_parse
+from whisperspeech import inference
+
+# %% ../nbs/C. Benchmark sampling.ipynb 3
+def measure(fun, iterations = 10):
+    ts = []
+    for x in range(iterations):
+        start = time.time()
+        fun()
+        if torch.cuda.is_available(): torch.cuda.synchronize()
+        ts.append(time.time() - start)
+    ts = torch.tensor(ts)
+    return ts.mean(), ts.std()
+
+def reference_sample(logits, T=1.0, top_k=None):
+    # the sampler we used before: a softmax over the (masked) full vocabulary and the exponential race
+    return inference.multinomial_sample_one_no_sync(inference.logits_to_probs(logits, T, top_k))
+
+@call_parse
+def benchmark(
+    batch_sizes : str = "1,8,32", # comma separated list of batch sizes
+    quantizers : int = 4, # 4 for S2A, use 1 for T2S
+    codes : int = 1024, # vocabulary size
+    top_k : int = None,
+    top_p : float = None,
+    device : str = None, # defaults to `inference.get_compute_device()`
+    no_torch_compile : bool = False,
+    iterations : int = 1000,
+):
+    """Compares the time of a single sampling step of the fused `inference.sample` with the softmax based one.
+
+    We time the samplers on their own on `[bs, quantizers, codes]` logits, eager and compiled with `torch.compile`
+    (the way they run inside the compiled decoding step). It also checks that the fused sampler follows the
+    same distribution and that seeding per row makes it independent of the rest of the batch."""
+    dev = device or inference.get_compute_device()
+    T = torch.tensor(0.7, device=dev)
+    samplers = [
+        ('softmax', lambda x, seeds: reference_sample(x, T, top_k)),
+        ('fused', lambda x, seeds: inference.sample(x, T, top_k, top_p=top_p)),
+        ('fused seeded', lambda x, seeds: inference.sample(x, T, top_k, top_p=top_p, seeds=seeds, steps=seeds)),
+    ]
+    if top_p is not None: samplers = samplers[1:] # the reference does not support top-p
+
+    # sanity check: empirical token frequencies on a small vocabulary (without top-p, we have no reference for it)
+    logits = torch.randn(16, device=dev) * 2
+    n = 100000
+    ref = torch.softmax(logits / T, -1)
+    if top_k: ref = torch.softmax(torch.where(logits < logits.topk(min(top_k, 16)).values[-1], -torch.inf, logits) / T, -1)
+    x = logits.expand(n, -1)
+    for name, f in samplers if top_p is None else []:
+        counts = torch.bincount(f(x, torch.arange(n, device=dev))[:,0].to(torch.long), minlength=16) / n
+        print(f"{name}: max abs. frequency error {(counts - ref).abs().max():.4f}")
+    logits = torch.randn(8, quantizers, codes, device=dev) * 3
+    step = torch.tensor(3, device=dev)
+    a = inference.sample(logits, T, top_k, top_p=top_p, seeds=torch.arange(8, device=dev), steps=step)
+    b = inference.sample(logits[:1], T, top_k, top_p=top_p, seeds=torch.arange(1, device=dev), steps=step)
+    print(f"seeded sampling independent of the rest of the batch: {bool((a[:1] == b).all())}")
+
+    modes = [('eager', lambda f: f)]
+    if not no_torch_compile: modes.append(('compiled', lambda f: torch.compile(f, fullgraph=True)))
+    print(f"\nbs\tmode\t\t" + "\t\t".join(name for name,_ in samplers))
+    for bs in [int(x) for x in batch_sizes.split(',')]:
+        logits = torch.randn(bs, quantizers, codes, device=dev) * 3
+        seeds = torch.arange(bs, device=dev)
+        for mode, wrap in modes:
+            ts = []
+            for name, f in samplers:
+                f = wrap(f)
+                f(logits, seeds) # warmup
+                f(logits, seeds)
+                mean, std = measure(lambda: f(logits, seeds), iterations=iterations)
+                ts.append(f"{mean*1e6:.1f} ± {std*1e6:.1f} us")
+            print(f"{bs}\t{mode}\t\t" + "\t".join(ts))
@@ -0,0 +1,31 @@
+# AUTOGENERATED! DO NOT EDIT! File to edit: ../nbs/C5. Build compile cache.ipynb.
+
+# %% auto 0
+__all__ = ['build_compile_cache']
+
+# %% ../nbs/C5. Build compile cache.ipynb 2
+import time
+from pathlib import Path
+from fastcore.script import call_parse
+
+from whisperspeech import inference
+from whisperspeech.pipeline import Pipeline
+
+# %% ../nbs/C5. Build compile cache.ipynb 3
+@call_parse
+def build_compile_cache(
+    output:Path, # where to save the artifacts (e.g. next to the model files)
+    t2s_ref='collabora/whisperspeech:t2s-small-en+pl.model',
+    s2a_ref='collabora/whisperspeech:s2a-q4-tiny-en+pl.model',
+    batch_sizes:str="1", # comma separated list of batch sizes to compile for
+):
+    """Compiles the decoding graphs for every batch size and saves the compiled artifacts.
+
+    Pass the file as `Pipeline(torch_compile=True, compile_cache=...)` (with the same models, `max_batch_size`
+    and GPU type) to skip the compilation on startup, `Pipeline.warmup` will then only load the graphs."""
+    batch_sizes = [int(x) for x in batch_sizes.split(',')]
+    pipe = Pipeline(t2s_ref=t2s_ref, s2a_ref=s2a_ref, torch_compile=True, max_batch_size=max(batch_sizes))
+    start = time.time()
+    pipe.warmup(batch_sizes)
+    print(f"Compiled for batch sizes {batch_sizes} in {time.time() - start:.1f} s")
+    inference.save_compile_cache(output)
@@ -0,0 +1,246 @@
+# AUTOGENERATED! DO NOT EDIT! File to edit: ../nbs/C6. Export ONNX.ipynb.
+
+# %% auto 0
+__all__ = ['export_t2s', 'export_s2a', 'export_onnx']
+
+# %% ../nbs/C6. Export ONNX.ipynb 2
+import copy
+import json
+from pathlib import Path
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from fastcore.script import call_parse
+
+try:
+    import onnx # needed by `torch.onnx.export`
+except ImportError:
+    onnx = None
+
+from whisperspeech import inference, s2a_delar_mup_wds_mlang_cond
+from whisperspeech.s2a_delar_mup_wds_mlang import SADelARTransformer
+from whisperspeech.t2s_up_wds_mlang_enclm import TSARTransformer
+
+# %% ../nbs/C6. Export ONNX.ipynb 3
+# The graphs get the KV caches as inputs and return the new keys and values as outputs (instead of updating
+# the cache buffers of the attention layers in place) so the runtime owns all the state.
+def _self_attention(attn, x, positions, past_k, past_v, mask):
+    q,k,v = attn.qkv(x).split(attn.odim, dim=-1)
+    q = attn.split_heads(q, positions, rope=attn.rotary, subsampling=attn.query_subsampling)
+    k = attn.split_heads(k, positions, rope=attn.rotary, subsampling=attn.key_subsampling)
+    v = attn.split_heads(v, positions)
+    if past_k is None: # prefill: the tokens only attend to each other
+        all_k, all_v = k, v
+    else: # decoding step: the new token goes into its slot of the cache
+        slot = (torch.arange(past_k.shape[2], device=x.device) == positions).view(1, 1, -1, 1)
+        all_k, all_v = torch.where(slot, k, past_k), torch.where(slot, v, past_v)
+    wv = F.scaled_dot_product_attention(q, all_k, all_v, attn_mask=mask)
+    return attn.out(wv.permute(0, 2, 1, 3).flatten(start_dim=2)), k, v
+
+def _cross_attention(attn, x, positions, k, v):
+    q = attn.split_heads(attn.q(x), positions, rope=attn.rotary, subsampling=attn.query_subsampling)
+    wv = F.scaled_dot_product_attention(q, k, v)
+    return attn.out(wv.permute(0, 2, 1, 3).flatten(start_dim=2))
+
+def _decoder(decoder, x, positions, cross_kvs, past_kvs=None):
+    # `BaseDecoder.forward` with explicit caches, returns the output and the new keys and values of every layer
+    if past_kvs is None:
+        mask = decoder.mask[positions][:, positions]
+    else:
+        mask = decoder.mask[positions][:, :past_kvs[0].shape[2]]
+    new_kvs = []
+    for i,l in enumerate(decoder.layers):
+        past_k, past_v = (past_kvs[2*i], past_kvs[2*i+1]) if past_kvs is not None else (None, None)
+        out, k, v = _self_attention(l.attn, l.attn_ln(x), positions, past_k, past_v, mask)
+        x = x + out
+        x = x + _cross_attention(l.cross_attn, l.cross_attn_ln(x), positions, cross_kvs[2*i], cross_kvs[2*i+1])
+        x = x + l.mlp(l.mlp_ln(x))
+        new_kvs += [k, v]
+    return decoder.ln_post(x), new_kvs
+
+# %% ../nbs/C6. Export ONNX.ipynb 4
+class _Wrapper(nn.Module):
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    def state_dict(self, *args, **kwargs):
+        # the tracer expects only tensors (the S2A models keep their speaker map in the `_extra_state`)
+        # (filtered in place because the tracer calls us with a `destination` of its own)
+        state = super().state_dict(*args, **kwargs)
+        for k in [k for k,v in state.items() if not torch.is_tensor(v)]: del state[k]
+        return state
+
+class T2SEncoder(_Wrapper):
+    def forward(self, ttoks, langs, cpss):
+        xenc, positions, cps_emb = self.model.run_encoder(ttoks, langs, cpss)
+        return (cps_emb, *self.model.decoder.cross_kv(xenc, positions))
+
+class T2SDecoder(_Wrapper):
+    def __init__(self, model, step):
+        super().__init__(model)
+        self.step = step
+
+    def forward(self, toks, positions, cps_emb, *kvs):
+        m = self.model
+        n = 2 * len(m.decoder.layers)
+        x = (m.embeddings.embedding(toks) + m.embeddings.positional_embedding[positions] + cps_emb).to(m.dtype)
+        x, new_kvs = _decoder(m.decoder, x, positions, kvs[:n], kvs[n:] if self.step else None)
+        logits = m.embeddings.embedding.unembed(x[:,-1])
+        logits = logits * m.tunables.output_mult / (m.width / m.base_width)
+        return (logits.float(), *new_kvs)
+
+def _traceable_conds(model, conds, device):
+    # the conditioned model makes tensors out of the python numbers in the conditions (and out of the defaults
+    # of the missing ones) which the exporter cannot trace, so we pass all of them in as tensors
+    defaults = {k:emb.default for k,emb in model.cond_embeddings.items()}
+    return [{k:v if torch.is_tensor(v) else torch.full((), float(v), device=device) for k,v in {**defaults, **c}.items()}
+            for c in conds]
+
+class S2AEncoder(_Wrapper):
+    def forward(self, stoks, speakers):
+        conds = self.model.speaker_conds(speakers)
+        # the conditioned model collates the conditions row by row so the graph is traced for a single row
+        if hasattr(self.model, 'cond_embeddings'): conds = _traceable_conds(self.model, conds, stoks.device)
+        xenc, positions, _ = self.model.run_encoder(stoks, conds)
+        return tuple(self.model.decoder.cross_kv(xenc, positions))
+
+class S2ADecoder(_Wrapper):
+    def __init__(self, model, step):
+        super().__init__(model)
+        self.step = step
+
+    def forward(self, toks, positions, *kvs):
+        m = self.model
+        n = 2 * len(m.decoder.layers)
+        embs = m.embds(toks, None)
+        x, new_kvs = _decoder(m.decoder, embs, positions, kvs[:n], kvs[n:] if self.step else None)
+        logits = m.head(x[:,-1:], embeddings=m.embds)[:,:,-1]
+        logits = logits * m.tunables.output_mult / (m.width / m.base_width)
+        return (logits.float(), *new_kvs)
+
+# %% ../nbs/C6. Export ONNX.ipynb 5
+def _check_onnx(quantize):
+    # the ONNX packages are an optional dependency (`pip install whisperspeech[onnx]`)
+    if onnx is None:
+        raise ImportError("exporting ONNX graphs needs the `onnx` package, please `pip install whisperspeech[onnx]`")
+    if quantize:
+        try:
+            import onnxruntime
+        except ImportError:
+            raise ImportError("quantizing ONNX graphs needs the `onnxruntime` package, please `pip install whisperspeech[onnx]`")
+
+def _kv_names(prefix, n):
+    return [f"{prefix}_{kv}{i}" for i in range(n) for kv in "kv"]
+
+def _export(module, args, fname, input_names, output_names, dynamic_axes):
+    with torch.no_grad():
+        # a new wrapper is in training mode and the exporter would restore it to the whole model afterwards
+        torch.onnx.export(module.eval(), tuple(args), fname, input_names=input_names, output_names=output_names,
+                          dynamic_axes=dynamic_axes, opset_version=17, dynamo=False)
+
+def _export_decoders(wrapper, model, output, toks, extra_names, extra_args, cross_kvs, ctx_len, seq_axis):
+    # the prefill graph takes a prompt of any length, the decoding step a single token and the whole cache
+    n = len(model.decoder.layers)
+    cross_names, past_names = _kv_names('cross', n), _kv_names('past', n)
+    batch = {0: 'batch'}
+    kv_axes = {**batch, 2: 'length'}
+    for step in (False, True):
+        T = 1 if step else 3
+        positions = torch.arange(T, device=toks.device) + (4 if step else 0)
+        past = [torch.zeros_like(cross_kvs[0][:,:,:1]).expand(-1, -1, ctx_len, -1).contiguous()] * (2 * n) if step else []
+        input_names = ['toks', 'positions', *extra_names, *cross_names, *past_names[:len(past)]]
+        output_names = ['logits', *_kv_names('new', n)]
+        dynamic_axes = {'toks': {**batch, seq_axis: 'length'}, 'positions': {0: 'length'},
+                        **{x: batch for x in extra_names}, **{x: batch for x in cross_names},
+                        **{x: kv_axes for x in past_names[:len(past)]}, 'logits': batch,
+                        **{x: {**batch, 2: 'length'} for x in output_names[1:]}}
+        if step: dynamic_axes['toks'], dynamic_axes['positions'] = batch, {}
+        _export(wrapper(model, step), [toks.narrow(seq_axis, 0, T), positions, *extra_args, *cross_kvs, *past],
+                output/('decode.onnx' if step else 'prefill.onnx'), input_names, output_names, dynamic_axes)
+
+def _export_copy(model):
+    # the export casts and converts the model so we work on a copy and leave the caller's model alone, the
+    # copied compiled functions would still call the original model so we drop them
+    model = copy.deepcopy(model).eval().float()
+    for name in getattr(model, 'compiled_for_inference', ()): model.__dict__.pop(name, None)
+    if not model.converted_for_eval: model.convert_for_eval()
+    model.dtype = torch.float32
+    return model
+
+def _save_config(output, model, **kwargs):
+    attn = model.decoder.layers[0].attn
+    config = dict(layers=len(model.decoder.layers), n_head=attn.n_head, head_width=attn.n_state // attn.n_head, **kwargs)
+    with open(output/'config.json', 'w') as f: json.dump(config, f, indent=2)
+
+def _quantize(output):
+    from onnxruntime.quantization import quantize_dynamic, QuantType
+    for name in ('encoder', 'prefill', 'decode'):
+        quantize_dynamic(output/f'{name}.onnx', output/f'{name}.onnx', weight_type=QuantType.QInt8)
+
+# %% ../nbs/C6. Export ONNX.ipynb 6
+@torch.no_grad()
+def export_t2s(model, output, quantize=False):
+    """Exports the encoder, prefill and decoding step graphs of a `TSARTransformer` into the `output` directory.
+
+    Load them with `ort_inference.ORTT2S(output)`."""
+    _check_onnx(quantize)
+    output = Path(output)
+    output.mkdir(parents=True, exist_ok=True)
+    model = _export_copy(model)
+    dev = model.device
+    ttoks = torch.zeros((1, model.ttoks_len), dtype=torch.long, device=dev)
+    langs = torch.zeros(1, dtype=torch.long, device=dev)
+    cpss = torch.full((1,), 15., device=dev)
+    cps_emb, *cross_kvs = T2SEncoder(model)(ttoks, langs, cpss)
+    n = len(model.decoder.layers)
+    _export(T2SEncoder(model), [ttoks, langs, cpss], output/'encoder.onnx', ['ttoks', 'langs', 'cpss'],
+            ['cps_emb', *_kv_names('cross', n)], {x: {0: 'batch'} for x in ['ttoks', 'langs', 'cpss', 'cps_emb', *_kv_names('cross', n)]})
+    toks = torch.zeros((1, 3), dtype=torch.long, device=dev)
+    _export_decoders(T2SDecoder, model, output, toks, ['cps_emb'], [cps_emb], cross_kvs, model.stoks_len, 1)
+    _save_config(output, model, kind='t2s', ttoks_len=model.ttoks_len, stoks_len=model.stoks_len,
+                 eot=model.stoks_codes + model.tunables.padding_token_offset, text_eot=0)
+    if quantize: _quantize(output)
+
+@torch.no_grad()
+def export_s2a(model, output, quantize=False):
+    """Exports the encoder, prefill and decoding step graphs of a `SADelARTransformer` into the `output` directory.
+
+    Load them with `ort_inference.ORTS2A(output)`. The sliding window is not supported (the runtime is limited
+    to `ctx_n` acoustic tokens like the model without `window`)."""
+    _check_onnx(quantize)
+    output = Path(output)
+    output.mkdir(parents=True, exist_ok=True)
+    model = _export_copy(model)
+    dev = model.device
+    stoks = torch.zeros((1, model.stoks_len), dtype=torch.long, device=dev)
+    speakers = torch.zeros((1, model.spk_width or model.width), device=dev)
+    cross_kvs = S2AEncoder(model)(stoks, speakers)
+    n = len(model.decoder.layers)
+    _export(S2AEncoder(model), [stoks, speakers], output/'encoder.onnx', ['stoks', 'speakers'],
+            _kv_names('cross', n), {})
+    toks = torch.zeros((1, model.quantizers, 3), dtype=torch.long, device=dev)
+    _export_decoders(S2ADecoder, model, output, toks, [], [], cross_kvs, model.ctx_n, 2)
+    _save_config(output, model, kind='s2a', stoks_len=model.stoks_len, ctx_n=model.ctx_n, quantizers=model.quantizers,
+                 codes=model.codes, stoks_pad=model.stoks_codes-1, spk_width=model.spk_width or model.width)
+    if quantize: _quantize(output)
+
+@call_parse
+def export_onnx(
+    output:Path, # output directory
+    t2s_ref='collabora/whisperspeech:t2s-small-en+pl.model',
+    s2a_ref='collabora/whisperspeech:s2a-q4-tiny-en+pl.model',
+    quantize:bool=False, # int8 dynamic quantization of the weights with ONNX Runtime
+):
+    """Exports the T2S and S2A models as ONNX graphs with explicit KV caches into `output/t2s` and `output/s2a`.
+
+    Run them with `ort_inference.ORTT2S(output/'t2s')` and `ort_inference.ORTS2A(output/'s2a')` which only need
+    `numpy` and `onnxruntime`."""
+    export_t2s(TSARTransformer.load_model(t2s_ref, device='cpu'), output/'t2s', quantize=quantize)
+    spec = inference.load_model(ref=s2a_ref)
+    if [x for x in spec['state_dict'].keys() if x.startswith('cond_embeddings.')]:
+        cls = s2a_delar_mup_wds_mlang_cond.SADelARTransformer
+    else:
+        cls = SADelARTransformer
+    export_s2a(cls.load_model(spec=spec, device='cpu'), output/'s2a', quantize=quantize)
@@ -0,0 +1,39 @@
+# AUTOGENERATED! DO NOT EDIT! File to edit: ../nbs/C4. Export optimized models.ipynb.
+
+# %% auto 0
+__all__ = ['export_optimized']
+
+# %% ../nbs/C4. Export optimized models.ipynb 2
+import torch
+from pathlib import Path
+from fastcore.script import call_parse
+
+from whisperspeech import inference, s2a_delar_mup_wds_mlang_cond
+from whisperspeech.s2a_delar_mup_wds_mlang import SADelARTransformer
+from whisperspeech.t2s_up_wds_mlang_enclm import TSARTransformer
+from whisperspeech.a2wav import Vocoder
+
+# %% ../nbs/C4. Export optimized models.ipynb 3
+@call_parse
+def export_optimized(
+    output:Path, # output directory
+    t2s_ref='collabora/whisperspeech:t2s-small-en+pl.model',
+    s2a_ref='collabora/whisperspeech:s2a-q4-tiny-en+pl.model',
+    vocoder_ref='charactr/vocos-encodec-24khz',
+    dtype:str='float16', # the inference dtype of the T2S and S2A models
+    ext:str='safetensors', # `safetensors` (memory-mapped) or `model` (torch pickle)
+):
+    """Writes the T2S and S2A models fused and cast for inference and the vocoder weights into `output`.
+
+    Load them with `Pipeline(t2s_ref=f"{output}/t2s.safetensors", s2a_ref=f"{output}/s2a.safetensors",
+    vocoder_ref=f"{output}/vocoder.safetensors")`."""
+    output.mkdir(parents=True, exist_ok=True)
+    dtype = getattr(torch, dtype)
+    TSARTransformer.load_model(t2s_ref, device='cpu').save_optimized(output/f't2s.{ext}', dtype=dtype)
+    spec = inference.load_model(ref=s2a_ref)
+    if [x for x in spec['state_dict'].keys() if x.startswith('cond_embeddings.')]:
+        cls = s2a_delar_mup_wds_mlang_cond.SADelARTransformer
+    else:
+        cls = SADelARTransformer
+    cls.load_model(spec=spec, device='cpu').save_optimized(output/f's2a.{ext}', dtype=dtype)
+    Vocoder(vocoder_ref, device='cpu').save_optimized(output/f'vocoder.{ext}')
@@ -1,13 +1,27 @@
 # AUTOGENERATED! DO NOT EDIT! File to edit: ../nbs/D. Common inference utilities.ipynb.
 
 # %% auto 0
-__all__ = ['get_compute_device']
+__all__ = ['get_compute_device', 'cpu_supports_bf16', 'get_inference_dtype', 'quantize_linears']
 
 # %% ../nbs/D. Common inference utilities.ipynb 1
+import hashlib
+import json
+import dataclasses
+import os
+import zipfile
+from pathlib import Path
+from collections import OrderedDict
+
+import numpy as np
 import torch
+import torch.nn as nn
 import torch.nn.functional as F
+from torch.profiler import record_function
+from fastprogress import progress_bar
 from huggingface_hub import hf_hub_download
 
+from .modules import MultiHeadAttention, Rotary
+
 from contextlib import nullcontext
 
 # %% ../nbs/D. Common inference utilities.ipynb 2
@@ -27,15 +41,123 @@ def get_compute_device():
     if preferred_device is None: preferred_device = get_default_compute_device()
     return preferred_device
 
+def cpu_supports_bf16():
+    try:
+        return torch.ops.mkldnn._is_mkldnn_bf16_supported()
+    except (AttributeError, RuntimeError):
+        return False
+
+def get_inference_dtype(device):
+    """Returns the fastest floating point type for running the models on `device`."""
+    if torch.device(device).type == 'cpu':
+        return torch.bfloat16 if cpu_supports_bf16() else torch.float32
+    return torch.float16
+
+def quantize_linears(model):
+    """Converts all `nn.Linear` layers of `model` to int8 dynamic quantization (CPU only).
+
+    The weights are stored in int8 and the activations are quantized on the fly so the rest of
+    the model has to stay in float32. Subclasses of `nn.Linear` (like the μP heads) are left alone."""
+    return torch.ao.quantization.quantize_dynamic(model, {nn.Linear}, dtype=torch.qint8, inplace=True)
+
 # %% ../nbs/D. Common inference utilities.ipynb 4
-def load_model(ref=None, spec=None, device='cpu'):
+def load_model(ref=None, spec=None, device='cpu', mmap=True):
     if spec is not None: return spec
     if ":" in ref:
         repo_id, filename = ref.split(":", 1)
         local_filename = hf_hub_download(repo_id=repo_id, filename=filename)
     else:
         local_filename = ref
-    return torch.load(local_filename, map_location=device)
+    return load_spec(local_filename, device=device, mmap=mmap)
+
+def load_spec(local_filename, device=None, mmap=True):
+    """Loads a model file written by `save_model` (a torch pickle or a `.safetensors` file).
+
+    With `mmap` the weights stay memory-mapped and are only read from disk when they are used. Files in the
+    legacy (non-zip) `torch.save` format cannot be memory-mapped and are loaded into memory instead."""
+    if str(local_filename).endswith('.safetensors'):
+        from safetensors import safe_open
+        from safetensors.torch import load_file
+        with safe_open(local_filename, framework='pt') as f:
+            spec = {k:json.loads(v) for k,v in f.metadata().items()}
+        spec['state_dict'] = load_file(local_filename, device=str(device or 'cpu'))
+        return spec
+    return torch.load(local_filename, map_location=device, mmap=mmap and zipfile.is_zipfile(local_filename))
+
+def save_spec(spec, fname):
+    """Saves a model spec (`config`, `tunables` and `state_dict`), `.safetensors` files can be memory-mapped
+    without unpickling and need the `safetensors` package."""
+    if str(fname).endswith('.safetensors'):
+        from safetensors.torch import save_file
+        # non-tensor entries (like the `_extra_state`) are recreated from the config
+        state_dict, seen = {}, set()
+        for k,v in spec['state_dict'].items():
+            if not isinstance(v, torch.Tensor): continue
+            # shared weights (e.g. the S2A special token embeddings) are saved separately for every user
+            state_dict[k] = v.clone() if v.data_ptr() in seen else v.contiguous()
+            seen.add(v.data_ptr())
+        save_file(state_dict, fname, metadata={k:json.dumps(v) for k,v in spec.items() if k != 'state_dict'})
+    else:
+        torch.save(spec, fname)
+
+def _fused_attention(model):
+    return [(n,m) for n,m in model.named_modules() if isinstance(m, MultiHeadAttention) and (m.qkv or m.kv)]
+
+def fused_state_dict(model):
+    """The `state_dict` of a model converted with `convert_for_eval` as saved by `save_optimized`: without the
+    KV caches and without the attention projections that were merged into the fused layers."""
+    unfused = tuple(f"{n}.{x}." for n,_ in _fused_attention(model) for x in ('query', 'key', 'value'))
+    return {k:v for k,v in model.state_dict().items() if not k.endswith(('.k_cache', '.v_cache')) and not k.startswith(unfused)}
+
+def drop_unfused(model):
+    """Removes the attention projections merged by `convert_for_eval` (to load a `fused_state_dict`)."""
+    for _,m in _fused_attention(model): m.drop_unfused()
+
+def build_model(build, state_dict):
+    """Runs `build()` on the meta device and loads `state_dict` into the result.
+
+    This skips allocating and randomly initializing weights that would be overwritten anyway and the
+    (possibly memory-mapped) tensors from `state_dict` are used directly instead of being copied.
+    Tensors saved in a different dtype are converted to the one the model was built with."""
+    with torch.device('meta'):
+        model = build()
+    dtypes = {k:v.dtype for k,v in model.state_dict().items() if isinstance(v, torch.Tensor)}
+    state_dict = {k:v.to(dtypes[k]) if k in dtypes else v for k,v in state_dict.items()}
+    model.load_state_dict(state_dict, assign=True)
+    # the causal masks are the only buffers that are not saved in the state_dict
+    for m in model.modules():
+        for n,b in m.named_buffers(recurse=False):
+            if b is None or not b.is_meta: continue
+            assert n == 'mask', f"the non-persistent buffer {n} cannot be recreated"
+            m.register_buffer(n, torch.empty(b.shape).fill_(-torch.inf).triu_(1), persistent=False)
+    return model
+
+def _check_compile_cache_support():
+    if not hasattr(torch.compiler, 'save_cache_artifacts'):
+        raise RuntimeError(f"the `torch.compile` cache artifacts need PyTorch 2.7 or newer (you have {torch.__version__})")
+
+def load_compile_cache(fname):
+    """Loads the `torch.compile` artifacts written by `save_compile_cache` (needs PyTorch 2.7 or newer).
+
+    Compiling the same graphs afterwards hits this cache instead of running inductor and autotuning again.
+    Artifacts built with a different PyTorch version or GPU are just cache misses."""
+    _check_compile_cache_support()
+    fname = Path(fname)
+    if not fname.exists(): return False
+    torch.compiler.load_cache_artifacts(fname.read_bytes())
+    return True
+
+def save_compile_cache(fname):
+    """Saves the artifacts of everything compiled in this process so far (run a warmup first)."""
+    _check_compile_cache_support()
+    artifacts = torch.compiler.save_cache_artifacts()
+    if artifacts is None: return False
+    fname = Path(fname)
+    fname.parent.mkdir(parents=True, exist_ok=True)
+    tmp = fname.with_name(fname.name + '.tmp')
+    tmp.write_bytes(artifacts[0])
+    os.replace(tmp, fname)
+    return True
 
 # %% ../nbs/D. Common inference utilities.ipynb 5
 def inference_context():
@@ -60,7 +182,428 @@ def logits_to_probs(logits, T=1.0, top_k=None):
     probs = torch.nn.functional.softmax(logits, dim=-1)
     return probs
 
-def sample(logits, T=1.0, top_k=None):
-    probs = logits_to_probs(logits, T, top_k)
-    idx_next = multinomial_sample_one_no_sync(probs)
-    return idx_next
+def _fmix32(h):
+    # the murmur3 finalizer, `h` holds 32-bit values in int64
+    h = h ^ (h >> 16)
+    h = (h * 0x85EBCA6B) & 0xFFFFFFFF
+    h = h ^ (h >> 13)
+    h = (h * 0xC2B2AE35) & 0xFFFFFFFF
+    return h ^ (h >> 16)
+
+def gumbel_noise(seeds, steps, idxs):
+    """Gumbel noise for the token ids `idxs` ([bs, ..., n]) that only depends on the per-row `seeds`, the decoding
+    `steps` (per row or shared), the position in the middle dimensions (e.g. the S2A quantizer) and the token id.
+
+    Being a counter-based RNG it gives the same noise for a request no matter what else is in the batch."""
+    bs, n = idxs.shape[0], idxs.shape[-1]
+    flat = idxs.reshape(bs, -1, n)
+    slices = torch.arange(flat.shape[1], device=idxs.device)
+    row = _fmix32((seeds.view(-1, 1) * 0x9E3779B1 + steps.view(-1, 1) * 0x85EBCA77 + slices) & 0xFFFFFFFF)
+    h = _fmix32((row.unsqueeze(-1) * 0xC2B2AE3D + flat) & 0xFFFFFFFF)
+    u = ((h >> 8).float() + 0.5) / 2**24 # 24 bits so it stays strictly inside (0, 1) in float32
+    return -torch.log(-torch.log(u)).view(idxs.shape)
+
+def sample(logits, T=1.0, top_k=None, top_p=None, seeds=None, steps=None):
+    """Samples a token id from the last dimension of `logits` with temperature `T` and top-k / top-p filtering.
+
+    We use the Gumbel-max trick on the (top-k) candidates: add Gumbel noise to the scaled logits and take the
+    argmax. So there is no softmax and no masked copy of the full vocabulary. With `seeds` (one per row)
+    the noise comes from `gumbel_noise` keyed by `steps`, otherwise from the global torch RNG."""
+    logits = logits.float() / max(T, 1e-5)
+    idxs = None
+    if top_k is not None and top_k < logits.shape[-1]:
+        logits, idxs = torch.topk(logits, top_k)
+    if top_p is not None:
+        if idxs is None: logits, idxs = torch.sort(logits, descending=True)
+        # keep the smallest prefix of the sorted candidates with a total probability of at least `top_p`
+        probs = logits.softmax(-1)
+        logits = logits.masked_fill(probs.cumsum(-1) - probs > top_p, -torch.inf)
+    if seeds is not None:
+        if idxs is None: idxs = torch.arange(logits.shape[-1], device=logits.device).expand(logits.shape)
+        noise = gumbel_noise(seeds, steps, idxs)
+    else:
+        noise = -torch.empty_like(logits).exponential_(1).log()
+    idx_next = torch.argmax(logits + noise, dim=-1, keepdim=True)
+    if idxs is not None: idx_next = idxs.gather(-1, idx_next)
+    return idx_next.to(dtype=torch.int)
+
+# %% ../nbs/D. Common inference utilities.ipynb 6
+class EncoderCache:
+    """A bounded LRU cache of per-request encoder outputs (and the cross-attention keys and values derived from them).
+
+    Every entry is a tuple of tensors without the batch dimension."""
+    def __init__(self, size=32):
+        self.size = size
+        self.entries = OrderedDict()
+        self.hits = self.misses = 0
+
+    @staticmethod
+    def key(*args):
+        h = hashlib.sha1()
+        def update(x):
+            if isinstance(x, dict):
+                for k in sorted(x): h.update(k.encode()); update(x[k])
+            elif isinstance(x, torch.Tensor):
+                h.update(str((x.dtype, tuple(x.shape))).encode())
+                h.update(x.detach().cpu().contiguous().view(-1).view(torch.uint8).numpy().tobytes())
+            elif isinstance(x, np.ndarray):
+                h.update(np.ascontiguousarray(x).tobytes())
+            else:
+                h.update(repr(x).encode())
+        for x in args: update(x)
+        return h.hexdigest()
+
+    def lookup(self, keys, compute):
+        """Returns the entries for `keys` stacked into batches.
+
+        `compute(idxs)` is called once with the indices of all the missing keys and has to return their entries."""
+        missing = [i for i,k in enumerate(keys) if k not in self.entries]
+        self.misses += len(missing)
+        self.hits += len(keys) - len(missing)
+        found = {i:self.entries[k] for i,k in enumerate(keys) if k in self.entries}
+        if missing:
+            found.update(zip(missing, compute(missing)))
+        for i,k in enumerate(keys):
+            self.entries[k] = found[i]
+            self.entries.move_to_end(k)
+        while len(self.entries) > self.size: self.entries.popitem(last=False)
+        return [torch.stack(xs) for xs in zip(*[found[i] for i in range(len(keys))])]
+
+    def clear(self):
+        self.entries.clear()
+
+class BatchBuckets:
+    """Rounds batch sizes up to a few fixed `sizes` so a compiled decoding graph can be reused for many batches.
+
+    The default sizes are the powers of two up to `max_batch_size` (and `max_batch_size` itself). `hits` counts
+    batches run with a size that was used before and `misses` the first batch of every size (when it is compiled)."""
+    def __init__(self, max_batch_size, sizes=None):
+        if sizes is None: sizes = [2**i for i in range(max_batch_size.bit_length()) if 2**i < max_batch_size]
+        self.sizes = sorted(set(x for x in sizes if x <= max_batch_size) | {max_batch_size})
+        self.used = set()
+        self.hits = self.misses = 0
+
+    def __call__(self, n):
+        size = next(x for x in self.sizes if x >= n)
+        if size in self.used:
+            self.hits += 1
+        else:
+            self.misses += 1
+            self.used.add(size)
+        return size
+
+class LengthBuckets(BatchBuckets):
+    """Rounds the number of KV cache positions read in a decoding step up to a few fixed `sizes`.
+
+    The default sizes are the powers of two from 64 up to `max_len` (and `max_len` itself)."""
+    def __init__(self, max_len, sizes=None):
+        if sizes is None: sizes = [2**i for i in range(6, max_len.bit_length())]
+        super().__init__(max_len, sizes)
+
+def allow_recompiles(*buckets):
+    # every combination of the bucket sizes gets its own compiled graph (and we call the decoding step in a few
+    # different ways, e.g. with and without `seeds`), so we make sure dynamo does not give up recompiling
+    n = 4
+    for b in buckets:
+        if b is not None: n *= len(b.sizes)
+    cfg = torch._dynamo.config
+    name = 'recompile_limit' if hasattr(cfg, 'recompile_limit') else 'cache_size_limit'
+    setattr(cfg, name, max(getattr(cfg, name), n))
+
+# %% ../nbs/D. Common inference utilities.ipynb 7
+class InferenceMixin:
+    """The inference setup shared by the T2S and S2A models (they implement `convert_for_eval` and `switch_dtypes`)."""
+    def save_optimized(self, fname, dtype=torch.float16):
+        """Saves the model already converted for inference and cast to `dtype`.
+
+        `load_model` builds the fused layers directly from this file so `optimize` only has to
+        allocate the KV caches."""
+        if not self.converted_for_eval: self.convert_for_eval()
+        self.switch_dtypes(dtype)
+        save_spec(dict(config = self.__stored_args__,
+                       tunables = dataclasses.asdict(self.tunables),
+                       inference_dtype = str(dtype).split('.')[-1],
+                       state_dict = fused_state_dict(self)), fname)
+
+    def prepare_for_inference(self, max_batch_size, max_seq_len, max_cross_seq_len, dtype=None, torch_compile=True,
+                              encoder_cache_size=0, quantize=False, window=None, kv_block_size=None, kv_blocks=None,
+                              batch_buckets=None, kv_len_buckets=None, fused_decode=False):
+        """The part of `optimize` that does not depend on the model.
+
+        `dtype` defaults to float16 on GPUs and bfloat16 (if supported) or float32 on CPUs. With `quantize`
+        the linear layers are converted to int8 dynamic quantization and the rest stays in float32 (CPU only).
+
+        With `kv_block_size` the decoder uses a paged KV cache (see `BaseDecoder.setup_kv_cache`).
+
+        With `torch_compile` the continuous batchers pad their batches to one of the `batch_buckets` sizes
+        (powers of two by default, see `BatchBuckets`) so they only need a few compiled graphs. Decoding steps
+        only attend to the filled part of the KV cache, with `torch_compile` its length is rounded up to one
+        of the `kv_len_buckets` (see `LengthBuckets`).
+
+        With `fused_decode` the single token decoding steps run through `BaseDecoder.decode_one` which
+        launches fewer kernels (see `benchmark_fused_decode` for a parity check and timings)."""
+        if quantize:
+            assert self.device.type == 'cpu', "int8 dynamic quantization is only supported on the CPU"
+            dtype = torch.float32
+        if dtype is None: dtype = self.dtype if self.converted_for_eval else get_inference_dtype(self.device)
+        if not self.converted_for_eval: self.convert_for_eval()
+        self.decoder.setup_kv_cache(max_batch_size, max_seq_len, max_cross_seq_len, window=window,
+                                    kv_block_size=kv_block_size, kv_blocks=kv_blocks)
+        self.switch_dtypes(dtype)
+        if quantize: quantize_linears(self)
+        self.decoder.fused_decode = fused_decode and self.decoder.can_fuse_decode()
+        self.encoder_cache = EncoderCache(encoder_cache_size) if encoder_cache_size else None
+        self.batch_buckets = BatchBuckets(max_batch_size, batch_buckets) if torch_compile else None
+        self.decoder.kv_len_buckets = LengthBuckets(max_seq_len, kv_len_buckets) if torch_compile and not window else None
+        if torch_compile: allow_recompiles(self.batch_buckets, self.decoder.kv_len_buckets)
+
+class S2AGenerationMixin(InferenceMixin):
+    """The inference code shared by the S2A model variants.
+
+    They differ in how the encoder is conditioned on the speaker (see `speaker_conds`), which of the
+    decoding functions `optimize` compiles (`compiled_for_inference`) and they pass in the `batcher_class`
+    used by `generate_batch` (`batching.S2ABatcher`, which depends on this module)."""
+    compiled_for_inference = ('generate_next',)
+    batcher_class = None
+
+    def speaker_conds(self, speakers):
+        """Returns the encoder conditioning for a batch of speaker embeddings (passed to `encode_to_kv_cache`)."""
+        return speakers
+
+    def convert_for_eval(self):
+        """Fuses the attention projections and merges the embeddings for inference (done by `optimize`)."""
+        self.embds.convert_for_eval()
+        for l in self.encoder:
+            l.attn.convert_for_eval()
+        for l in self.decoder.layers:
+            l.attn.convert_for_eval()
+            l.cross_attn.convert_for_eval()
+        self.converted_for_eval = True
+        return self
+
+    def optimize(self, max_batch_size=1, dtype=None, torch_compile=True, encoder_cache_size=0, quantize=False, window=None,
+                 kv_block_size=None, kv_blocks=None, batch_buckets=None, kv_len_buckets=None, fused_decode=False):
+        """Prepares the model for fast inference (see `prepare_for_inference` for the arguments).
+
+        With `window` the decoder self-attention only looks at the last `window` acoustic token columns and
+        uses a ring buffer KV cache of that size. `generate` is then no longer limited to `ctx_n` and slides
+        the encoder over longer semantic token sequences."""
+        self.prepare_for_inference(max_batch_size, self.ctx_n, self.stoks_len, dtype=dtype, torch_compile=torch_compile,
+                                   encoder_cache_size=encoder_cache_size, quantize=quantize, window=window,
+                                   kv_block_size=kv_block_size, kv_blocks=kv_blocks, batch_buckets=batch_buckets,
+                                   kv_len_buckets=kv_len_buckets, fused_decode=fused_decode)
+        if torch_compile:
+            for name in self.compiled_for_inference:
+                setattr(self, name, torch.compile(getattr(self, name), mode="reduce-overhead", fullgraph=True))
+
+    def encode_to_kv_cache(self, Stoks, conds, rows=None, offset=0):
+        """Runs the encoder and stores the cross-attention keys and values in the decoder KV cache `rows`
+        (by default the first rows, one per sequence).
+
+        With `optimize(encoder_cache_size=...)` the results are cached per (stoks, speaker) so revoicing
+        the same semantic tokens skips the encoder and the cross-attention projections.
+
+        `offset` is the position of `Stoks` inside a longer sequence (used with the sliding window)."""
+        if rows is None: rows = slice(0, Stoks.shape[0])
+        if self.encoder_cache is None:
+            xenc, positions, _ = self.run_encoder(Stoks, conds)
+            self.decoder.fill_cross_kv_cache(xenc, positions, rows, offset)
+            return xenc, positions
+
+        def compute(idxs):
+            selected = conds[torch.tensor(idxs, device=Stoks.device)] if torch.is_tensor(conds) else [conds[i] for i in idxs]
+            xenc, positions, _ = self.run_encoder(Stoks[torch.tensor(idxs, device=Stoks.device)], selected)
+            return list(zip(xenc, *self.decoder.cross_kv(xenc, positions, offset)))
+        keys = [self.encoder_cache.key(*x, offset) for x in zip(Stoks, conds)]
+        xenc, *kvs = self.encoder_cache.lookup(keys, compute)
+        positions = torch.arange(0, Stoks.shape[1], device=Stoks.device)
+        self.decoder.store_cross_kv(kvs, positions, rows)
+        return xenc, positions
+
+    def generate_one(self, toks, positions, langs, xenc, xenc_positions, T, top_k, seeds=None):
+        probs = self(None, toks, None, langs, noloss=True, xenc=xenc, xenc_positions=xenc_positions, atoks_positions=positions)
+        probs = probs[:,:,-1]
+        return sample(probs, T, top_k, seeds=seeds, steps=positions[...,-1])
+
+    def prefill(self, *args, **kwargs):
+        return self.generate_one(*args, **kwargs)
+
+    def generate_next(self, *args, **kwargs):
+        return self.generate_one(*args, **kwargs)
+
+    def _generate_steps(self, stoks, speakers, langs, atoks_prompt, N, bs, T, top_k, show_progress_bar, step, jacobi_window=None, seed=None):
+        # yields the (delayed) token buffer and the index of the column that was just sampled
+        dev = self.device
+        end = self._last_column(N)
+        stoks = F.pad(stoks.to(dev), (1, max(self.stoks_len - len(stoks) - 1, 0)), value=self.stoks_codes-1).unsqueeze(0)
+        speakers = speakers.to(device=dev, dtype=self.dtype)
+        toks = torch.full((bs,self.quantizers,max(self.ctx_n, end+1)), self.codes+1, dtype=torch.long, device=dev)
+        T = torch.tensor(T, device=dev)
+        seeds = None if seed is None else seed + torch.arange(bs, device=dev)
+
+        start = 0 # number of valid tokens or the index of first empty spot
+        if atoks_prompt is not None:
+            start = atoks_prompt.shape[-1]
+            for i in range(self.quantizers):
+                toks[:,i,1+i:start+i+1] = atoks_prompt[:,i]
+        start += 1 # we always start with at least an SOT
+
+        with record_function("encode"):
+            stoks, speakers = [x.repeat(bs, 1) for x in (stoks, speakers)]
+            # the cross-attention keys and values are computed once here and only read from the cache later
+            offset = 0
+            def encode(offset):
+                self.encode_to_kv_cache(stoks[:,offset:offset+self.stoks_len], self.speaker_conds(speakers), offset=offset)
+            encode(offset)
+            toks_positions = torch.arange(end, device=dev)
+            sliding = self.decoder.layers[0].attn.window is not None
+            if sliding and jacobi_window:
+                # the ring buffer only has room for that many new positions per forward pass
+                attn = self.decoder.layers[0].attn
+                slack = attn.k_cache.shape[2] - attn.window
+                assert jacobi_window <= slack, f"jacobi_window ({jacobi_window}) is larger than the KV cache slack of the sliding window ({slack})"
+            if sliding:
+                for m in self.modules():
+                    if isinstance(m, Rotary): m.extend(max(end, 3 * stoks.shape[1]))
+
+        def slide(i):
+            # with the sliding window we re-encode the semantic tokens when the generated audio gets close
+            # to the end of the encoded part (stoks run 3x slower than the atoks), returns the column of
+            # the next re-encoding
+            nonlocal offset
+            if not sliding or offset + self.stoks_len >= stoks.shape[1]: return end
+            if i // 3 > offset + self.stoks_len * 3 // 4:
+                offset = min(i // 3 - self.stoks_len // 4, stoks.shape[1] - self.stoks_len)
+                with record_function("encode"):
+                    encode(offset)
+            if offset + self.stoks_len >= stoks.shape[1]: return end
+            return 3 * (offset + self.stoks_len * 3 // 4 + 1)
+        with self.decoder.reserved_kv_cache(bs):
+            with record_function("prefill"):
+                assert not sliding or start <= self.decoder.layers[0].attn.k_cache.shape[2], "the prompt is longer than the KV cache"
+                self.decoder.set_kv_len(start)
+                initial = self.prefill(toks[:,:,:start], toks_positions[:start], langs, None, None, T, top_k, seeds=seeds)
+                toks[:,:start,start:start+1] = initial[:,:start]
+            yield toks, start
+            start += 1
+
+            with inference_context():
+                if jacobi_window:
+                    yield from self._jacobi_steps(toks, start, end, langs, T, top_k, jacobi_window, step, slide, seeds)
+                    return
+
+                it = range(start,end)
+                if show_progress_bar: it = progress_bar(it)
+
+                for i in it:
+                    slide(i)
+                    with record_function("generate_one"):
+                        self.decoder.set_kv_len(i)
+                        toks[:,:i,i:i+1] = self.generate_next(toks[:,:,i-1:i], toks_positions[i-1:i], langs, None, None, T, top_k, seeds=seeds)[:,:i]
+
+                    # for profiling, debugging or early exit
+                    if step is not None: step()
+                    yield toks, i
+
+    def _jacobi_steps(self, toks, start, end, langs, T, top_k, window, step, slide=None, seeds=None):
+        # Jacobi decoding: we run the next `window` columns through the model at once, using the previous
+        # predictions as guesses for the inputs, and keep the columns whose inputs were guessed correctly.
+        # The sampling noise is fixed per column so the predictions converge to exactly what sequential
+        # sampling with the same noise would give. With `seeds` the noise comes from `gumbel_noise`
+        # which is keyed by the column so the result is the same as the sequential loop. Without them we draw
+        # the noise for the whole window at once which is only distributed like the sequential draws.
+        positions = torch.arange(end, device=toks.device)
+        quantizer_ids = torch.arange(self.quantizers, device=toks.device).unsqueeze(1)
+        def draw_noise(n, like):
+            # drawn column by column so the noise of each column does not depend on the window size
+            return torch.empty((n, *like.shape[:2], like.shape[-1]), device=like.device).exponential_(1).permute(1,2,0,3)
+
+        noise = None
+        i = start
+        while i < end:
+            # we stop the window at the column where the encoder slides to get the same results as `generate`
+            w = min(window, (slide(i) if slide else end) - i)
+            with record_function("jacobi_step"):
+                self.decoder.set_kv_len(i+w-1)
+                logits = self(None, toks[:,:,i-1:i+w-1], None, langs, noloss=True, atoks_positions=positions[i-1:i+w-1])
+                if seeds is not None:
+                    preds = torch.cat([sample(logits[:,:,j], T, top_k, seeds=seeds, steps=positions[i-1+j])
+                                       for j in range(w)], dim=-1).to(torch.long)
+                else:
+                    probs = logits_to_probs(logits.float(), T, top_k)
+                    if noise is None: noise = draw_noise(window, probs)
+                    preds = torch.argmax(probs / noise[:,:,:w], dim=-1)
+                # the delay pattern: quantizer j only starts in column j+1
+                guesses = toks[:,:,i:i+w]
+                preds = torch.where(quantizer_ids < positions[i:i+w], preds, guesses)
+                # column i is always correct, every following one only if all the guesses before it were
+                matches = (preds == guesses).flatten(end_dim=1).all(0)[:-1].tolist() + [False]
+                accepted = matches.index(False) + 1
+                toks[:,:,i:i+w] = preds
+            if seeds is None: noise = torch.cat([noise[:,:,accepted:], draw_noise(accepted, probs)], dim=2)
+            i += accepted
+
+            # for profiling, debugging or early exit
+            if step is not None: step()
+            yield toks, i-1
+
+    def _last_column(self, N):
+        # the index of the column after the last one we generate
+        if self.decoder.layers[0].attn.window: return N
+        return min(N, self.ctx_n-1)
+
+    def _undelay(self, toks, start, end):
+        # quantizer j of frame t is stored in column t+1+j of the delayed buffer
+        return torch.stack([toks[:,j,start+1+j:end+1+j] for j in range(self.quantizers)], dim=1)
+
+    @torch.no_grad()
+    def generate(self, stoks, speakers, langs=None, atoks_prompt=None, N=None, bs=1, T=0.7, top_k=None, show_progress_bar=True, step=None, subsample_enc=False,
+                 jacobi_window=None, seed=None):
+        """Generates acoustic tokens for `stoks`.
+
+        With `jacobi_window` set we decode that many columns per forward pass using Jacobi iteration
+        (see `_jacobi_steps`), which can take several steps at once when the model is confident. With a `seed`
+        the tokens are the same as with the sequential loop, without it they only follow the same distribution.
+
+        With an integer `seed` the sampling is deterministic: row `j` of the batch uses the seed `seed+j` and
+        does not depend on the global torch RNG."""
+        N = N or len(stoks) * 3
+        for toks, _ in self._generate_steps(stoks, speakers, langs, atoks_prompt, N, bs, T, top_k, show_progress_bar, step, jacobi_window, seed):
+            pass
+        # shift tokens
+        toks = toks[:,:,1:N]
+        for j in range(self.quantizers):
+            toks[:, j] = torch.roll(toks[:, j], -j)
+        return toks[:,:,:N-4]
+
+    @torch.no_grad()
+    def generate_stream(self, stoks, speakers, langs=None, atoks_prompt=None, N=None, bs=1, T=0.7, top_k=None, chunk=25, show_progress_bar=False, step=None,
+                        jacobi_window=None, seed=None):
+        """Yields the acoustic tokens in chunks of `chunk` frames as soon as all quantizers of a frame are sampled.
+        
+        The chunks concatenated along the last dimension match the output of `generate`."""
+        N = N or len(stoks) * 3
+        done, total = 0, self._last_column(N) - self.quantizers
+        for toks, i in self._generate_steps(stoks, speakers, langs, atoks_prompt, N, bs, T, top_k, show_progress_bar, step, jacobi_window, seed):
+            ready = min(i - self.quantizers + 1, total)
+            if ready - done >= chunk:
+                yield self._undelay(toks, done, ready)
+                done = ready
+        if total > done: yield self._undelay(toks, done, total)
+
+    @torch.no_grad()
+    def generate_batch(self, stoks, speakers, atoks_prompt=None, T=0.7, top_k=None, show_progress_bar=True, seed=None):
+        """Generates acoustic tokens for a list of semantic token sequences of different lengths.
+
+        `speakers` is a single speaker embedding or one embedding per sequence. Every row stops at its own
+        target length (3 acoustic frames per semantic token) and finished rows are compacted out of the batch,
+        freeing their KV cache rows for the remaining sequences. Returns a list in the order of `stoks`.
+
+        The optional `atoks_prompt` is shared by all rows and, like in `generate`, has to be covered by `stoks`.
+        With an integer `seed` sequence `j` uses the seed `seed+j`, so it gets the same tokens as `generate(seed=seed+j)`."""
+        if isinstance(speakers, torch.Tensor) and (speakers.dim() == 1 or len(speakers) == 1):
+            speakers = speakers.reshape(1, -1).expand(len(stoks), -1)
+        batcher = self.batcher_class(self, T=T, top_k=top_k)
+        futs = [batcher.submit(x, spk, atoks_prompt, seed=None if seed is None else seed + j)
+                for j, (x, spk) in enumerate(zip(stoks, speakers))]
+        return batcher.run_until_done(futs, show_progress_bar=show_progress_bar)
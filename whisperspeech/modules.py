@@ -1,8 +1,9 @@
 # AUTOGENERATED! DO NOT EDIT! File to edit: ../nbs/A. Neural modules.ipynb.
 
 # %% auto 0
-__all__ = ['LayerNorm', 'LinearHead', 'QueryHead', 'init_transformer', 'sinusoids', 'MultiHeadAttention',
-           'ResidualAttentionBlock', 'BaseDecoder', 'EmbeddingProjector', 'FlexEmbeddings']
+__all__ = ['LayerNorm', 'LinearHead', 'QueryHead', 'init_transformer', 'sinusoids', 'KVBlockAllocator', 'MultiHeadAttention',
+           'Rotary', 'rotate_half', 'rope_rotate', 'ResidualAttentionBlock', 'BaseDecoder', 'EmbeddingProjector',
+           'FlexEmbeddings']
 
 # %% ../nbs/A. Neural modules.ipynb 2
 import torch
@@ -12,6 +13,7 @@ import math
 from torch import Tensor, nn
 import torch.nn.functional as F
 from typing import Dict, Iterable, Optional
+from contextlib import contextmanager
 
 # import xformers.ops as xops
 
@@ -52,6 +54,51 @@ def sinusoids(length, channels, max_timescale=10000):
     return torch.cat([torch.sin(scaled_time), torch.cos(scaled_time)], dim=1)
 
 # %% ../nbs/A. Neural modules.ipynb 5
+class KVBlockAllocator:
+    """Hands out fixed-size KV cache blocks from a shared pool to the rows of a batch.
+
+    All the layers of a decoder share one allocator: a row uses the same block ids in every layer's pool.
+    Block 0 is never handed out so unallocated entries of the block tables can safely point to it."""
+    def __init__(self, num_blocks, block_size, max_batch_size, max_seq_len, device=None):
+        self.num_blocks = num_blocks
+        self.block_size = block_size
+        self.max_batch_size = max_batch_size
+        self.max_seq_len = max_seq_len
+        self.block_tables = torch.zeros((max_batch_size, -(-max_seq_len // block_size)), dtype=torch.long, device=device)
+        self.free_blocks = list(range(num_blocks - 1, 0, -1))
+        self.row_blocks = [[] for _ in range(max_batch_size)]
+        self.n_blocks = 0 # the largest number of blocks used by any row
+
+    def reserve(self, lengths):
+        """Makes sure the first `len(lengths)` rows have blocks for `lengths[i]` positions."""
+        updates = []
+        for row, length in enumerate(lengths):
+            blocks = self.row_blocks[row]
+            need = -(-min(length, self.max_seq_len) // self.block_size) - len(blocks)
+            if need <= 0: continue
+            if need > len(self.free_blocks): raise RuntimeError("out of KV cache blocks, please pass in a larger `kv_blocks`")
+            for _ in range(need):
+                updates.append((row, len(blocks), self.free_blocks[-1]))
+                blocks.append(self.free_blocks.pop())
+        if updates:
+            rows, idxs, blocks = zip(*updates)
+            self.block_tables[list(rows), list(idxs)] = torch.tensor(blocks, device=self.block_tables.device)
+            self.n_blocks = max(self.n_blocks, max(len(x) for x in self.row_blocks))
+
+    def free(self, rows):
+        for row in rows:
+            self.free_blocks += reversed(self.row_blocks[row])
+            self.row_blocks[row] = []
+            self.block_tables[row] = 0
+        self.n_blocks = max(len(x) for x in self.row_blocks)
+
+    def reorder(self, rows):
+        """Moves the block tables of `rows` to the front, the other rows have to be freed first."""
+        rows = [int(x) for x in rows]
+        self.block_tables[:len(rows)] = self.block_tables[rows]
+        self.block_tables[len(rows):] = 0
+        self.row_blocks = [self.row_blocks[i] for i in rows] + [[] for _ in range(self.max_batch_size - len(rows))]
+
 class MultiHeadAttention(nn.Module):
     def __init__(self, n_state: int, n_head: int, qk_scale: float = 1, rope: bool = False, cross=False):
         super().__init__()
@@ -66,9 +113,11 @@ class MultiHeadAttention(nn.Module):
         self.query_subsampling = 1
         self.key_subsampling = 1
 
-        self.cached_kvx = None
         self.register_buffer('k_cache', None)
         self.register_buffer('v_cache', None)
+        self.window = None
+        self.allocator = None
+        self.kv_len = None # with a KV cache only read the first `kv_len` positions (see `BaseDecoder.set_kv_len`)
         
         self.rotary = None
         if rope:
@@ -76,10 +125,34 @@ class MultiHeadAttention(nn.Module):
         self.qkv = None
         self.kv = None
 
-    def setup_kv_cache(self, max_batch_size, max_seq_len, dtype=torch.float32):
+    def setup_kv_cache(self, max_batch_size, max_seq_len, dtype=torch.float32, window=None, window_slack=64, allocator=None):
+        """Allocates the KV cache.
+
+        With `window` the cache becomes a ring buffer and every query only attends to the last `window` positions
+        (including itself), so the sequence length is not limited by the cache size. The ring buffer has
+        `window_slack` extra entries so we can process that many new positions in one forward pass without
+        overwriting keys that are still visible to the earlier ones.
+
+        With an `allocator` (a `KVBlockAllocator`) we allocate a pool of blocks instead and every row
+        only uses as many of them as it needs."""
+        self.window = window
+        self.allocator = allocator
+        assert not (window and allocator), "the sliding window cannot be combined with the paged KV cache"
+        if window: max_seq_len = window + window_slack
         cache_shape = (max_batch_size, self.n_head, max_seq_len, self.n_state//self.n_head)
-        self.k_cache = torch.zeros(cache_shape, dtype=dtype, device=self.key.weight.device)
-        self.v_cache = torch.zeros(cache_shape, dtype=dtype, device=self.value.weight.device)
+        if allocator: cache_shape = (allocator.num_blocks, self.n_head, allocator.block_size, self.n_state//self.n_head)
+        device = self.out.weight.device
+        self.k_cache = torch.zeros(cache_shape, dtype=dtype, device=device)
+        self.v_cache = torch.zeros(cache_shape, dtype=dtype, device=device)
+        # the position stored in each slot of the ring buffer (not a buffer to keep it out of `switch_dtypes`)
+        self.kv_slot_positions = torch.full((max_batch_size, max_seq_len), -1, device=device) if window else None
+
+    def reorder_kv_cache(self, rows):
+        """Moves the cache `rows` to the front (used to compact the batch after some sequences finished)."""
+        if self.allocator: return # the allocator just reorders the block tables
+        self.k_cache[:len(rows)] = self.k_cache[rows]
+        self.v_cache[:len(rows)] = self.v_cache[rows]
+        if self.window: self.kv_slot_positions[:len(rows)] = self.kv_slot_positions[rows]
 
     def merge_linears(self, layers, mults):
         bias = [x.bias for x in layers if x.bias is not None][0]
@@ -101,6 +174,11 @@ class MultiHeadAttention(nn.Module):
         else:
             self.qkv = self.merge_linears([self.query, self.key, self.value],
                                           [self.sqrt_qk_scale, self.sqrt_qk_scale, 1])
+
+    def drop_unfused(self):
+        """Removes the projections merged by `convert_for_eval`, inference only uses the fused ones."""
+        if not (self.qkv or self.kv): raise AttributeError("not converted yet")
+        self.query = self.key = self.value = None
         
     def split_heads(self, x, x_positions, rope=False, subsampling=1):
         x = x.view(*x.shape[:2], self.n_head, -1)
@@ -108,6 +186,66 @@ class MultiHeadAttention(nn.Module):
             x = rope_rotate(x, x_positions * subsampling, *self.rotary(x))
         return x.permute(0, 2, 1, 3)
 
+    def store_kv(self, k, v, kv_positions, rows=slice(None)):
+        if self.allocator:
+            bs = self.allocator.block_size
+            rows = torch.arange(k.shape[0], device=k.device).unsqueeze(1)
+            if kv_positions.dim() == 1: kv_positions = kv_positions.unsqueeze(0)
+            blocks = self.allocator.block_tables[rows, kv_positions // bs]
+            self.k_cache[blocks,:,kv_positions % bs] = k.transpose(1,2)
+            self.v_cache[blocks,:,kv_positions % bs] = v.transpose(1,2)
+            return
+        slots = kv_positions
+        if self.window: slots = kv_positions % self.k_cache.shape[2]
+        if kv_positions.dim() == 2: # separate positions for every row
+            rows = torch.arange(k.shape[0], device=k.device).unsqueeze(1)
+            self.k_cache[rows,:,slots] = k.transpose(1,2)
+            self.v_cache[rows,:,slots] = v.transpose(1,2)
+        else:
+            self.k_cache[rows,:,slots] = k
+            self.v_cache[rows,:,slots] = v
+        if self.window: self.kv_slot_positions[rows,slots] = kv_positions
+
+    def paged_kv(self, bs):
+        # gathers the blocks of the first `bs` rows into contiguous keys and values: `scaled_dot_product_attention`
+        # cannot read them from the pool so every step copies the filled part of the cache of every layer (the
+        # same amount of memory it reads afterwards, see `benchmark_paged_kv` for how much time it costs)
+        # so we only take the blocks up to `kv_len` or, without it, the blocks held by these rows
+        if self.kv_len:
+            n_blocks, length = -(-self.kv_len // self.allocator.block_size), self.kv_len
+        else:
+            n_blocks, length = max(len(x) for x in self.allocator.row_blocks[:bs]), self.allocator.max_seq_len
+        blocks = self.allocator.block_tables[:bs,:n_blocks]
+        def gather(cache):
+            x = cache[blocks].transpose(1,2)
+            return x.reshape(*x.shape[:2], -1, x.shape[-1])[:,:,:length]
+        return gather(self.k_cache), gather(self.v_cache)
+
+    def window_mask(self, q_positions, bs, dtype):
+        # allow the slots holding one of the last `window` positions before each query
+        slot_positions = self.kv_slot_positions[:bs].unsqueeze(1)
+        if q_positions.dim() == 1: q_positions = q_positions.unsqueeze(0)
+        dist = q_positions.unsqueeze(-1) - slot_positions
+        allowed = (slot_positions >= 0) & (dist >= 0) & (dist < self.window)
+        mask = torch.zeros(allowed.shape, dtype=dtype, device=allowed.device).masked_fill(~allowed, -torch.inf)
+        return mask.unsqueeze(1) # broadcast over the heads
+
+    def project_kv(self, kvx, kv_positions):
+        if self.kv:
+            k,v = self.kv(kvx).split(self.odim, dim=-1)
+        else:
+            k,v = self.key(kvx) * self.sqrt_qk_scale, self.value(kvx)
+        k = self.split_heads(k, kv_positions, rope = self.rotary, subsampling = self.key_subsampling)
+        v = self.split_heads(v, kv_positions)
+        return k, v
+
+    def fill_kv_cache(self, kvx, kv_positions, rows=slice(None), offset=0):
+        """Projects `kvx` into keys and values and stores them in the cache `rows`.
+
+        Afterwards you can pass `kvx=None` to `forward` to attend to the cached values. The keys are rotated
+        as if they were at `kv_positions + offset` (for RoPE) but are stored at `kv_positions`."""
+        self.store_kv(*self.project_kv(kvx, kv_positions + offset), kv_positions, rows)
+
     def forward(
         self,
         qx,
@@ -118,32 +256,41 @@ class MultiHeadAttention(nn.Module):
         mask=None,
     ):
         if self.k_cache is not None:
-            assert qx.shape[0] <= self.k_cache.shape[0], "please pass in a larger max_batch_size to setup_kv_cache"
+            max_batch_size = self.allocator.max_batch_size if self.allocator else self.k_cache.shape[0]
+            assert qx.shape[0] <= max_batch_size, "please pass in a larger max_batch_size to setup_kv_cache"
         if self.qkv:
             q,k,v = self.qkv(qx).split(self.odim, dim=-1)
         elif self.kv:
             q = self.q(qx)
-            k,v = self.kv(kvx).split(self.odim, dim=-1)
+            if kvx is not None: k,v = self.kv(kvx).split(self.odim, dim=-1)
+            else: k,v = None,None
         else:
             q,k,v = None,None,None
         
         if q is None: q = self.query(qx) * self.sqrt_qk_scale
         q = self.split_heads(q, q_positions, rope = self.rotary, subsampling = self.query_subsampling)
 
-        if kvx is not self.cached_kvx:
+        # kvx is None when the keys and values were already put into the cache with `fill_kv_cache`
+        if kvx is not None:
             if k is None: k = self.key(kvx) * self.sqrt_qk_scale
             k = self.split_heads(k, kv_positions, rope = self.rotary, subsampling = self.key_subsampling)
             if v is None: v = self.value(kvx)
             v = self.split_heads(v, kv_positions)
             if self.k_cache is not None:
-                self.k_cache[:k.shape[0],:,kv_positions] = k
-                self.v_cache[:v.shape[0],:,kv_positions] = v
-
-        if self.k_cache is not None:
-            k, v = self.k_cache[:k.shape[0]], self.v_cache[:v.shape[0]]
-
-        if mask is not None:
+                self.store_kv(k, v, kv_positions, slice(None, k.shape[0]))
+
+        if self.allocator:
+            k, v = self.paged_kv(q.shape[0])
+        elif self.k_cache is not None:
+            # the positions after `kv_len` are not filled yet and would be masked out anyway
+            n = self.kv_len if self.kv_len and not self.window else self.k_cache.shape[2]
+            k, v = self.k_cache[:q.shape[0],:,:n], self.v_cache[:q.shape[0],:,:n]
+
+        if self.window:
+            mask = self.window_mask(q_positions, q.shape[0], q.dtype)
+        elif mask is not None:
             mask = mask[q_positions,:k.shape[-2]]
+            if q_positions.dim() == 2: mask = mask.unsqueeze(1) # broadcast over the heads
             
         wv = F.scaled_dot_product_attention(q, k, v, attn_mask=mask, dropout_p=0, is_causal=causal)
         
@@ -157,6 +304,7 @@ import torch
 class Rotary(torch.nn.Module):
     def __init__(self, dim, base=10000):
         super().__init__()
+        self.dim, self.base = dim, base
         inv_freq = 1.0 / (base ** (torch.arange(0, dim, 2).float() / dim))
         self.register_buffer("inv_freq", inv_freq)
         self.seq_len_cached = 2500
@@ -166,6 +314,18 @@ class Rotary(torch.nn.Module):
         emb = torch.cat((freqs, freqs), dim=-1)
         self.register_buffer('cos_cached', emb.cos()[None, :, None, :])
         self.register_buffer('sin_cached', emb.sin()[None, :, None, :])
+
+    def extend(self, seq_len):
+        """Makes sure we have the rotations for the first `seq_len` positions."""
+        if seq_len <= self.seq_len_cached: return
+        self.seq_len_cached = seq_len
+        # inv_freq may have been converted to float16 so we recompute it
+        inv_freq = 1.0 / (self.base ** (torch.arange(0, self.dim, 2, device=self.inv_freq.device).float() / self.dim))
+        t = torch.arange(seq_len, device=inv_freq.device).type_as(inv_freq)
+        freqs = torch.einsum("i,j->ij", t, inv_freq)
+        emb = torch.cat((freqs, freqs), dim=-1)
+        self.cos_cached = emb.cos()[None, :, None, :].to(self.cos_cached.dtype)
+        self.sin_cached = emb.sin()[None, :, None, :].to(self.sin_cached.dtype)
     
     def forward(self, x, seq_dim=1):
         seq_len = x.shape[seq_dim]
@@ -179,7 +339,11 @@ def rotate_half(x):
     )
 
 def rope_rotate(x, positions, cos, sin):
-    return x * cos[:,positions] + rotate_half(x) * sin[:,positions]
+    if positions.dim() == 2: # separate positions for every row
+        cos, sin = cos[0,positions], sin[0,positions]
+    else:
+        cos, sin = cos[:,positions], sin[:,positions]
+    return x * cos + rotate_half(x) * sin
 
 # %% ../nbs/A. Neural modules.ipynb 7
 class ResidualAttentionBlock(nn.Module):
@@ -200,10 +364,15 @@ class ResidualAttentionBlock(nn.Module):
         )
         self.mlp_ln = LayerNorm(n_state)
     
-    def setup_kv_cache(self, max_batch_size, max_seq_len, max_cross_seq_len=None):
-        self.attn.setup_kv_cache(max_batch_size, max_seq_len)
+    def setup_kv_cache(self, max_batch_size, max_seq_len, max_cross_seq_len=None, window=None, allocator=None):
+        self.attn.setup_kv_cache(max_batch_size, max_seq_len, window=window, allocator=allocator)
         if self.cross_attn:
             self.cross_attn.setup_kv_cache(max_batch_size, max_cross_seq_len)
+
+    def reorder_kv_cache(self, rows):
+        self.attn.reorder_kv_cache(rows)
+        if self.cross_attn:
+            self.cross_attn.reorder_kv_cache(rows)
     
     def forward(
         self,
@@ -222,6 +391,35 @@ class ResidualAttentionBlock(nn.Module):
         x = x + self.mlp(self.mlp_ln(x))
         return x
 
+    def decode_one(self, x, positions, rope, mask):
+        """A decoding step for a single token per row, reading the KV caches (see `BaseDecoder.fused_decode`).
+
+        `rope` are the rotations for `positions` (with the sign of `rotate_half` folded into the sines) and
+        `mask` the attention mask rows, both are computed once for all the layers."""
+        attn, bs = self.attn, x.shape[0]
+        qkv = attn.qkv(self.attn_ln(x)).view(bs, 3, attn.n_head, -1)
+        qk = qkv[:,:2]
+        if rope is not None: # the queries and keys are rotated together
+            qk = qk * rope[0] + qk.roll(qk.shape[-1] // 2, -1) * rope[1]
+        q, k, v = qk[:,0].unsqueeze(2), qk[:,1].unsqueeze(2), qkv[:,2].unsqueeze(2)
+        attn.store_kv(k, v, positions, slice(None, bs))
+        if attn.allocator:
+            k, v = attn.paged_kv(bs)
+        else:
+            n = attn.kv_len or attn.k_cache.shape[2]
+            k, v = attn.k_cache[:bs,:,:n], attn.v_cache[:bs,:,:n]
+        wv = F.scaled_dot_product_attention(q, k, v, attn_mask=mask[...,:k.shape[-2]])
+        x = x + attn.out(wv.view(bs, 1, -1))
+
+        if self.cross_attn:
+            cross = self.cross_attn
+            q = cross.q(self.cross_attn_ln(x)).view(bs, 1, cross.n_head, -1)
+            if rope is not None: q = q * rope[0] + q.roll(q.shape[-1] // 2, -1) * rope[1]
+            wv = F.scaled_dot_product_attention(q.transpose(1,2), cross.k_cache[:bs], cross.v_cache[:bs])
+            x = x + cross.out(wv.view(bs, 1, -1))
+
+        return x + self.mlp(self.mlp_ln(x))
+
 # %% ../nbs/A. Neural modules.ipynb 8
 class BaseDecoder(nn.Module):
     def __init__(self, depth=6, n_head=6, width=384, qk_scale=1, ffn_mult=4, length=2250, rope=False):
@@ -238,8 +436,106 @@ class BaseDecoder(nn.Module):
         
         mask = torch.empty(length, length).fill_(-torch.inf).triu_(1)
         self.register_buffer("mask", mask, persistent=False)
+        self.kv_allocator = None
+        self.kv_growing_rows = 0 # the rows `set_kv_len` reserves the paged KV cache for (see `reserved_kv_cache`)
+        self.kv_len_buckets = None
+        self.fused_decode = False # use `decode_one` for single token steps (set by the models' `optimize`)
+
+    def setup_kv_cache(self, max_batch_size, max_seq_len, max_cross_seq_len=None, window=None, kv_block_size=None, kv_blocks=None):
+        """Allocates the KV caches of all layers.
+
+        With `kv_block_size` the self-attention caches are paged: a pool of `kv_blocks` blocks (by default
+        as much memory as the dense cache) is shared by all the rows and each row takes blocks as it grows.
+        Use `reserve_kv_cache` before decoding (or `reserved_kv_cache`) and `free_kv_cache` when a sequence
+        is finished. The attention layers copy the blocks of the batch into contiguous tensors at every step.
+
+        The cross-attention caches stay dense: they hold the encoder output, which is written once when a
+        request is admitted and is always padded to `max_cross_seq_len` (the fixed text or semantic token
+        context), so every row needs all of its entries and paging them would not save any memory."""
+        if kv_block_size:
+            if kv_blocks is None: kv_blocks = max_batch_size * -(-max_seq_len // kv_block_size) + 1
+            self.kv_allocator = KVBlockAllocator(kv_blocks, kv_block_size, max_batch_size, max_seq_len, self.mask.device)
+        else:
+            self.kv_allocator = None
+        for l in self.layers:
+            l.setup_kv_cache(max_batch_size, max_seq_len, max_cross_seq_len, window=window, allocator=self.kv_allocator)
+
+    def reserve_kv_cache(self, lengths):
+        if self.kv_allocator: self.kv_allocator.reserve(lengths)
+
+    def set_kv_len(self, n):
+        """Makes the self-attention read only the first `n` positions of the KV cache (`None` reads all of them).
+
+        Use it before every decoding step with the number of positions that are filled after it. With
+        `kv_len_buckets` (an `inference.LengthBuckets`) `n` is rounded up so we only need a few compiled graphs."""
+        if n is not None and self.kv_len_buckets: n = self.kv_len_buckets(n)
+        if n is not None and self.kv_growing_rows: self.kv_allocator.reserve([n] * self.kv_growing_rows)
+        for l in self.layers:
+            l.attn.kv_len = n
+
+    def free_kv_cache(self, rows):
+        if self.kv_allocator: self.kv_allocator.free(rows)
+
+    @contextmanager
+    def reserved_kv_cache(self, bs):
+        """Reserves the paged KV cache for the first `bs` rows as they grow and frees it afterwards.
+
+        Inside the block every `set_kv_len(n)` makes sure the rows have blocks for `n` positions, so
+        a sequence that stops early never takes the blocks for its maximum length."""
+        if self.kv_allocator: self.kv_growing_rows = bs
+        try:
+            yield
+        finally:
+            self.kv_growing_rows = 0
+            self.free_kv_cache(range(bs))
+            self.set_kv_len(None)
+
+    def fill_cross_kv_cache(self, xenc, xenc_positions, rows=slice(None), offset=0):
+        for l in self.layers:
+            l.cross_attn.fill_kv_cache(xenc, xenc_positions, rows, offset)
+
+    def cross_kv(self, xenc, xenc_positions, offset=0):
+        """Returns the cross-attention keys and values of all layers as a flat `[k0, v0, k1, v1, ...]` list."""
+        return [x for l in self.layers for x in l.cross_attn.project_kv(xenc, xenc_positions + offset)]
+
+    def store_cross_kv(self, kvs, xenc_positions, rows=slice(None)):
+        for l,k,v in zip(self.layers, kvs[::2], kvs[1::2]):
+            l.cross_attn.store_kv(k, v, xenc_positions, rows)
+
+    def reorder_kv_cache(self, rows):
+        if self.kv_allocator: self.kv_allocator.reorder(rows.tolist())
+        for l in self.layers:
+            l.reorder_kv_cache(rows)
+
+    def can_fuse_decode(self):
+        attn = self.layers[0].attn
+        return (attn.qkv is not None and attn.k_cache is not None and attn.window is None and
+                all(l.attn.query_subsampling == l.attn.key_subsampling == 1 and
+                    (not l.cross_attn or l.cross_attn.query_subsampling == 1) for l in self.layers))
+
+    def decode_one(self, x, x_positions):
+        """Runs a single token per row through all the layers with the fused `ResidualAttentionBlock.decode_one`.
+
+        It reads the keys and values from the caches (and writes the new ones) like `forward` but uses fewer,
+        larger operations which matters at batch size 1 where we mostly wait for the kernel launches."""
+        rope = None
+        rotary = self.layers[0].attn.rotary
+        if rotary:
+            if x_positions.dim() == 2: # separate positions for every row
+                cos, sin = rotary.cos_cached[0,x_positions], rotary.sin_cached[0,x_positions]
+            else:
+                cos, sin = rotary.cos_cached[:,x_positions], rotary.sin_cached[:,x_positions]
+            half = sin.shape[-1] // 2
+            rope = cos, torch.cat([-sin[...,:half], sin[...,half:]], dim=-1)
+        mask = self.mask[x_positions]
+        if x_positions.dim() == 2: mask = mask.unsqueeze(1) # broadcast over the heads
+        for l in self.layers:
+            x = l.decode_one(x, x_positions, rope, mask)
+        return self.ln_post(x)
 
     def forward(self, x, x_positions, xenc, xenc_positions):
+        if self.fused_decode and not self.training and x.shape[1] == 1 and xenc is None:
+            return self.decode_one(x, x_positions)
         for i,l in enumerate(self.layers):
             x = l(x, x_positions, xenc, xenc_positions, causal=self.training, mask=self.mask if not self.training else None)
 
@@ -0,0 +1,163 @@
+# AUTOGENERATED! DO NOT EDIT! File to edit: ../nbs/D1. ONNX Runtime inference.ipynb.
+
+# %% auto 0
+__all__ = ['gumbel_noise', 'sample', 'ORTModel', 'ORTT2S', 'ORTS2A']
+
+# %% ../nbs/D1. ONNX Runtime inference.ipynb 2
+import json
+from pathlib import Path
+
+import numpy as np
+try:
+    import onnxruntime as ort
+except ImportError:
+    ort = None # an optional dependency (`pip install whisperspeech[onnx]`), only needed by `ORTModel`
+
+from whisperspeech import languages
+
+# %% ../nbs/D1. ONNX Runtime inference.ipynb 3
+# numpy ports of `inference.gumbel_noise` and `inference.sample` so a seed gives the same tokens as in PyTorch
+def _fmix32(h):
+    h = h ^ (h >> 16)
+    h = (h * 0x85EBCA6B) & 0xFFFFFFFF
+    h = h ^ (h >> 13)
+    h = (h * 0xC2B2AE35) & 0xFFFFFFFF
+    return h ^ (h >> 16)
+
+def gumbel_noise(seeds, steps, idxs):
+    """Same as `inference.gumbel_noise` (uint64 wraps around like the int64 tensors there)."""
+    bs, n = idxs.shape[0], idxs.shape[-1]
+    flat = idxs.reshape(bs, -1, n).astype(np.uint64)
+    slices = np.arange(flat.shape[1], dtype=np.uint64)
+    seeds = np.asarray(seeds, dtype=np.uint64).reshape(-1, 1)
+    steps = np.broadcast_to(np.asarray(steps, dtype=np.uint64), (bs,)).reshape(-1, 1)
+    with np.errstate(over='ignore'):
+        row = _fmix32((seeds * np.uint64(0x9E3779B1) + steps * np.uint64(0x85EBCA77) + slices) & np.uint64(0xFFFFFFFF))
+        h = _fmix32((row[...,None] * np.uint64(0xC2B2AE3D) + flat) & np.uint64(0xFFFFFFFF))
+    u = ((h >> np.uint64(8)).astype(np.float32) + np.float32(0.5)) / np.float32(2**24)
+    return (-np.log(-np.log(u))).reshape(idxs.shape)
+
+def sample(logits, T=1.0, top_k=None, seeds=None, steps=None, rng=None):
+    """Samples a token id from the last dimension of `logits` with the Gumbel-max trick like `inference.sample`.
+
+    With `seeds` (one per row) the noise comes from `gumbel_noise` keyed by `steps`, otherwise from `rng`."""
+    logits = logits.astype(np.float32) / np.float32(max(T, 1e-5))
+    idxs = None
+    if top_k is not None and top_k < logits.shape[-1]:
+        idxs = np.argpartition(-logits, top_k - 1, axis=-1)[...,:top_k]
+        logits = np.take_along_axis(logits, idxs, -1)
+    if seeds is not None:
+        if idxs is None: idxs = np.broadcast_to(np.arange(logits.shape[-1]), logits.shape)
+        noise = gumbel_noise(seeds, steps, idxs)
+    else:
+        noise = -np.log((rng or np.random.default_rng()).exponential(size=logits.shape)).astype(np.float32)
+    idx_next = np.argmax(logits + noise, axis=-1)[...,None]
+    if idxs is not None: idx_next = np.take_along_axis(idxs, idx_next, -1)
+    return idx_next.astype(np.int64)
+
+# %% ../nbs/D1. ONNX Runtime inference.ipynb 4
+class ORTModel:
+    """The encoder, prefill and decoding step graphs written by `export_onnx` with the KV caches kept in numpy arrays.
+
+    `threads` sets the intra-op thread pool size of ONNX Runtime (by default it uses all the cores)."""
+    def __init__(self, path, threads=None, providers=None):
+        if ort is None: raise ImportError("ONNX Runtime inference needs the `onnxruntime` package, please `pip install whisperspeech[onnx]`")
+        path = Path(path)
+        with open(path/'config.json') as f: self.config = json.load(f)
+        opts = ort.SessionOptions()
+        if threads: opts.intra_op_num_threads = threads
+        providers = providers or ['CPUExecutionProvider']
+        self.encoder, self.prefill, self.decode = [ort.InferenceSession(str(path/f'{name}.onnx'), opts, providers=providers)
+                                                   for name in ('encoder', 'prefill', 'decode')]
+        n = self.config['layers']
+        self.cross_names = [f"cross_{kv}{i}" for i in range(n) for kv in "kv"]
+        self.past_names = [f"past_{kv}{i}" for i in range(n) for kv in "kv"]
+
+    def new_cache(self, bs, length):
+        c = self.config
+        return [np.zeros((bs, c['n_head'], length, c['head_width']), dtype=np.float32) for _ in self.past_names]
+
+    def run_prefill(self, toks, positions, cross_kvs, cache, **extra):
+        # runs the prompt through the decoder and writes its keys and values into the beginning of the `cache`
+        logits, *kvs = self.prefill.run(None, dict(toks=toks, positions=positions, **extra,
+                                                   **dict(zip(self.cross_names, cross_kvs))))
+        for c, kv in zip(cache, kvs): c[:,:,:kv.shape[2]] = kv
+        return logits
+
+    def run_decode(self, toks, position, cross_kvs, cache, **extra):
+        logits, *kvs = self.decode.run(None, dict(toks=toks, positions=np.array([position], dtype=np.int64), **extra,
+                                                  **dict(zip(self.cross_names, cross_kvs)),
+                                                  **dict(zip(self.past_names, cache))))
+        for c, kv in zip(cache, kvs): c[:,:,position:position+1] = kv
+        return logits
+
+# %% ../nbs/D1. ONNX Runtime inference.ipynb 5
+class ORTT2S(ORTModel):
+    def generate(self, txt, cps=15, lang="en", stoks_prompt=None, N=None, bs=1, T=0.7, top_k=None, seed=None, rng=None):
+        """Generates semantic tokens for `txt` like `TSARTransformer.generate` (same tokens for the same `seed`)."""
+        c = self.config
+        N = N or c['stoks_len']
+        ttoks = list(bytes(txt.strip(), 'utf-8'))
+        ttoks = np.pad(np.array(ttoks, dtype=np.int64), (1, c['ttoks_len'] - len(ttoks) - 1), constant_values=c['text_eot'])
+        ttoks = np.repeat(ttoks[None], bs, 0)
+        langs = np.full((bs,), languages.to_id(lang), dtype=np.int64)
+        cpss = np.full((bs,), cps, dtype=np.float32)
+        cps_emb, *cross_kvs = self.encoder.run(None, dict(ttoks=ttoks, langs=langs, cpss=cpss))
+
+        eot = c['eot']
+        toks = np.zeros((bs, N), dtype=np.int64)
+        toks[:,0] = eot
+        start = 0
+        if stoks_prompt is not None:
+            toks[:,1:len(stoks_prompt)+1] = stoks_prompt
+            start = len(stoks_prompt)
+        seeds = None if seed is None else seed + np.arange(bs)
+        cache = self.new_cache(bs, N)
+
+        logits = self.run_prefill(toks[:,:start+1], np.arange(start+1), cross_kvs, cache, cps_emb=cps_emb)
+        toks[:,start+1] = sample(logits, T, top_k, seeds=seeds, steps=start, rng=rng)[:,0]
+        finished = toks[:,start+1] == eot
+        for i in range(start+1, N-1):
+            if finished.all(): break
+            logits = self.run_decode(toks[:,i:i+1], i, cross_kvs, cache, cps_emb=cps_emb)
+            toks[:,i+1] = np.where(finished, eot, sample(logits, T, top_k, seeds=seeds, steps=i, rng=rng)[:,0])
+            finished |= toks[:,i+1] == eot
+        # cut after the EOT of the row that finished last (and drop the SOT)
+        is_eot = toks[:,start+1:] == eot
+        ends = np.where(is_eot.any(-1), is_eot.argmax(-1), is_eot.shape[-1]) + start + 1
+        return toks[:,1:ends.max()]
+
+class ORTS2A(ORTModel):
+    def generate(self, stoks, speakers, atoks_prompt=None, N=None, bs=1, T=0.7, top_k=None, seed=None, rng=None):
+        """Generates acoustic tokens for `stoks` like `SADelARTransformer.generate` (same tokens for the same `seed`)."""
+        c = self.config
+        Q = c['quantizers']
+        stoks = np.asarray(stoks, dtype=np.int64)
+        N = N or len(stoks) * 3
+        end = min(N, c['ctx_n']-1)
+        stoks = np.pad(stoks, (1, max(c['stoks_len'] - len(stoks) - 1, 0)), constant_values=c['stoks_pad'])
+        speakers = np.asarray(speakers, dtype=np.float32).reshape(1, -1)
+        # all the rows share the same input so we run the encoder once (the graph has a batch size of 1)
+        cross_kvs = [np.repeat(x, bs, 0) for x in self.encoder.run(None, dict(stoks=stoks[None], speakers=speakers))]
+        toks = np.full((bs, Q, max(c['ctx_n'], end+1)), c['codes']+1, dtype=np.int64)
+        seeds = None if seed is None else seed + np.arange(bs)
+
+        start = 0
+        if atoks_prompt is not None:
+            atoks_prompt = np.asarray(atoks_prompt, dtype=np.int64)
+            start = atoks_prompt.shape[-1]
+            for i in range(Q):
+                toks[:,i,1+i:start+i+1] = atoks_prompt[:,i]
+        start += 1
+        cache = self.new_cache(bs, c['ctx_n'])
+
+        logits = self.run_prefill(toks[:,:,:start], np.arange(start), cross_kvs, cache)
+        toks[:,:start,start:start+1] = sample(logits, T, top_k, seeds=seeds, steps=start-1, rng=rng)[:,:start]
+        for i in range(start+1, end):
+            logits = self.run_decode(toks[:,:,i-1:i], i-1, cross_kvs, cache)
+            toks[:,:i,i:i+1] = sample(logits, T, top_k, seeds=seeds, steps=i-1, rng=rng)[:,:i]
+        # undo the delay pattern
+        toks = toks[:,:,1:N]
+        for j in range(Q):
+            toks[:, j] = np.roll(toks[:, j], -j, axis=-1)
+        return toks[:,:,:N-4]
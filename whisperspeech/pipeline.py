@@ -1,7 +1,7 @@
 # AUTOGENERATED! DO NOT EDIT! File to edit: ../nbs/7. Pipeline.ipynb.
 
 # %% auto 0
-__all__ = ['Pipeline']
+__all__ = ['split_text', 'file_hash', 'VoiceLibrary', 'run_stages', 'Pipeline']
 
 # %% ../nbs/7. Pipeline.ipynb 1
 from os.path import expanduser
@@ -10,10 +10,141 @@ from whisperspeech.t2s_up_wds_mlang_enclm import TSARTransformer
 from whisperspeech.s2a_delar_mup_wds_mlang import SADelARTransformer
 from whisperspeech.a2wav import Vocoder
 from whisperspeech import inference, s2a_delar_mup_wds_mlang_cond
+import re
+import os
+import json
+import hashlib
 import traceback
+import queue
+import threading
+from collections import OrderedDict
 from pathlib import Path
+import numpy as np
 
 # %% ../nbs/7. Pipeline.ipynb 2
+_boundaries = [
+    r'(?<=[.!?…])\s+|(?<=[。！？])\s*', # sentences
+    r'(?<=[,;:，；：])\s+|\s+(?=[—–-]\s)', # clauses
+    r'\s+', # words
+]
+
+def _split(text, max_chars, level=0):
+    if len(text) <= max_chars: return [text]
+    if level == len(_boundaries): # a single word longer than a segment
+        return [text[i:i+max_chars] for i in range(0, len(text), max_chars)]
+    return [x for part in re.split(_boundaries[level], text) if part for x in _split(part, max_chars, level+1)]
+
+def split_text(text, max_chars=300):
+    """Splits `text` into segments of at most `max_chars` characters.
+
+    We split on sentence boundaries and only fall back to clauses and words for overlong sentences (and
+    cut words that are longer than a whole segment). Consecutive pieces are packed together as long as
+    they fit in a segment. Empty text gives no segments."""
+    if max_chars < 1: raise ValueError(f"max_chars has to be at least 1, got {max_chars}")
+    segments = []
+    for piece in _split(" ".join(text.split()), max_chars):
+        if not piece: continue
+        if segments and len(segments[-1]) + 1 + len(piece) <= max_chars:
+            segments[-1] += " " + piece
+        else:
+            segments.append(piece)
+    return segments
+
+# %% ../nbs/7. Pipeline.ipynb 3
+def file_hash(fname):
+    h = hashlib.sha256()
+    with open(fname, 'rb') as f:
+        for block in iter(lambda: f.read(1<<20), b''):
+            h.update(block)
+    return h.hexdigest()
+
+class VoiceLibrary:
+    """A set of named speaker embeddings stored in a single memory-mapped `.npy` file.
+
+    The names are kept in a `.json` index next to it. Embeddings are only read from disk when used
+    so even very large libraries load instantly and are shared between processes by the page cache."""
+    def __init__(self, path):
+        path = Path(path)
+        self.embs = np.load(path.with_suffix('.npy'), mmap_mode='r')
+        self.names = json.loads(path.with_suffix('.json').read_text())
+        self.index = {name:i for i,name in enumerate(self.names)}
+
+    def __len__(self): return len(self.names)
+    def __contains__(self, name): return name in self.index
+
+    def __getitem__(self, name):
+        return torch.from_numpy(np.array(self.embs[self.index[name]]))
+
+    @staticmethod
+    def save(path, names, embs):
+        path = Path(path)
+        np.save(path.with_suffix('.npy'), np.stack([np.asarray(x, dtype=np.float32) for x in embs]))
+        path.with_suffix('.json').write_text(json.dumps(list(names)))
+
+# %% ../nbs/7. Pipeline.ipynb 4
+class _Failure:
+    def __init__(self, exc): self.exc = exc
+
+_DONE = object()
+
+def _put(q, item, stop):
+    # a put that gives up when the consumer went away (so no worker stays blocked on a full queue)
+    while not stop.is_set():
+        try:
+            q.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            pass
+    return False
+
+def _get(q, stop):
+    while not stop.is_set():
+        try:
+            return q.get(timeout=0.1)
+        except queue.Empty:
+            pass
+    return _DONE
+
+def _stage(fn, inq, outq, stop):
+    while True:
+        item = _get(inq, stop)
+        if item is not _DONE and not isinstance(item, _Failure):
+            try:
+                with torch.no_grad(): # the grad mode is per thread
+                    item = fn(item)
+            except Exception as e:
+                item = _Failure(e)
+        if not _put(outq, item, stop) or item is _DONE or isinstance(item, _Failure): return
+
+def run_stages(items, stages, queue_size=2):
+    """Yields `stages[-1](...(stages[0](item)))` for every item in order, running every stage in its own thread.
+
+    The stages are connected by queues of at most `queue_size` results, so stage `k` works on item `n` while
+    stage `k+1` works on item `n-1` and the throughput approaches the one of the slowest stage. An exception in
+    any stage is raised here and closing the generator early stops all the threads."""
+    stop = threading.Event()
+    queues = [queue.Queue()] + [queue.Queue(maxsize=queue_size) for _ in stages]
+    for item in items: queues[0].put(item)
+    queues[0].put(_DONE)
+    threads = [threading.Thread(target=_stage, args=(fn, inq, outq, stop), daemon=True)
+               for fn, inq, outq in zip(stages, queues, queues[1:])]
+    for t in threads: t.start()
+    try:
+        while True:
+            item = _get(queues[-1], stop)
+            if item is _DONE: return
+            if isinstance(item, _Failure): raise item.exc
+            yield item
+    finally:
+        stop.set()
+        for t in threads: t.join()
+
+def _crossfade(audio, x, crossfade):
+    ov = min(int(crossfade * 24000), audio.shape[-1], x.shape[-1])
+    fade = torch.linspace(0, 1, ov, device=audio.device)
+    return torch.cat([audio[...,:audio.shape[-1]-ov], audio[...,audio.shape[-1]-ov:] * (1 - fade) + x[...,:ov] * fade, x[...,ov:]], dim=-1)
+
+# %% ../nbs/7. Pipeline.ipynb 5
 class Pipeline:
     default_speaker = torch.tensor(
        [-0.2929, -0.4503,  0.4155, -0.1417,  0.0473, -0.1624, -0.2322,  0.7071,
@@ -42,15 +173,26 @@ class Pipeline:
          0.2702,  0.1699, -0.1443, -0.9614,  0.3261,  0.1718,  0.3545, -0.0686]
     )
     
-    def __init__(self, t2s_ref=None, s2a_ref=None, optimize=True, torch_compile=False, device=None):
+    spk_emb_model = "speechbrain/spkrec-ecapa-voxceleb"
+
+    def __init__(self, t2s_ref=None, s2a_ref=None, optimize=True, torch_compile=False, device=None, max_batch_size=1,
+                 spk_cache_size=64, spk_cache_dir="~/.cache/whisperspeech/spk_emb/", voices=None, encoder_cache_size=0,
+                 quantize=False, vocoder_ref="charactr/vocos-encodec-24khz", compile_cache=None):
         if device is None: device = inference.get_compute_device()
         self.device = device
+        # the compilation itself is lazy so it's enough to load the cached artifacts before the first generation
+        if torch_compile and compile_cache: inference.load_compile_cache(compile_cache)
+        self.spk_cache = OrderedDict()
+        self.spk_cache_size = spk_cache_size
+        self.spk_cache_dir = Path(expanduser(spk_cache_dir)) if spk_cache_dir else None
+        self.voices = VoiceLibrary(voices) if isinstance(voices, (str, Path)) else voices
         args = dict(device = device)
         try:
             if t2s_ref:
                 args["ref"] = t2s_ref
             self.t2s = TSARTransformer.load_model(**args)  # use obtained compute device
-            if optimize: self.t2s.optimize(torch_compile=torch_compile)
+            if optimize: self.t2s.optimize(max_batch_size=max_batch_size, torch_compile=torch_compile,
+                                          encoder_cache_size=encoder_cache_size, quantize=quantize)
         except:
             print("Failed to load the T2S model:")
             print(traceback.format_exc())
@@ -67,17 +209,61 @@ class Pipeline:
             else:
                 cls = SADelARTransformer
             self.s2a = cls.load_model(**args)  # use obtained compute device
-            if optimize: self.s2a.optimize(torch_compile=torch_compile)
+            if optimize: self.s2a.optimize(max_batch_size=max_batch_size, torch_compile=torch_compile,
+                                          encoder_cache_size=encoder_cache_size, quantize=quantize)
         except:
             print("Failed to load the S2A model:")
             print(traceback.format_exc())
 
-        self.vocoder = Vocoder(device=device)
+        self.vocoder = Vocoder(vocoder_ref, device=device, quantize=quantize)
         self.encoder = None
 
-    def extract_spk_emb(self, fname):
-        """Extracts a speaker embedding from the first 30 seconds of the give audio file.
-        """
+    def warmup(self, batch_sizes=(1,)):
+        """Runs a short generation for every batch size so all the (compiled) graphs are ready before serving.
+
+        With KV length buckets (see `optimize`) we decode the whole context instead so every bucket is compiled."""
+        t2s_N = self.t2s.stoks_len if self.t2s.decoder.kv_len_buckets else 4
+        stoks = torch.zeros(self.s2a.ctx_n // 3 if self.s2a.decoder.kv_len_buckets else 4, dtype=torch.long)
+        speaker = self.default_speaker.unsqueeze(0)
+        for bs in batch_sizes:
+            # a check interval of N never stops at the end of text
+            self.t2s.generate("warmup", bs=bs, N=t2s_N, eos_check_interval=t2s_N, show_progress_bar=False)
+            self.s2a.generate(stoks, speaker, bs=bs, show_progress_bar=False)
+
+    def extract_spk_emb(self, fname, seconds=30):
+        """Extracts a speaker embedding from the first `seconds` of the given audio file.
+
+        The embeddings are cached in memory (the `spk_cache_size` most recently used ones) and in `spk_cache_dir`
+        under the hash of the file contents so the same voice is only encoded once. The in-memory cache is keyed
+        on the path, size and modification time of the file so we only have to read and hash it on a miss."""
+        st = os.stat(fname)
+        key = (os.path.realpath(fname), st.st_size, st.st_mtime_ns, seconds)
+        if key in self.spk_cache:
+            self.spk_cache.move_to_end(key)
+            return self.spk_cache[key]
+        cache_file = self.spk_cache_dir / f"{file_hash(fname)}-{seconds}.npy" if self.spk_cache_dir else None
+        if cache_file and cache_file.exists():
+            spk_emb = torch.from_numpy(np.load(cache_file)).to(self.device)
+        else:
+            spk_emb = self._extract_spk_emb(fname, seconds)
+            if cache_file:
+                cache_file.parent.mkdir(parents=True, exist_ok=True)
+                tmp = cache_file.with_suffix(f".{os.getpid()}.tmp")
+                with open(tmp, 'wb') as f: np.save(f, spk_emb.float().cpu().numpy())
+                os.replace(tmp, cache_file)
+        self.spk_cache[key] = spk_emb
+        if len(self.spk_cache) > self.spk_cache_size: self.spk_cache.popitem(last=False)
+        return spk_emb
+
+    def build_voice_library(self, path, voices, seconds=30):
+        """Extracts speaker embeddings for all the `voices` (a dict of names to audio files) and saves them as a `VoiceLibrary`.
+
+        The library is also made available to `get_speaker` so you can pass voice names as the `speaker`."""
+        VoiceLibrary.save(path, voices.keys(), [self.extract_spk_emb(fname, seconds).float().cpu() for fname in voices.values()])
+        self.voices = VoiceLibrary(path)
+        return self.voices
+
+    def _extract_spk_emb(self, fname, seconds=30):
         import torchaudio
         if self.encoder is None:
             device = self.device
@@ -87,12 +273,12 @@ class Pipeline:
                 from speechbrain.pretrained import EncoderClassifier
             except: # 1.0.0
                 from speechbrain.inference.classifiers import EncoderClassifier
-            self.encoder = EncoderClassifier.from_hparams("speechbrain/spkrec-ecapa-voxceleb",
+            self.encoder = EncoderClassifier.from_hparams(self.spk_emb_model,
                                                           savedir=expanduser("~/.cache/speechbrain/"),
                                                           run_opts={"device": device})
         audio_info = torchaudio.info(fname)
         actual_sample_rate = audio_info.sample_rate
-        num_frames = actual_sample_rate * 30 # specify 30 seconds worth of frames
+        num_frames = actual_sample_rate * seconds
         samples, sr = torchaudio.load(fname, num_frames=num_frames)
         samples = samples[:, :num_frames]
         samples = self.encoder.audio_normalizer(samples[0], sr)
@@ -100,9 +286,15 @@ class Pipeline:
         
         return spk_emb[0,0].to(self.device)
         
+    def get_speaker(self, speaker):
+        if speaker is None: return self.default_speaker
+        if isinstance(speaker, str) and self.voices is not None and speaker in self.voices:
+            return self.voices[speaker].to(self.device)
+        if isinstance(speaker, (str, Path)): return self.extract_spk_emb(speaker)
+        return speaker
+
     def generate_atoks(self, text, speaker=None, lang='en', cps=15, step_callback=None):
-        if speaker is None: speaker = self.default_speaker
-        elif isinstance(speaker, (str, Path)): speaker = self.extract_spk_emb(speaker)
+        speaker = self.get_speaker(speaker)
         text = text.replace("\n", " ")
         stoks = self.t2s.generate(text, cps=cps, lang=lang, step=step_callback)[0]
         atoks = self.s2a.generate(stoks, speaker.unsqueeze(0), step=step_callback)
@@ -110,7 +302,133 @@ class Pipeline:
         
     def generate(self, text, speaker=None, lang='en', cps=15, step_callback=None):
         return self.vocoder.decode(self.generate_atoks(text, speaker, lang=lang, cps=cps, step_callback=step_callback))
+
+    def generate_stream(self, text, speaker=None, lang='en', cps=15, chunk=25, context=8, step_callback=None):
+        """Yields 24kHz audio chunks while the S2A model is still generating.
+
+        `chunk` is the number of acoustic frames (75 per second) vocoded at once and `context` is the number
+        of frames shared between neighbouring chunks to crossfade the seams."""
+        speaker = self.get_speaker(speaker)
+        text = text.replace("\n", " ")
+        stoks = self.t2s.generate(text, cps=cps, lang=lang, step=step_callback)[0]
+        atoks = self.s2a.generate_stream(stoks, speaker.unsqueeze(0), chunk=chunk, step=step_callback)
+        yield from self.vocoder.decode_stream(atoks, context=context)
     
+    def stoks_budget(self, prompt_stoks=0):
+        """The number of semantic tokens of a segment that both models can handle after a `prompt_stoks` long prompt.
+
+        T2S outputs that reached its context length were cut off so they never fit. Without the sliding window
+        S2A generates at most `ctx_n-1` acoustic frames, 3 per semantic token."""
+        s2a = self.s2a.stoks_len - 1
+        if not self.s2a.decoder.layers[0].attn.window: s2a = min(s2a, (self.s2a.ctx_n - 1) // 3)
+        return min(self.t2s.stoks_len - 2, s2a - prompt_stoks)
+
+    def max_segment_chars(self, cps=15, prompt_stoks=0):
+        # semantic tokens run at 25 per second, leave some margin since the real speed varies
+        chars = min(int(self.stoks_budget(prompt_stoks) / 25 * cps * .8), self.t2s.ttoks_len - 2)
+        if chars < 1:
+            raise ValueError(f"a {prompt_stoks} token prompt leaves no room for text in the model context, please use a shorter `prompt_seconds`")
+        return chars
+
+    def _fit_segments(self, segments, stoks, budget, t2s):
+        # T2S can speak slower than `max_segment_chars` assumes, S2A would silently drop the end of the segments
+        # that got too long so we split them in half and generate them again
+        out = []
+        for segment, x in zip(segments, stoks):
+            if len(x) <= budget:
+                out.append(x)
+                continue
+            if len(segment) < 2:
+                raise ValueError(f"T2S generated {len(x)} semantic tokens for {segment!r}, more than the {budget} that fit in the model context")
+            halves = split_text(segment, (len(segment) + 1) // 2)
+            out += self._fit_segments(halves, t2s(halves), budget, t2s)
+        return out
+
+    def generate_long(self, text, speaker=None, lang='en', cps=15, max_chars=None, prompt_seconds=3, crossfade=0.05):
+        """Synthesizes text of any length by splitting it into segments that fit into the model context.
+
+        All segments go through T2S together. The first one is then voiced on its own and its beginning
+        is used as the `atoks_prompt` for all the remaining segments which go through S2A together to keep
+        the voice consistent. The audio is concatenated with `crossfade` seconds of overlap.
+
+        Segments for which T2S generated more semantic tokens than S2A can voice (see `stoks_budget`) are split
+        again. The models have to be optimized with `max_batch_size` > 1 to actually run the segments in parallel."""
+        speaker = self.get_speaker(speaker)
+        prompt_stoks = int(prompt_seconds * 25)
+        segments = split_text(text, max_chars or self.max_segment_chars(cps, prompt_stoks))
+        t2s = lambda segments: self.t2s.generate_batch(segments, T=0.7, top_k=None, lang=lang, cps=cps)
+        stoks = self._fit_segments(segments, t2s(segments), self.stoks_budget(prompt_stoks), t2s)
+        # T2S can also stop right away, these segments have no audio
+        stoks = [x for x in stoks if len(x) * 3 > self.s2a.quantizers]
+        if not stoks: return torch.zeros((1, 0))
+
+        atoks = [self.s2a.generate(stoks[0], speaker.unsqueeze(0))]
+        if len(stoks) > 1:
+            n = min(prompt_stoks, atoks[0].shape[-1] // 3)
+            prompt = stoks[0][:n]
+            rest = self.s2a.generate_batch([torch.cat([prompt, x]) for x in stoks[1:]], speaker,
+                                           atoks_prompt=atoks[0][:,:,:3*n])
+            atoks += [x[:,:,3*n:] for x in rest]
+
+        audio = self.vocoder.decode(atoks[0])
+        for x in atoks[1:]:
+            audio = _crossfade(audio, self.vocoder.decode(x), crossfade)
+        return audio
+
+    def generate_pipelined(self, text, speaker=None, lang='en', cps=15, max_chars=None, prompt_seconds=3, crossfade=0.05,
+                           queue_size=2):
+        """Synthesizes text of any length segment by segment with T2S, S2A and the vocoder running in parallel threads.
+
+        While S2A voices segment n, T2S already works on segment n+1 and the vocoder on segment n-1 (see
+        `run_stages`). Like in `generate_long` the beginning of the first segment is the `atoks_prompt` for all
+        the others and segments that T2S made too long are split again. Yields the audio as soon as a segment is vocoded, the chunks concatenated are crossfaded
+        the same way as in `generate_long`.
+
+        It does not need batching so it works with `max_batch_size=1` and helps most on multi-core CPUs
+        (with CUDA the stages still share the GPU and only their Python overhead overlaps)."""
+        speaker = self.get_speaker(speaker).unsqueeze(0)
+        prompt_stoks = int(prompt_seconds * 25)
+        segments = split_text(text, max_chars or self.max_segment_chars(cps, prompt_stoks))
+        budget = self.stoks_budget(prompt_stoks)
+        prompt = None
+
+        def generate_t2s(segments):
+            return [self.t2s.generate(x, cps=cps, lang=lang, show_progress_bar=False)[0] for x in segments]
+
+        def t2s(segment):
+            # the pieces of the segment if it had to be split again (see `generate_long`)
+            pieces = self._fit_segments([segment], generate_t2s([segment]), budget, generate_t2s)
+            # T2S can also stop right away, these pieces have no audio
+            return [x for x in pieces if len(x) * 3 > self.s2a.quantizers]
+
+        def s2a(pieces):
+            return torch.cat([s2a_piece(x) for x in pieces], dim=-1) if pieces else None
+
+        def s2a_piece(stoks):
+            nonlocal prompt
+            if prompt is None:
+                atoks = self.s2a.generate(stoks, speaker, show_progress_bar=False)
+                n = min(prompt_stoks, atoks.shape[-1] // 3)
+                prompt = stoks[:n], atoks[:,:,:3*n]
+                return atoks
+            stoks_prompt, atoks_prompt = prompt
+            n = len(stoks_prompt)
+            return self.s2a.generate(torch.cat([stoks_prompt, stoks]), speaker, atoks_prompt=atoks_prompt,
+                                     show_progress_bar=False)[:,:,3*n:]
+
+        def vocoder(atoks):
+            return None if atoks is None else self.vocoder.decode(atoks)
+
+        tail = None
+        for x in run_stages(segments, [t2s, s2a, vocoder], queue_size=queue_size):
+            if x is None: continue # a segment without audio
+            # we hold back the end of every segment to crossfade it with the next one
+            audio = x if tail is None else _crossfade(tail, x, crossfade)
+            keep = min(int(crossfade * 24000), audio.shape[-1])
+            yield audio[...,:audio.shape[-1]-keep]
+            tail = audio[...,audio.shape[-1]-keep:]
+        if tail is not None: yield tail
+
     def generate_to_file(self, fname, text, speaker=None, lang='en', cps=15, step_callback=None):
         self.vocoder.decode_to_file(fname, self.generate_atoks(text, speaker, lang=lang, cps=cps, step_callback=None))
         
@@ -1,8 +1,8 @@
 # AUTOGENERATED! DO NOT EDIT! File to edit: ../nbs/4B. Multi-language semantic to acoustic token modeling with conditioning.ipynb.
 
 # %% auto 0
-__all__ = ['load_dataset', 'DelSumEmbedding', 'DelSumHead', 'rand', 'Tunables', 'CategoricalEmbedding', 'BinnedEmbedding',
-           'SpeakerEmbedding', 'SADelARTransformer']
+__all__ = ['rand', 'logrand', 'load_dataset', 'DelSumEmbedding', 'DelSumHead', 'Tunables', 'CategoricalEmbedding',
+           'BinnedEmbedding', 'SpeakerEmbedding', 'SADelARTransformer']
 
 # %% ../nbs/4B. Multi-language semantic to acoustic token modeling with conditioning.ipynb 1
 import io
@@ -27,6 +27,7 @@ from fastprogress import progress_bar, master_bar
 
 # %% ../nbs/4B. Multi-language semantic to acoustic token modeling with conditioning.ipynb 4
 from . import inference, languages
+from .batching import S2ABatcher
 from .modules import *
 
 # %% ../nbs/4B. Multi-language semantic to acoustic token modeling with conditioning.ipynb 8
@@ -166,17 +167,37 @@ class DelSumEmbedding(nn.Module):
         self.embeddings = nn.ModuleList(embs)
         if pos_embs is not None:
             self.register_buffer("positional_embedding", pos_embs)
+        # stacked [quantizers, codes, width] tables of all the quantizers, created by `convert_for_eval`
+        self.register_buffer('merged_in', None)
+        self.register_buffer('merged_out', None)
+        self.register_buffer('bias_out', None)
+
+    @torch.no_grad()
+    def convert_for_eval(self):
+        for emb in self.embeddings: emb.convert_for_eval()
+        if self.embeddings[0].merged_in is None: return
+        self.merged_in = torch.stack([emb.merged_in.weight for emb in self.embeddings])
+        self.merged_out = torch.stack([emb.merged_out for emb in self.embeddings])
+        if self.embeddings[0].bias_out is not None:
+            self.bias_out = torch.stack([emb.bias_out for emb in self.embeddings])
 
     def forward(self, toks, xenc):
         with record_function("embeddings"):
             b,_,n = toks.shape
             newn = min(n, self.length)
 
-            embs = torch.zeros((b,newn,self.width), dtype=xenc.dtype, device=xenc.device)
+            dtype = xenc.dtype if xenc is not None else self.embeddings[0].main.weight.dtype
+            if not self.training and self.merged_in is not None:
+                # sum the embeddings of all quantizers with a single lookup in the stacked table
+                q, codes, _ = self.merged_in.shape
+                idxs = toks + torch.arange(q, device=toks.device).view(1, q, 1) * codes
+                embs = F.embedding_bag(idxs.transpose(1, 2).reshape(-1, q), self.merged_in.flatten(0, 1), mode='sum')
+                return embs.view(b, n, self.width).to(dtype)
+            embs = torch.zeros((b,newn,self.width), dtype=dtype, device=toks.device)
             for i in range(self.quantizers):
                 embs[:, :] += self.embeddings[i](toks[:,i,:])
             
-            x = embs.to(xenc.dtype)
+            x = embs.to(dtype)
         return x
 
 # %% ../nbs/4B. Multi-language semantic to acoustic token modeling with conditioning.ipynb 14
@@ -195,7 +216,16 @@ class DelSumHead(nn.Module):
         with record_function("splitter"):
             split = self.splitter(x).view(b,newn,self.quantizers,self.width)
         with record_function("unembed"):
-            logits = torch.stack([embeddings[q].unembed(split[:,:,q]) for q in range(self.quantizers)], dim=1)
+            if not self.training and embeddings.merged_out is not None:
+                # one batched matmul with the stacked output embeddings of all quantizers
+                split = split.permute(2,0,1,3).flatten(1,2)
+                weight = embeddings.merged_out.transpose(1,2)
+                if embeddings.bias_out is not None:
+                    logits = torch.baddbmm(embeddings.bias_out.unsqueeze(1), split, weight)
+                else:
+                    logits = torch.bmm(split, weight)
+                return logits.view(self.quantizers, b, newn, -1).transpose(0,1)
+            logits = torch.stack([embeddings.embeddings[q].unembed(split[:,:,q]) for q in range(self.quantizers)], dim=1)
         return logits
         
 def rand(start, end):
@@ -301,7 +331,9 @@ class SpeakerEmbedding(nn.Module):
     
 from webdataset.filters import default_collation_fn
         
-class SADelARTransformer(nn.Module):
+class SADelARTransformer(inference.S2AGenerationMixin, nn.Module):
+    batcher_class = S2ABatcher
+
     def __init__(self, depth=3, ctx_n=2250,
                  stoks_len=750, stoks_codes=4097, stoks_width=None,
                  spk_width=None,
@@ -363,6 +395,9 @@ class SADelARTransformer(nn.Module):
         
         self.register_buffer('val_true', torch.zeros(self.quantizers))
         self.register_buffer('val_total', torch.zeros(self.quantizers))
+        self.encoder_cache = None
+        self.converted_for_eval = False
+        self.batch_buckets = None
         self.apply(self.init_transformer)
 
     def setup(self, device):
@@ -448,14 +483,15 @@ class SADelARTransformer(nn.Module):
         return xenc + cond_embs.unsqueeze(1), positions, enc_logits
 
     def forward(self, Stoks, Atoks, conds, out_stoks=None, out_atoks=None, noloss=False, xenc=None, xenc_positions=None, atoks_positions=None):
-        if xenc is None:
+        # without Stoks and xenc the decoder uses the cross-attention keys and values from the KV cache
+        if xenc is None and Stoks is not None:
             Stoks, Atoks = [x.to(dtype=torch.long) for x in (Stoks, Atoks)]
             xenc, xenc_positions, enc_logits = self.run_encoder(Stoks, conds)
         with record_function("decoder"):
             embs = self.embds(Atoks, xenc)
             if atoks_positions is None: atoks_positions = torch.arange(0, embs.shape[1], device=embs.device)
             x = self.decoder(embs, atoks_positions, xenc, xenc_positions)
-            logits = self.head(x, embeddings=self.embds.embeddings)
+            logits = self.head(x, embeddings=self.embds)
             logits *= self.tunables.output_mult / (self.width / self.base_width)
             
         if noloss:
@@ -494,11 +530,21 @@ class SADelARTransformer(nn.Module):
     # inference
     #
     @classmethod
-    def load_model(cls, ref="collabora/whisperspeech:s2a-q4-small-en+pl.model", spec=None, device=None):
-        spec = inference.load_model(ref=ref, spec=spec, device=device)
+    def load_model(cls, ref="collabora/whisperspeech:s2a-q4-small-en+pl.model", spec=None, device=None, fast=True):
+        spec = inference.load_model(ref=ref, spec=spec, device=device, mmap=fast)
         if '_extra_state' not in spec['state_dict'] and 'speaker_map' in spec['config']: spec['state_dict']['_extra_state'] = { 'speaker_map': spec['config']['speaker_map'] }
-        model = cls(**spec['config'], tunables=Tunables(**Tunables.upgrade(spec['tunables'])))
-        model.load_state_dict(spec['state_dict'])
+        def build():
+            model = cls(**spec['config'], tunables=Tunables(**Tunables.upgrade(spec['tunables'])))
+            if 'inference_dtype' in spec: # saved with `save_optimized`
+                model.convert_for_eval().switch_dtypes(getattr(torch, spec['inference_dtype']))
+                inference.drop_unfused(model)
+            return model
+        if fast:
+            # skip the random init and use the (memory-mapped) weights directly
+            model = inference.build_model(build, spec['state_dict'])
+        else:
+            model = build()
+            model.load_state_dict(spec['state_dict'])
         model.eval().to(device)
         return model
     
@@ -520,9 +566,9 @@ class SADelARTransformer(nn.Module):
         return self
     
     def save_model(self, fname):
-        torch.save(dict(config = self.__stored_args__,
-                        tunables = dataclasses.asdict(self.tunables),
-                        state_dict = self.state_dict()), fname)
+        inference.save_spec(dict(config = self.__stored_args__,
+                                 tunables = dataclasses.asdict(self.tunables),
+                                 state_dict = self.state_dict()), fname)
 
     def switch_dtypes(self, dtype=torch.float16):
         self.dtype = dtype
@@ -534,19 +580,6 @@ class SADelARTransformer(nn.Module):
             for bn,b in m.named_buffers(recurse=False):
                 setattr(m,bn,b.to(dtype))
 
-    def optimize(self, max_batch_size=1, dtype=torch.float16, torch_compile=True):
-        for emb in self.embds.embeddings:
-            emb.convert_for_eval()
-        for l in self.encoder:
-            l.attn.convert_for_eval()
-        for l in self.decoder.layers:
-            l.attn.convert_for_eval()
-            l.cross_attn.convert_for_eval()
-            l.setup_kv_cache(max_batch_size, self.ctx_n, self.stoks_len)
-        self.switch_dtypes(dtype)
-        if torch_compile:
-            self.generate_next = torch.compile(self.generate_next, mode="reduce-overhead", fullgraph=True)
-            
     def optimize_training(self):
         self.decoder = torch.compile(self.decoder, fullgraph=True, mode="reduce-overhead")
         self._encoder = torch.compile(self._encoder, fullgraph=True, mode="reduce-overhead")
@@ -555,54 +588,9 @@ class SADelARTransformer(nn.Module):
     def device(self):
         return next(self.parameters()).device
 
-    def generate_one(self, toks, positions, langs, xenc, xenc_positions, T, top_k):
-        probs = self(None, toks, None, langs, noloss=True, xenc=xenc, xenc_positions=xenc_positions, atoks_positions=positions)
-        probs = probs[:,:,-1]
-        return inference.sample(probs, T, top_k)
-
-    def generate_next(self, *args, **kwargs):
-        return self.generate_one(*args, **kwargs)
-    
-    @torch.no_grad()
-    def generate(self, stoks, speakers, langs=None, atoks_prompt=None, N=None, bs=1, T=0.7, top_k=None, show_progress_bar=True, step=None, subsample_enc=False):
-        dev = self.device
-        N = N or len(stoks) * 3
-        stoks = F.pad(stoks.to(dev), (1, self.stoks_len - len(stoks) - 1), value=self.stoks_codes-1).unsqueeze(0)
-        speakers = speakers.to(device=dev, dtype=self.dtype)
-        toks = torch.full((bs,self.quantizers,self.ctx_n), self.codes+1, dtype=torch.long, device=dev)
-        T = torch.tensor(T, device=dev)
-
-        start = 0 # number of valid tokens or the index of first empty spot
-        if atoks_prompt is not None:
-            start = atoks_prompt.shape[-1]
-            for i in range(self.quantizers):
-                toks[:,i,1+i:start+i+1] = atoks_prompt[:,i]
-        start += 1 # we always start with at least an SOT
-
-        with record_function("encode"):
-            stoks, speakers = [x.repeat(bs, 1) for x in (stoks, speakers)]
-            xenc, xenc_positions, _ = self.run_encoder(stoks, [dict(speaker = s, snr=60, c50=60) for s in speakers])
-            toks_positions = torch.arange(N, device=dev)
-        with record_function("prefill"):
-            initial = self.generate_one(toks[:,:,:start], toks_positions[:start], langs, xenc, xenc_positions, T, top_k)
-            toks[:,:start,start:start+1] = initial[:,:start]
-            start += 1
-            
-        with inference.inference_context():
-            it = range(start,min(N,self.ctx_n-1))
-            if show_progress_bar: it = progress_bar(it)
-
-            for i in it:
-                with record_function("generate_one"):
-                    toks[:,:i,i:i+1] = self.generate_next(toks[:,:,i-1:i], toks_positions[i-1:i], langs, xenc, xenc_positions, T, top_k)[:,:i]
-
-                # for profiling, debugging or early exit
-                if step is not None: step()
-        # shift tokens
-        toks = toks[:,:,1:N]
-        for j in range(self.quantizers):
-            toks[:, j] = torch.roll(toks[:, j], -j)
-        return toks[:,:,:N-4]
+    def speaker_conds(self, speakers):
+        # we only have the speaker embeddings at inference time, the other conditions are set to clean audio
+        return [dict(speaker = s, snr=60, c50=60) for s in speakers]
 
 # %% ../nbs/4B. Multi-language semantic to acoustic token modeling with conditioning.ipynb 15
 def _make_model(size:str, quantizers:int=4, tunables:Tunables=Tunables(), **kwargs):
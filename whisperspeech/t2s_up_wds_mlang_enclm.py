@@ -22,6 +22,7 @@ from pathlib import Path
 # %% ../nbs/5B. Multi-lang text to semantic token modeling.ipynb 2
 from whisperspeech.modules import *
 from whisperspeech import languages, inference, up_initialization
+from whisperspeech.batching import T2SBatcher
 
 # %% ../nbs/5B. Multi-lang text to semantic token modeling.ipynb 6
 import re
@@ -236,7 +237,7 @@ class Encoder(nn.Module):
         return self.ln_post(x)
 
 # %% ../nbs/5B. Multi-lang text to semantic token modeling.ipynb 15
-class TSARTransformer(nn.Module):
+class TSARTransformer(inference.InferenceMixin, nn.Module):
     def __init__(self, depth=6, n_head=6, head_width=64, ffn_mult=4,
                  ttoks_len=200, ttoks_codes=256, ttoks_width=None,
                  stoks_len=1500, stoks_codes=1024, stoks_width=None,
@@ -270,6 +271,9 @@ class TSARTransformer(nn.Module):
             width=width, n_head=n_head, ffn_mult=ffn_mult,
         )
         self.tokenizer = None
+        self.encoder_cache = None
+        self.converted_for_eval = False
+        self.batch_buckets = None
         
         self.apply(self.init_transformer)
 
@@ -301,16 +305,39 @@ class TSARTransformer(nn.Module):
             xenc = self.encoder(in_ttoks.to(torch.long), positions, lang_emb=lang_embs)
 
         return xenc, positions, cps_emb
+
+    def encode_to_kv_cache(self, in_ttoks, languages, cpss, rows=None):
+        """Runs the encoder and stores the cross-attention keys and values in the decoder KV cache `rows`
+        (by default the first rows, one per sequence).
+
+        With `optimize(encoder_cache_size=...)` the results are cached per (text, language, speed) so
+        regenerating the same text skips the encoder and the cross-attention projections."""
+        if rows is None: rows = slice(0, in_ttoks.shape[0])
+        if self.encoder_cache is None:
+            xenc, positions, cps_emb = self.run_encoder(in_ttoks, languages, cpss)
+            self.decoder.fill_cross_kv_cache(xenc, positions, rows)
+            return xenc, positions, cps_emb
+
+        def compute(idxs):
+            idxs = torch.tensor(idxs, device=in_ttoks.device)
+            xenc, positions, cps_emb = self.run_encoder(in_ttoks[idxs], languages[idxs], cpss[idxs])
+            return list(zip(xenc, cps_emb, *self.decoder.cross_kv(xenc, positions)))
+        keys = [self.encoder_cache.key(*x) for x in zip(in_ttoks, languages, cpss)]
+        xenc, cps_emb, *kvs = self.encoder_cache.lookup(keys, compute)
+        positions = torch.arange(0, in_ttoks.shape[1], device=in_ttoks.device)
+        self.decoder.store_cross_kv(kvs, positions, rows)
+        return xenc, positions, cps_emb
     
     def forward(self, in_ttoks, out_ttoks, languages, cpss, in_stoks, out_stoks=None, in_stoks_positions=None, loss=True, offset=None, xenc=None, xenc_positions=None, cps_emb=None):
-        if xenc is None:
+        if xenc is None and in_ttoks is not None:
             xenc, xenc_positions, cps_emb = self.run_encoder(in_ttoks, languages, cpss)
 
         with record_function("decoder"):
+            # without xenc the decoder uses the cross-attention keys and values from the KV cache
             x = (self.embeddings.embedding(in_stoks) + 
                  self.embeddings.positional_embedding[in_stoks_positions] +
-                 cps_emb).to(xenc[0].dtype)
-            x = self.decoder(x, in_stoks_positions, xenc.clone(), xenc_positions)
+                 cps_emb).to(xenc[0].dtype if xenc is not None else self.dtype)
+            x = self.decoder(x, in_stoks_positions, xenc, xenc_positions)
             logits = self.embeddings.embedding.unembed(x)
             logits = logits * self.tunables.output_mult / (self.width / self.base_width)
 
@@ -329,7 +356,7 @@ class TSARTransformer(nn.Module):
     #
     @classmethod
     def load_model(cls, ref="collabora/whisperspeech:t2s-small-en+pl.model",
-                   repo_id=None, filename=None, local_filename=None, spec=None, device=None):
+                   repo_id=None, filename=None, local_filename=None, spec=None, device=None, fast=True):
         if repo_id is None and filename is None and local_filename is None and spec is None:
             if ":" in ref:
                 repo_id, filename = ref.split(":", 1)
@@ -338,9 +365,19 @@ class TSARTransformer(nn.Module):
         if not local_filename and spec is None:
             local_filename = hf_hub_download(repo_id=repo_id, filename=filename)
         if spec is None:
-            spec = torch.load(local_filename, map_location=device)
-        model = cls(**spec['config'], tunables=Tunables(**Tunables.upgrade(spec['tunables'])))
-        model.load_state_dict(spec['state_dict'])
+            spec = inference.load_spec(local_filename, device=device, mmap=fast)
+        def build():
+            model = cls(**spec['config'], tunables=Tunables(**Tunables.upgrade(spec['tunables'])))
+            if 'inference_dtype' in spec: # saved with `save_optimized`
+                model.convert_for_eval().switch_dtypes(getattr(torch, spec['inference_dtype']))
+                inference.drop_unfused(model)
+            return model
+        if fast:
+            # skip the random init and use the (memory-mapped) weights directly
+            model = inference.build_model(build, spec['state_dict'])
+        else:
+            model = build()
+            model.load_state_dict(spec['state_dict'])
         model.eval().to(device)
         return model
 
@@ -356,9 +393,9 @@ class TSARTransformer(nn.Module):
         return self
 
     def save_model(self, fname):
-        torch.save(dict(config = self.__stored_args__,
-                        tunables = dataclasses.asdict(self.tunables),
-                        state_dict = self.state_dict()), fname)
+        inference.save_spec(dict(config = self.__stored_args__,
+                                 tunables = dataclasses.asdict(self.tunables),
+                                 state_dict = self.state_dict()), fname)
 
     def ensure_tokenizer(self):
         assert not self.training
@@ -374,7 +411,8 @@ class TSARTransformer(nn.Module):
             for bn,b in m.named_buffers(recurse=False):
                 setattr(m,bn,b.to(dtype))
 
-    def optimize(self, max_batch_size=1, dtype=torch.float16, torch_compile=True):
+    def convert_for_eval(self):
+        """Fuses the attention projections and merges the embeddings for inference (done by `optimize`)."""
         for emb in [self.embeddings.embedding, self.embeddings.embedding]:
             emb.convert_for_eval()
         for l in self.encoder.layers:
@@ -382,8 +420,16 @@ class TSARTransformer(nn.Module):
         for l in self.decoder.layers:
             l.attn.convert_for_eval()
             l.cross_attn.convert_for_eval()
-            l.setup_kv_cache(max_batch_size, self.stoks_len, self.ttoks_len)
-        self.switch_dtypes(dtype)
+        self.converted_for_eval = True
+        return self
+
+    def optimize(self, max_batch_size=1, dtype=None, torch_compile=True, encoder_cache_size=0, quantize=False,
+                 kv_block_size=None, kv_blocks=None, batch_buckets=None, kv_len_buckets=None, fused_decode=False):
+        """Prepares the model for fast inference (see `inference.InferenceMixin.prepare_for_inference` for the arguments)."""
+        self.prepare_for_inference(max_batch_size, self.stoks_len, self.ttoks_len, dtype=dtype, torch_compile=torch_compile,
+                                   encoder_cache_size=encoder_cache_size, quantize=quantize, kv_block_size=kv_block_size,
+                                   kv_blocks=kv_blocks, batch_buckets=batch_buckets, kv_len_buckets=kv_len_buckets,
+                                   fused_decode=fused_decode)
         if torch_compile:
             self.generate_next = torch.compile(self.generate_next, mode="reduce-overhead", fullgraph=True)
             
@@ -397,15 +443,20 @@ class TSARTransformer(nn.Module):
     def device(self):
         return next(self.parameters()).device
 
-    def generate_one(self, toks, toks_positions, cps_emb, xenc, xenc_positions, T, top_k):
+    def generate_one(self, toks, toks_positions, cps_emb, xenc, xenc_positions, T, top_k, seeds=None):
         probs, _ = self(None, None, None, None, toks, in_stoks_positions=toks_positions, loss=None, xenc=xenc, xenc_positions=xenc_positions, cps_emb=cps_emb)
         probs = probs[:,-1]
         probs[self.embeddings.embedding.codes:] = -torch.inf
-        return inference.sample(probs, T, top_k)
+        return inference.sample(probs, T, top_k, seeds=seeds, steps=toks_positions[...,-1])
 
     def generate_next(self, *args, **kwargs):
         return self.generate_one(*args, **kwargs)
 
+    def probs_next(self, toks, toks_positions, cps_emb, T, top_k):
+        """Returns the sampling distributions for the tokens following each of `toks` (read from the KV cache)."""
+        logits, _ = self(None, None, None, None, toks, in_stoks_positions=toks_positions, loss=None, cps_emb=cps_emb)
+        return inference.logits_to_probs(logits.float(), T, top_k)
+
     @torch.no_grad()
     def prep(self, txt, cps=15, lang="en"):
         dev = self.device
@@ -416,7 +467,21 @@ class TSARTransformer(nn.Module):
         return ttoks, cpss, langs
     
     @torch.no_grad()
-    def generate(self, txt, cps=15, lang="en", stoks_prompt=None, N=None, bs=1, T=0.7, top_k=None, step=None, show_progress_bar=True):
+    def generate(self, txt, cps=15, lang="en", stoks_prompt=None, N=None, bs=1, T=0.7, top_k=None, step=None, show_progress_bar=True,
+                 draft=None, draft_k=4, seed=None, eos_check_interval=8):
+        """Generates semantic tokens for `txt`.
+
+        With an integer `seed` the sampling is deterministic: row `j` of the batch uses the seed `seed+j` and
+        does not depend on the global torch RNG (not supported in speculative decoding).
+
+        The end of text is tracked in a mask on the device and we only check it (and wait for the device)
+        every `eos_check_interval` steps. Finished rows are padded with EOT and everything after the last
+        EOT is trimmed, so the result does not depend on the interval.
+
+        If you pass a smaller T2S model (optimized the same way) as the `draft` we use speculative decoding:
+        the draft proposes `draft_k` tokens at a time and this model verifies them in a single forward pass."""
+        if draft is not None and seed is not None:
+            raise ValueError("seeded sampling is not supported in speculative decoding, please pass either `draft` or `seed`")
         self.ensure_tokenizer()
         N = N or self.stoks_len
         dev = self.device
@@ -454,46 +519,113 @@ class TSARTransformer(nn.Module):
         if show_progress_bar: it = progress_bar(it)
 
         toks_positions = torch.arange(N, device=dev)
+        seeds = None if seed is None else seed + torch.arange(bs, device=dev)
         with record_function("encode"):
             ttoks = ttoks.repeat(bs, 1)
             langs, cpss = [x.repeat(bs) for x in (langs, cpss)]
-            xenc, xenc_positions, cps_emb = self.run_encoder(ttoks, langs, cpss)
+            # the cross-attention keys and values are computed once here and only read from the cache later
+            _, _, cps_emb = self.encode_to_kv_cache(ttoks, langs, cpss)
             toks_positions = torch.arange(N+1, device=dev)
+
+        with self.decoder.reserved_kv_cache(bs):
+            if draft is not None:
+                return self._generate_speculative(draft, draft_k, toks, start, N, (ttoks, langs, cpss), cps_emb, T, top_k,
+                                                  step, show_progress_bar)
         
-        with record_function("prefill"):
-            toks[:,start+1] = self.generate_one(toks[:,:start+1].contiguous(), toks_positions[:start+1], cps_emb, xenc, xenc_positions, T, top_k)[:,0]
-        with inference.inference_context():
-            for i in it:
-                toks[:,i+1] = self.generate_next(toks[:,i:i+1], toks_positions[i:i+1], cps_emb, xenc, xenc_positions, T, top_k)[:,0]
-                if (toks[:,i+1] == self.stoks_codes+self.tunables.padding_token_offset).all(): return toks[:,1:i+1]
-
-                # for profiling, debugging or early exit
-                if step is not None: step()
-        return toks[:,1:]
+            eot = self.stoks_codes+self.tunables.padding_token_offset
+            with record_function("prefill"):
+                self.decoder.set_kv_len(start+1)
+                toks[:,start+1] = self.generate_one(toks[:,:start+1].contiguous(), toks_positions[:start+1], cps_emb, None, None, T, top_k, seeds=seeds)[:,0]
+            finished = toks[:,start+1] == eot
+            with inference.inference_context():
+                for i in it:
+                    self.decoder.set_kv_len(i+1)
+                    new = self.generate_next(toks[:,i:i+1], toks_positions[i:i+1], cps_emb, None, None, T, top_k, seeds=seeds)[:,0]
+                    toks[:,i+1] = torch.where(finished, eot, new)
+                    finished |= toks[:,i+1] == eot
+                    if (i - start) % eos_check_interval == 0 and finished.all(): break
+
+                    # for profiling, debugging or early exit
+                    if step is not None: step()
+            return self._trim_eot(toks, start, eot)
+
+    def _trim_eot(self, toks, start, eot):
+        # cuts the batch after the first EOT of the row that finished last (and drops the SOT)
+        is_eot = toks[:,start+1:] == eot
+        ends = torch.where(is_eot.any(-1), is_eot.int().argmax(-1), is_eot.shape[-1]) + start + 1
+        return toks[:,1:ends.max().item()]
+
+    def _generate_speculative(self, draft, k, toks, start, N, enc_inputs, cps_emb, T, top_k, step, show_progress_bar):
+        # speculative sampling (Leviathan et al. 2023, Chen et al. 2023): we accept each drafted token with
+        # probability min(1, q/p) and resample the first rejected one from max(0, q-p) which gives exactly
+        # the same output distribution as sampling from this model alone
+        assert toks.shape[0] == 1, "speculative decoding only supports bs=1"
+        assert (draft.stoks_codes, draft.ttoks_len) == (self.stoks_codes, self.ttoks_len), "the draft model is not compatible"
+        assert draft.stoks_len >= N, f"the draft model context ({draft.stoks_len}) is shorter than N ({N})"
+        draft.ensure_tokenizer()
+        _, _, draft_cps_emb = draft.encode_to_kv_cache(*enc_inputs)
+        eot = self.stoks_codes + self.tunables.padding_token_offset
+        positions = torch.arange(N, device=toks.device)
+        if show_progress_bar:
+            pb = progress_bar(range(start+1, N-1))
+            pb.update(0)
+
+        with draft.decoder.reserved_kv_cache(1):
+            with record_function("prefill"):
+                self.decoder.set_kv_len(start+1)
+                q = self.probs_next(toks[:,:start+1], positions[:start+1], cps_emb, T, top_k)[:,-1]
+                toks[:,start+1] = inference.multinomial_sample_one_no_sync(q)[:,0]
+            i = start + 1 # toks[:,i] is the last sampled token, the target KV cache is filled up to i-1
+            drafted = 0 # the draft KV cache is valid up to drafted-1
+            with inference.inference_context():
+                while i < N-1:
+                    n_draft = min(k, N-2-i)
+                    ps = []
+                    with record_function("draft"):
+                        for j in range(i, i+n_draft):
+                            draft.decoder.set_kv_len(j+1)
+                            p = draft.probs_next(toks[:,drafted:j+1], positions[drafted:j+1], draft_cps_emb, T, top_k)[0,-1]
+                            toks[:,j+1] = inference.multinomial_sample_one_no_sync(p)
+                            drafted = j+1
+                            ps.append(p)
+                    with record_function("verify"):
+                        self.decoder.set_kv_len(i+n_draft+1)
+                        qs = self.probs_next(toks[:,i:i+n_draft+1], positions[i:i+n_draft+1], cps_emb, T, top_k)[0]
+                    accepted = 0
+                    for p,q,tok in zip(ps, qs, toks[0,i+1:i+n_draft+1]):
+                        if torch.rand((), device=p.device) * p[tok] > q[tok]:
+                            q = (q - p).clamp(min=0)
+                            break
+                        accepted += 1
+                    else:
+                        q = qs[-1]
+                    toks[:,i+accepted+1] = inference.multinomial_sample_one_no_sync(q / q.sum())
+                    drafted = min(drafted, i+accepted+1)
+
+                    new = toks[0,i+1:i+accepted+2]
+                    if (new == eot).any(): return toks[:,1:i+1+(new == eot).nonzero()[0,0]]
+                    i += accepted+1
+
+                    # for profiling, debugging or early exit
+                    if step is not None: step()
+                    if show_progress_bar: pb.update(i-start-1)
+            return toks[:,1:]
     
     @torch.no_grad()
-    def generate_batch(self, txts, N=None, T=1.1, top_k=7, show_progress_bar=True):
-        self.ensure_tokenizer()
-        N = self.stoks_len
-        dev = self.device
-        ttoks = []
-        for txt in txts:
-            ttoks_ = torch.tensor(self.tokenizer.encode(txt), device=dev)
-            ttoks_ = F.pad(ttoks_, (0, self.ttoks_len - len(ttoks_)), value=self.tokenizer.eot).unsqueeze(0)
-            ttoks.append(ttoks_)
-        ttoks = torch.cat(ttoks, dim=0)
-        toks = torch.zeros((len(ttoks),N), dtype=torch.long, device=dev)
-        it = range(N)
-        if show_progress_bar: it = progress_bar(it)
-        for i in it:
-            p, _ = self(ttoks, toks[:,:i], loss=None)
-            last_p = p[:,-1]
-            if top_k:
-                last_p[last_p < torch.topk(last_p, top_k).values[:,-1,None]] = -torch.inf
-            tok = torch.multinomial((last_p / float(T)).softmax(-1), 1)
-            toks[:,i] = tok[:,0]
-            if (toks[:,i] == self.stoks_codes-1).all(): return toks[:,:i]
-        return toks
+    def generate_batch(self, txts, N=None, T=1.1, top_k=7, show_progress_bar=True, cps=15, lang="en", seed=None):
+        """Generates semantic tokens for a list of texts of different lengths.
+
+        Every item of `txts` is either a string or a `(txt, lang, cps)` tuple. The texts are decoded together
+        in the KV cache rows set up by `optimize(max_batch_size=...)`, each one stops at its own EOT (or after
+        `N` positions, like in `generate`) and frees its row for the next text. Returns a list of token tensors
+        in the order of `txts`.
+
+        With an integer `seed` text `j` uses the seed `seed+j`, so it gets the same tokens as
+        `generate(seed=seed+j)` with the same `N`, `T` and `top_k`."""
+        batcher = T2SBatcher(self, T=T, top_k=top_k, N=N)
+        futs = [batcher.submit(*((x, lang, cps) if isinstance(x, str) else x), seed=None if seed is None else seed + j)
+                for j, x in enumerate(txts)]
+        return batcher.run_until_done(futs, show_progress_bar=show_progress_bar)
 
 # %% ../nbs/5B. Multi-lang text to semantic token modeling.ipynb 16
 def _make_model(size:str, tunables:Tunables=Tunables(), dataset=None, **kwargs):